@@ -0,0 +1,135 @@
+import time
+import uuid
+import sqlite3
+from contextlib import contextmanager
+
+# --- KIỂM SOÁT TẢI CHO CÁC ROUTE GỌI AI ---
+# 1. Token bucket theo user: mỗi user có `burst` lượt, hồi lại `rate_per_minute` lượt/phút.
+# 2. Giới hạn số lời gọi AI chạy cùng lúc trên toàn hệ thống (mọi gunicorn worker, cả route lẫn job nền),
+#    request vượt mức thì xếp hàng chờ (hàng đợi có giới hạn), hàng đầy -> từ chối ngay.
+# Trạng thái nằm trong 1 file SQLite dùng chung nên mọi process thấy cùng số liệu.
+
+
+class Rejected(Exception):
+    def __init__(self, message, retry_after, status=429):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class Admission:
+    def __init__(self, path, rate_per_minute=6.0, burst=10, max_concurrent=8, max_waiting=16,
+                 wait_timeout=20.0, lease_timeout=900.0, poll_interval=0.2):
+        self.path = path
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.lease_timeout = lease_timeout  # slot giữ quá lâu = process đã chết -> thu hồi
+        self.poll_interval = poll_interval
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS token_bucket (
+                user_id INTEGER PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL,
+                spent REAL NOT NULL DEFAULT 0, rejected INTEGER NOT NULL DEFAULT 0)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS llm_slot (
+                ticket TEXT PRIMARY KEY, user_id INTEGER, label TEXT, state TEXT NOT NULL,
+                created_at REAL NOT NULL, acquired_at REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_slot_state ON llm_slot (state, created_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=15, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK"); raise
+        finally:
+            conn.close()
+
+    # --- TOKEN BUCKET ---
+    def take(self, user_id, cost=1):
+        cost = min(cost, self.burst)  # batch lớn hơn burst vẫn chạy được khi bucket đầy
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated_at FROM token_bucket WHERE user_id = ?", (user_id,)).fetchone()
+            tokens = self.burst if row is None else min(self.burst, row["tokens"] + (now - row["updated_at"]) * self.rate_per_minute / 60)
+            allowed = tokens >= cost
+            if allowed: tokens -= cost
+            conn.execute("""INSERT INTO token_bucket (user_id, tokens, updated_at, spent, rejected) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(user_id) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at,
+                            spent = spent + excluded.spent, rejected = rejected + excluded.rejected""",
+                         (user_id, tokens, now, cost if allowed else 0, 0 if allowed else 1))
+        if not allowed:
+            retry_after = (cost - tokens) * 60 / self.rate_per_minute
+            raise Rejected(f"You are generating too fast. Please wait {max(1, round(retry_after))}s and try again.", retry_after)
+
+    # --- GIỚI HẠN ĐỒNG THỜI + HÀNG ĐỢI ---
+    def _expire(self, conn, now):
+        conn.execute("DELETE FROM llm_slot WHERE state = 'active' AND acquired_at < ?", (now - self.lease_timeout,))
+        conn.execute("DELETE FROM llm_slot WHERE state = 'waiting' AND created_at < ?", (now - self.wait_timeout - 30,))
+
+    def _try_promote(self, conn, ticket):
+        # Chỉ người chờ lâu nhất được lấy slot trống (FIFO)
+        active = conn.execute("SELECT COUNT(*) FROM llm_slot WHERE state = 'active'").fetchone()[0]
+        if active >= self.max_concurrent: return False
+        first = conn.execute("SELECT ticket FROM llm_slot WHERE state = 'waiting' ORDER BY created_at, ticket LIMIT 1").fetchone()
+        if first is None or first["ticket"] != ticket: return False
+        conn.execute("UPDATE llm_slot SET state = 'active', acquired_at = ? WHERE ticket = ?", (time.time(), ticket))
+        return True
+
+    def acquire(self, user_id, label=None):
+        ticket = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire(conn, now)
+            waiting = conn.execute("SELECT COUNT(*) FROM llm_slot WHERE state = 'waiting'").fetchone()[0]
+            if waiting >= self.max_waiting:
+                raise Rejected("The server is busy right now. Please try again in a moment.", self.wait_timeout, status=503)
+            conn.execute("INSERT INTO llm_slot (ticket, user_id, label, state, created_at) VALUES (?, ?, ?, 'waiting', ?)",
+                         (ticket, user_id, label, now))
+            if self._try_promote(conn, ticket): return ticket
+
+        deadline = now + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            with self._transaction() as conn:
+                if self._try_promote(conn, ticket): return ticket
+        self.release(ticket)
+        raise Rejected("The server is busy right now. Please try again in a moment.", self.wait_timeout, status=503)
+
+    def release(self, ticket):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM llm_slot WHERE ticket = ?", (ticket,))
+
+    @contextmanager
+    def slot(self, user_id, label=None):
+        ticket = self.acquire(user_id, label)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def usage(self):
+        now = time.time()
+        with self._connect() as conn:
+            slots = [dict(r) for r in conn.execute("SELECT user_id, label, state, created_at, acquired_at FROM llm_slot ORDER BY created_at")]
+            buckets = {}
+            for r in conn.execute("SELECT * FROM token_bucket"):
+                tokens = min(self.burst, r["tokens"] + (now - r["updated_at"]) * self.rate_per_minute / 60)
+                buckets[r["user_id"]] = {"tokens": round(tokens, 1), "spent": r["spent"], "rejected": r["rejected"]}
+        return {
+            "active": [s for s in slots if s["state"] == "active"],
+            "waiting": [s for s in slots if s["state"] == "waiting"],
+            "buckets": buckets,
+            "limits": {"rate_per_minute": self.rate_per_minute, "burst": self.burst,
+                       "max_concurrent": self.max_concurrent, "max_waiting": self.max_waiting},
+        }
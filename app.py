@@ -1,19 +1,43 @@
 import os
 import json
-import http.client
 import sys
 import webbrowser
-import uuid
 import re
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
+import time
+import math
+import asyncio
+import functools
+import contextlib
+import contextvars
+from datetime import datetime, timedelta, timezone
+import click
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, Response, stream_with_context, send_from_directory, abort, session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, update, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import PyPDF2
-import docx
+import llm_client
+import llm_cache
+import jobs
+import pipeline
+import image_pipeline
+import storage
+import metrics
+import resilience
+import admission
+import search
+import prompts
+import ingest
+import jsonscan
+import export
+import imagegen
+import bulk
+import httpcache
+import storydoc
 
 # --- 1. CẤU HÌNH BAN ĐẦU ---
 load_dotenv()
@@ -49,11 +73,184 @@ if not os.path.exists(UPLOAD_FOLDER): os.makedirs(UPLOAD_FOLDER)
 instance_folder = os.path.join(base_dir, 'instance')
 if not os.path.exists(instance_folder): os.makedirs(instance_folder)
 
+# Ảnh panel lưu theo hash nội dung (không trùng lặp), local hoặc S3 tùy STORAGE_BACKEND
+media_store = storage.from_env(os.path.join(base_dir, 'static', 'media'))
+# PDF xuất phía server, key = hash nội dung truyện/comic (xem export.py)
+EXPORT_CACHE_DAYS = float(os.environ.get('EXPORT_CACHE_DAYS', 30))
+export_store = storage.LocalStorage(os.environ.get('EXPORT_CACHE_DIR', os.path.join(instance_folder, 'exports')), url_prefix='')
+
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Thread pool cho pipeline: tầng quiz (fan-out biến thể) và batch nhiều level tách riêng
+# để batch không chiếm hết chỗ của quiz đang chờ bên trong nó
+quiz_stage = pipeline.FanOut(int(os.environ.get('QUIZ_STAGE_WORKERS', 6)), 'quiz-stage')
+batch_stage = pipeline.FanOut(int(os.environ.get('BATCH_STAGE_WORKERS', 4)), 'batch-stage')
+QUIZ_TIMEOUT = float(os.environ.get('QUIZ_TIMEOUT', 240))
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', 600))
+# Sinh ảnh panel (imagegen.py): pool dùng chung mọi comic -> giới hạn số ảnh render cùng lúc trong 1 process
+image_stage = pipeline.FanOut(int(os.environ.get('IMAGE_WORKERS', 12)), 'panel-image')
+IMAGE_TIMEOUT = float(os.environ.get('IMAGE_TIMEOUT', 300))
+IMAGE_ATTEMPTS = int(os.environ.get('IMAGE_ATTEMPTS', 3))
+# Bulk từ CSV/XLSX: pool riêng = số truyện của mọi lượt bulk được sinh cùng lúc trong 1 process
+bulk_stage = pipeline.FanOut(int(os.environ.get('BULK_CONCURRENCY', 4)), 'bulk-stage')
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 200))
+BULK_MAX_BYTES = int(os.environ.get('BULK_MAX_BYTES', 2 * 1024 * 1024))
+BULK_CHUNK_ROWS = int(os.environ.get('BULK_CHUNK_ROWS', 24))  # mỗi lượt FanOut; giữa các lượt, bulk của user khác được chen vào
+BULK_FLUSH_ROWS = int(os.environ.get('BULK_FLUSH_ROWS', 8))  # ghi DB (1 transaction) sau mỗi N truyện xong = 1 checkpoint
+
+# Lời gọi LLM trong job nền (kể cả trong task fan-out: FanOut chép contextvars sang thread của nó) giữ slot admission
+# như route đồng bộ -> giới hạn đồng thời toàn cục tính cả job. Ngoài job = None: route đã tự giữ slot của nó
+llm_job_owner = contextvars.ContextVar('llm_job_owner', default=None)
+JOB_SLOT_WAIT = float(os.environ.get('JOB_SLOT_WAIT', 600))  # job không bị từ chối như request, chờ slot tối đa chừng này
+
+@contextlib.contextmanager
+def job_context(job):
+    owner = llm_job_owner.set((job['user_id'], f"job:{job['kind']}"))
+    try:
+        with app.app_context(): yield
+    finally:
+        llm_job_owner.reset(owner)
+
+@contextlib.contextmanager
+def job_llm_slot():
+    owner = llm_job_owner.get()
+    if owner is None:
+        yield; return
+    deadline = time.time() + JOB_SLOT_WAIT
+    while True:
+        try:
+            ticket = admission_control.acquire(*owner)
+            break
+        except admission.Rejected as e:
+            if time.time() + e.retry_after > deadline: raise
+            time.sleep(e.retry_after)  # hàng chờ đầy / chờ quá lâu -> xếp hàng lại sau, không làm hỏng job
+    try:
+        yield
+    finally:
+        admission_control.release(ticket)
+
+# Hàng đợi job nền cho các route gọi AI lâu (story/quiz/comic)
+job_queue = jobs.JobQueue(
+    os.environ.get('JOB_DB_PATH', os.path.join(instance_folder, 'jobs.db')),
+    workers=int(os.environ.get('JOB_WORKERS', 4)),
+    context=job_context,
+)
+
+@app.before_request
+def start_job_workers():
+    # Worker + heartbeat/housekeeping chạy ngay khi process nhận request đầu tiên (1 lần mỗi PID, sau fork của gunicorn),
+    # không đợi tới lần enqueue đầu -> sau restart/deploy, job còn trong hàng đợi và job mồ côi được chạy tiếp
+    job_queue.start()
+
+# Giới hạn tốc độ theo user + số lời gọi AI đồng thời (dùng chung giữa các worker qua SQLite)
+admission_control = admission.Admission(
+    os.environ.get('ADMISSION_DB_PATH', os.path.join(instance_folder, 'admission.db')),
+    rate_per_minute=float(os.environ.get('RATE_LIMIT_PER_MINUTE', 6)),
+    burst=int(os.environ.get('RATE_LIMIT_BURST', 10)),
+    max_concurrent=int(os.environ.get('LLM_MAX_CONCURRENT', 8)),
+    max_waiting=int(os.environ.get('LLM_MAX_WAITING', 16)),
+    wait_timeout=float(os.environ.get('LLM_WAIT_TIMEOUT', 20)),
+)
+MAX_PENDING_JOBS_PER_USER = int(os.environ.get('MAX_PENDING_JOBS_PER_USER', 3))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 100))
+
+# --- HTTP CACHE: ETag theo version của dữ liệu + fragment HTML đã render (xem httpcache.py) ---
+def build_id():
+    # Deploy template/code mới -> ETag cũ hết hiệu lực dù dữ liệu không đổi
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    paths = [__file__] + [os.path.join(d, f) for d, _, files in os.walk(template_dir) for f in files]
+    return os.environ.get('APP_BUILD') or str(int(max(os.path.getmtime(p) for p in paths)))
+
+BUILD_ID = build_id()
+fragment_cache = httpcache.FragmentCache(max_items=int(os.environ.get('FRAGMENT_CACHE_ITEMS', 2000)),
+                                         max_bytes=int(os.environ.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024)))
+app.jinja_env.globals['cache_fragment'] = httpcache.TemplateFragments(fragment_cache, lambda: current_user.get_id())
+
+# --- ĐỌC FILE STYLE (PDF/DOCX): giới hạn dung lượng/trang, cache theo hash, parse trong process pool ---
+style_extractor = ingest.Extractor(
+    max_bytes=int(os.environ.get('INGEST_MAX_BYTES', 10 * 1024 * 1024)),
+    max_pages=int(os.environ.get('INGEST_MAX_PAGES', 30)),
+    max_chars=int(os.environ.get('STYLE_SAMPLE_CHARS', 4000)),
+    workers=int(os.environ.get('INGEST_WORKERS', 2)),
+    timeout=float(os.environ.get('INGEST_TIMEOUT', 30)),
+    cache=llm_cache.ResponseCache(os.environ.get('INGEST_CACHE_PATH', os.path.join(instance_folder, 'ingest_cache.db')),
+                                  max_items=64, max_bytes=50 * 1024 * 1024, ttl=30 * 24 * 3600),
+)
+
+# --- METRICS (/metrics, tắt bằng METRICS_ENABLED=0) ---
+http_latency = metrics.registry.histogram('http_request_duration_seconds', 'Time until the response headers are sent, per Flask endpoint.', ('endpoint', 'method', 'status'))
+request_db_queries = metrics.registry.histogram('http_request_db_queries', 'SQL queries issued per request.', ('endpoint',), metrics.COUNT_BUCKETS)
+request_db_seconds = metrics.registry.histogram('http_request_db_seconds', 'Time spent in SQL per request.', ('endpoint',))
+db_query_latency = metrics.registry.histogram('db_query_duration_seconds', 'Latency of single SQL statements.', ('operation',))
+upload_bytes = metrics.registry.histogram('upload_bytes', 'Size of multipart uploads.', ('endpoint',), metrics.BYTES_BUCKETS)
+llm_latency = metrics.registry.histogram('llm_request_duration_seconds', 'LLM call duration (streamed calls: until the last chunk).', ('mode', 'status'))
+llm_tokens = metrics.registry.counter('llm_tokens_total', 'LLM tokens, from the usage field or estimated as chars/4 for streams.', ('kind', 'source'))
+
+def llm_pool_stats():
+    stats = llm_client.get_client().stats()
+    return {(k,): stats[k] for k in ("created", "reused", "requests", "stale_retries", "discarded", "errors")}
+
+def llm_cache_stats():
+    cache = llm_cache.get_cache(instance_folder)
+    if not cache: return None
+    stats = cache.stats()
+    return {(k,): stats[k] for k in ("hits_memory", "hits_disk", "misses", "stores", "bypassed", "rejected")}
+
+def llm_cache_size():
+    cache = llm_cache.get_cache(instance_folder)
+    if not cache: return None
+    stats = cache.stats()
+    return {("memory_entries",): stats["memory_entries"], ("disk_entries",): stats["disk_entries"], ("disk_bytes",): stats["disk_bytes"]}
+
+metrics.registry.gauge('llm_pool_events_total', 'LLM connection pool counters (stale_retries = retries on a dropped keep-alive connection).', llm_pool_stats, ('event',), kind='counter')
+metrics.registry.gauge('llm_resilience_events_total', 'LLM retries, hedged requests and calls rejected by the circuit breaker.',
+                       lambda: {(k,): v for k, v in llm_client.get_client().counters.items()}, ('event',), kind='counter')
+metrics.registry.gauge('llm_circuit_open', '1 while the LLM circuit breaker is rejecting calls (0.5 = half-open probe).',
+                       lambda: {"closed": 0, "half_open": 0.5, "open": 1}[llm_client.get_client().breaker.state])
+metrics.registry.gauge('llm_pool_idle_connections', 'Idle keep-alive connections to the LLM API.', lambda: llm_client.get_client().stats()["idle"])
+metrics.registry.gauge('llm_cache_events_total', 'LLM response cache counters.', llm_cache_stats, ('event',), kind='counter')
+metrics.registry.gauge('style_ingest_cache_events_total', 'Text extracted from uploaded style files: cache hits/misses by file hash.',
+                       lambda: {(k,): v for k, v in style_extractor.stats().items() if k in ("hits_memory", "hits_disk", "misses", "stores")}, ('event',), kind='counter')
+metrics.registry.gauge('llm_cache_size', 'LLM response cache size.', llm_cache_size, ('measure',))
+http_cache_events = metrics.registry.counter('http_cache_responses_total', 'Cacheable pages answered with 304 or rendered.', ('endpoint', 'result'))
+export_requests = metrics.registry.counter('export_pdf_requests_total', 'PDF export requests: served from cache, answered 304, queued or rendered.', ('kind', 'result'))
+bulk_rows = metrics.registry.counter('bulk_rows_total', 'Rows of bulk CSV/XLSX runs, by outcome.', ('result',))
+panel_image_renders = metrics.registry.counter('panel_image_renders_total', 'Panel images generated by the image backend.', ('backend', 'result'))
+admission_rejections = metrics.registry.counter('admission_rejected_total', 'Requests refused by rate limiting or the concurrency cap.', ('endpoint', 'reason'))
+metrics.registry.gauge('llm_admission_slots', 'LLM calls (requests and background jobs) holding or waiting for a global slot.',
+                       lambda: {(k,): len(v) for k, v in admission_control.usage().items() if k in ("active", "waiting")}, ('state',))
+metrics.registry.gauge('job_queue_depth', 'Background jobs waiting or running.', lambda: {(k,): v for k, v in job_queue.depth().items()}, ('status',))
+metrics.registry.gauge('prompt_template_events_total', 'Prompts rendered, inputs trimmed to the token budget and compiled-section cache hits, per template version.',
+                       prompts.stats, ('template', 'event'), kind='counter')
+metrics.registry.gauge('fragment_cache_events_total', 'Rendered HTML fragment cache counters (discarded = dropped because the row changed or was deleted).',
+                       lambda: {(k,): v for k, v in fragment_cache.stats().items() if k not in ("entries", "bytes")}, ('event',), kind='counter')
+metrics.registry.gauge('fragment_cache_size', 'Rendered HTML fragments held in memory.', lambda: {(k,): fragment_cache.stats()[k] for k in ("entries", "bytes")}, ('measure',))
+metrics.registry.gauge('pipeline_pending_tasks', 'Fan-out tasks waiting for a free thread.', lambda: {("quiz",): quiz_stage.pending(), ("batch",): batch_stage.pending(), ("image",): image_stage.pending(), ("bulk",): bulk_stage.pending()}, ('stage',))
+
+if metrics.ENABLED:
+    with app.app_context(): metrics.install_sqlalchemy_hooks(db.engine, db_query_latency)
+
+    @app.before_request
+    def start_request_metrics():
+        request.environ['metrics.started'] = time.perf_counter()
+        metrics.begin_scope()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = request.environ.get('metrics.started')
+        if started is None: return response
+        endpoint = request.endpoint or 'unmatched'
+        http_latency.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method, status=response.status_code)
+        queries, query_seconds = metrics.end_scope()
+        request_db_queries.observe(queries, endpoint=endpoint)
+        request_db_seconds.observe(query_seconds, endpoint=endpoint)
+        if request.mimetype == 'multipart/form-data' and request.content_length:
+            upload_bytes.observe(request.content_length, endpoint=endpoint)
+        return response
+
 # --- 2. MODELS ---
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -74,12 +271,96 @@ class Story(db.Model):
     content = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     prompt_data = db.Column(db.Text, nullable=True)
+    # Các trường hay lọc/thống kê, tách từ prompt_data khi lưu (xem sync_story_metadata)
+    cefr_level = db.Column(db.String(20), nullable=True)
+    word_count = db.Column(db.Integer, nullable=True)
+    theme = db.Column(db.String(200), nullable=True)
+    target_audience = db.Column(db.String(200), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow) # Truyện lưu trước khi có cột này = NULL
+    # Tăng mỗi lần sửa (xem bump_row_versions) -> ETag/fragment cache biết khi nào nội dung đổi
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # HTML dựng sẵn từ content (storydoc.py), hợp lệ khi content_html_key == story_html_key(version). Deferred: chỉ tải khi cần
+    content_html = db.deferred(db.Column(db.Text, nullable=True))
+    content_html_key = db.Column(db.String(40), nullable=True)
     comics = db.relationship('Comic', backref='story', lazy=True)
+    vocab = db.relationship('StoryVocab', backref='story', lazy=True, cascade='all, delete-orphan')
+    worksheets = db.relationship('Worksheet', backref='story', lazy=True, cascade='all, delete-orphan', order_by='Worksheet.version')
+    __table_args__ = (db.Index('ix_story_user_level', 'user_id', 'cefr_level'),
+                      db.Index('ix_story_user_created', 'user_id', 'created_at'))
+
+class StoryVocab(db.Model):
+    # 1 dòng / từ vựng / truyện -> "các truyện dùng từ X" là 1 truy vấn có index
+    id = db.Column(db.Integer, primary_key=True)
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
+    word = db.Column(db.String(100), nullable=False)
+    __table_args__ = (db.UniqueConstraint('story_id', 'word', name='uq_story_vocab'),
+                      db.Index('ix_story_vocab_word', 'word', 'story_id'))
+
+class Worksheet(db.Model):
+    # Worksheet/quiz của 1 truyện. Trước đây nối vào cuối Story.content -> mỗi lần thêm quiz lại gửi cả quiz cũ cho model
+    id = db.Column(db.Integer, primary_key=True)
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
+    kind = db.Column(db.String(50), nullable=False, default='mix') # quiz_type lúc tạo (mcq / tf / "mcq,tf"...); 'legacy' = tách từ content cũ
+    version = db.Column(db.Integer, nullable=False) # 1, 2, 3... theo thứ tự thêm vào truyện
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('story_id', 'version', name='uq_worksheet_story_version'),)
 
 class Comic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
-    panels_content = db.Column(db.Text, nullable=False)
+    panels_content = db.Column(db.Text, nullable=False) # Bản kịch bản gốc (JSON). Dữ liệu đang dùng nằm ở bảng Panel
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1') # Tăng khi comic hoặc panel của nó đổi
+    panels = db.relationship('Panel', backref='comic', lazy=True, order_by='Panel.position')
+
+class Panel(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    comic_id = db.Column(db.Integer, db.ForeignKey('comic.id'), nullable=False)
+    panel_number = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False) # Thứ tự hiển thị (giữ đúng thứ tự trong JSON cũ)
+    prompt = db.Column(db.Text, nullable=False, default='')
+    caption = db.Column(db.Text, nullable=False, default='')
+    image_url = db.Column(db.String(300), nullable=False, default='')
+    image_variants = db.Column(db.Text, nullable=True) # JSON các cỡ ảnh (thumb/screen/print) do image_pipeline tạo
+    image_error = db.Column(db.Text, nullable=True) # Lỗi lần sinh ảnh gần nhất (imagegen); có ảnh mới thì xóa -> "Retry failed" chỉ chạy lại các panel này
+    __table_args__ = (db.Index('ix_panel_comic_number', 'comic_id', 'panel_number'),)
+
+    @property
+    def srcsets(self): return image_pipeline.srcsets(self.image_variants)
+
+class StoredFile(db.Model):
+    # Đếm số Panel đang trỏ tới mỗi file trong media_store; refcount = 0 -> lệnh storage-gc sẽ xóa
+    key = db.Column(db.String(120), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    touched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+BULK_PENDING, BULK_DONE, BULK_FAILED = 'pending', 'done', 'failed'
+
+class BulkRun(db.Model):
+    # 1 file CSV/XLSX upload ở trang Bulk. Tiến độ = đếm BulkRow theo status (không lưu bộ đếm riêng -> không lệch)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    fresh = db.Column(db.Boolean, nullable=False, default=False)
+    prompt_versions = db.Column(db.Text, nullable=True) # JSON prompts.assign() lúc upload -> chạy tiếp vẫn dùng đúng bản prompt
+    job_id = db.Column(db.String(32), nullable=True) # Job 'bulk_run' gần nhất (Resume tạo job mới)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    rows = db.relationship('BulkRow', backref='run', lazy=True, cascade='all, delete-orphan', order_by='BulkRow.row_number')
+    __table_args__ = (db.Index('ix_bulk_run_user_created', 'user_id', 'created_at'),)
+
+class BulkRow(db.Model):
+    # 1 dòng của file = 1 truyện. status là checkpoint: job chạy lại (process chết / Resume) bỏ qua các dòng 'done'
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('bulk_run.id'), nullable=False)
+    row_number = db.Column(db.Integer, nullable=False) # Số dòng trong file (header = 1) để báo lỗi đúng chỗ
+    form = db.Column(db.Text, nullable=False) # JSON theo field của form index.html, lưu làm prompt_data của truyện
+    status = db.Column(db.String(20), nullable=False, default=BULK_PENDING)
+    story_id = db.Column(db.Integer, nullable=True) # Không FK: user có thể xóa truyện sau đó
+    error = db.Column(db.Text, nullable=True)
+    __table_args__ = (db.Index('ix_bulk_row_run_status', 'run_id', 'status'),)
 
 class Feedback(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -98,320 +379,549 @@ def configure_ai():
     if not api_key: return None
     return api_key
 
-def extract_text_from_file(file):
-    text = ""
-    filename = file.filename.lower()
+def wants_fresh():
+    # Cờ bỏ qua cache cho từng request: form field fresh=1 hoặc header Cache-Control: no-cache
+    return request.values.get('fresh') == '1' or 'no-cache' in request.headers.get('Cache-Control', '')
+
+def cached_completion(prompt, use_cache):
+    # Trả về (cache, key, nội dung đã cache hoặc None)
+    cache = llm_cache.get_cache(instance_folder)
+    if not cache: return None, None, None
+    cache_key = llm_cache.make_key(llm_client.get_client().model, prompt, 0.8)
+    if not use_cache:
+        cache.note_bypass()
+        return cache, cache_key, None
+    return cache, cache_key, cache.get(cache_key)
+
+def generate_story_ai(api_key, prompt, use_cache=True):
+    cache, cache_key, cached = cached_completion(prompt, use_cache)
+    if cached is not None: return cached
+    started = time.perf_counter()
+    status = "error"
     try:
-        if filename.endswith('.pdf'):
-            reader = PyPDF2.PdfReader(file)
-            for page in reader.pages: text += page.extract_text() + "\n"
-        elif filename.endswith('.docx'):
-            doc = docx.Document(file)
-            for para in doc.paragraphs: text += para.text + "\n"
-        else: return None
-    except: return None
-    return text
-
-def generate_story_ai(api_key, prompt):
+        with job_llm_slot():
+            started = time.perf_counter()  # không tính thời gian chờ slot
+            status, data = llm_client.get_client().chat(api_key, prompt, temperature=0.8)
+        return completion_text(status, data, cache, cache_key)
+    except admission.Rejected as e:
+        status = "busy"
+        return f"ERROR: {e}"
+    except resilience.CircuitOpenError as e:
+        status = "circuit_open"
+        return f"ERROR: {e}"
+    except Exception as e: return f"System Error: {e}"
+    finally: llm_latency.observe(time.perf_counter() - started, mode='chat', status=status)
+
+def completion_text(status, data, cache, cache_key):
+    # Đọc body của /chat/completions (dùng chung cho bản sync và async)
+    if status != 200: return f"ERROR: {status}"
+    response_json = json.loads(data)
+    usage = response_json.get('usage') or {}
+    if usage:
+        llm_tokens.inc(usage.get('prompt_tokens', 0), kind='prompt', source='usage')
+        llm_tokens.inc(usage.get('completion_tokens', 0), kind='completion', source='usage')
+    if 'choices' in response_json:
+        content = response_json['choices'][0]['message']['content'].replace('**', '')
+        if cache: cache.put(cache_key, content)
+        return content
+    return "Error parsing response"
+
+def stream_story_ai(api_key, prompt, use_cache=True):
+    # Bản streaming của generate_story_ai: yield từng đoạn text ngay khi model viết ra.
+    # Lỗi được yield dưới dạng chuỗi "ERROR: ..." / "System Error: ..." như bản thường.
+    cache, cache_key, cached = cached_completion(prompt, use_cache)
+    if cached is not None:
+        yield cached; return
+    stripper = llm_client.BoldStripper()
+    parts = []
+    started = time.perf_counter()
+    status = "error"
     try:
-        conn = http.client.HTTPSConnection("api.yescale.io")
-        payload = json.dumps({
-            "model": "gemini-2.5-pro-thinking",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.8 
-        })
-        headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
-        conn.request("POST", "/v1/chat/completions", payload, headers)
-        res = conn.getresponse()
-        data = res.read().decode("utf-8")
-        if res.status != 200: return f"ERROR: {res.status}"
-        
-        response_json = json.loads(data)
-        if 'choices' in response_json:
-             content = response_json['choices'][0]['message']['content']
-             return content.replace('**', '')
-        return "Error parsing response"
+        with job_llm_slot():
+            started = time.perf_counter()
+            for delta in llm_client.get_client().stream_chat(api_key, prompt, temperature=0.8):
+                text = stripper.feed(delta)
+                if text:
+                    parts.append(text); yield text
+            tail = stripper.flush()
+            if tail:
+                parts.append(tail); yield tail
+        status = 200
+    except admission.Rejected as e:
+        status = "busy"
+        yield f"ERROR: {e}"; return
+    except llm_client.UpstreamError as e:
+        status = e.status
+        yield f"ERROR: {e.status}"; return
+    except resilience.CircuitOpenError as e:
+        status = "circuit_open"
+        yield f"ERROR: {e}"; return
+    except Exception as e:
+        yield f"System Error: {e}"; return
+    finally:
+        llm_latency.observe(time.perf_counter() - started, mode='stream', status=status)
+    finish_stream(prompt, parts, cache, cache_key)
+
+def finish_stream(prompt, parts, cache, cache_key):
+    llm_tokens.inc(len(prompt) // 4, kind='prompt', source='estimate')
+    llm_tokens.inc(sum(len(p) for p in parts) // 4, kind='completion', source='estimate')
+    if cache: cache.put(cache_key, "".join(parts))
+
+# --- BẢN ASYNC (chế độ ASGI, xem asgi.py): cùng cache/metrics/định dạng lỗi, chờ model trên event loop ---
+async def async_generate_story_ai(api_key, prompt, use_cache=True):
+    cache, cache_key, cached = cached_completion(prompt, use_cache)
+    if cached is not None: return cached
+    started = time.perf_counter()
+    status = "error"
+    try:
+        status, data = await llm_client.get_async_client().chat(api_key, prompt, temperature=0.8)
+        return completion_text(status, data, cache, cache_key)
+    except resilience.CircuitOpenError as e:
+        status = "circuit_open"
+        return f"ERROR: {e}"
     except Exception as e: return f"System Error: {e}"
-
-def robust_json_extract(text):
+    finally: llm_latency.observe(time.perf_counter() - started, mode='chat', status=status)
+
+async def async_stream_story_ai(api_key, prompt, use_cache=True):
+    cache, cache_key, cached = cached_completion(prompt, use_cache)
+    if cached is not None:
+        yield cached; return
+    stripper = llm_client.BoldStripper()
+    parts = []
+    started = time.perf_counter()
+    status = "error"
     try:
-        match = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", text, re.DOTALL)
-        if match:
-            text = match.group(1)
-        else:
-            start_match = re.search(r"[\{\[]", text)
-            if start_match:
-                start_idx = start_match.start()
-                end_idx = max(text.rfind('}'), text.rfind(']'))
-                if end_idx > start_idx:
-                    text = text[start_idx : end_idx + 1]
-            else:
-                return None
-
-        text = re.sub(r'//.*', '', text)
-        text = re.sub(r',\s*([\]}])', r'\1', text)
-        return json.loads(text)
+        async for delta in llm_client.get_async_client().stream_chat(api_key, prompt, temperature=0.8):
+            text = stripper.feed(delta)
+            if text:
+                parts.append(text); yield text
+        tail = stripper.flush()
+        if tail:
+            parts.append(tail); yield tail
+        status = 200
+    except llm_client.UpstreamError as e:
+        status = e.status
+        yield f"ERROR: {e.status}"; return
+    except resilience.CircuitOpenError as e:
+        status = "circuit_open"
+        yield f"ERROR: {e}"; return
     except Exception as e:
-        print(f"JSON Parsing Error: {e}")
-        return None
-    
-# --- 4. ADVANCED PROMPT ENGINEERING ---
-
-CEFR_LEVEL_GUIDELINES = {
-    "PRE A1": "Simple Present (be/have/action). Short sentences (3-6 words). Focus on visual actions.",
-    "A1": "Present Simple/Continuous. Basic conjunctions (and, but). Dialogues are simple Q&A.",
-    "A2": "Past Simple, Future (will/going to). Adverbs of frequency. Coordinated sentences.",
-    "B1": "Narrative tenses (Past Continuous), Conditionals (1 & 2), Reasons (because/so). Expressing feelings/opinions.",
-    "B2": "Passive voice, Reported speech, Relative clauses. Nuanced vocabulary and abstract ideas.",
-    "C1": "Complex sentence structures, Inversion, Idiomatic expressions. Literary tone.",
-    "C2": "Sophisticated style, Implicit meaning, Cultural references, Irony/Humor."
-}
+        yield f"System Error: {e}"; return
+    finally:
+        llm_latency.observe(time.perf_counter() - started, mode='stream', status=status)
+    finish_stream(prompt, parts, cache, cache_key)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_text_response(pieces):
+    # Đẩy từng đoạn text xuống trình duyệt dạng Server-Sent Events
+    def stream():
+        for piece in pieces: yield sse_event('chunk', {"text": piece})
+        yield sse_event('done', {})
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- CHẾ ĐỘ ASGI (asgi.py) ---
+# asgi.py vẫn chạy Flask trong thread pool, nhưng đặt ASYNC_BODY vào environ: view có bản async chỉ làm phần nhanh
+# (đăng nhập, admission, dựng prompt) rồi giao phần chờ model cho event loop -> thread được trả lại ngay.
+ASYNC_BODY = 'storycraft.async_body'
+
+def async_mode():
+    return ASYNC_BODY in request.environ
+
+def deferred_response(body, mimetype, on_close=None, headers=None):
+    # body: async generator (str/bytes); on_close chạy khi body xong hoặc client ngắt giữa chừng
+    request.environ[ASYNC_BODY] = (body, on_close)
+    return Response(mimetype=mimetype, headers=headers)
+
+async def async_sse(pieces):
+    async for piece in pieces: yield sse_event('chunk', {"text": piece})
+    yield sse_event('done', {})
+
+def panels_from_json(panels_data):
+    panels = []
+    for i, p in enumerate(panels_data):
+        if not isinstance(p, dict): continue
+        try: number = int(p.get('panel_number', i + 1))
+        except (TypeError, ValueError): number = i + 1
+        panels.append(Panel(panel_number=number, position=i, prompt=p.get('prompt', ''),
+                            caption=p.get('caption', ''), image_url=p.get('image_url', '') or ''))
+    return panels
+
+def delete_comics_for_stories(story_ids):
+    if not story_ids: return
+    comic_ids = db.session.query(Comic.id).filter(Comic.story_id.in_(story_ids))
+    for image_url, image_variants in db.session.query(Panel.image_url, Panel.image_variants).filter(Panel.comic_id.in_(comic_ids)):
+        release_media(panel_media_keys(image_url, image_variants))
+    Panel.query.filter(Panel.comic_id.in_(comic_ids)).delete(synchronize_session=False)
+    Comic.query.filter(Comic.story_id.in_(story_ids)).delete(synchronize_session=False)
+
+# --- METADATA TRUYỆN (tách từ prompt_data) ---
+def prompt_metadata(prompt_data):
+    # prompt_data = JSON form index.html (vocab_str, cefr_level, word_count, theme, target_audience...)
+    try: data = json.loads(prompt_data) if prompt_data else {}
+    except (TypeError, ValueError): data = {}
+    if not isinstance(data, dict): data = {}
+
+    def field(*keys, limit=200):
+        value = next((str(data[k]).strip() for k in keys if data.get(k)), "")
+        return value[:limit] or None
+
+    vocab = data.get('vocab_str') or data.get('vocab') or ''
+    if isinstance(vocab, str): vocab = vocab.split(',')
+    words = [str(w).strip().lower()[:100] for w in vocab if str(w).strip()] if isinstance(vocab, list) else []
+    count = re.search(r'\d+', str(data.get('word_count') or data.get('count') or ''))
+    level = field('cefr_level', 'level', limit=20)
+    return {
+        "cefr_level": level.upper() if level else None,
+        "word_count": min(int(count.group()), 100000) if count else None,
+        "theme": field('theme'),
+        "target_audience": field('target_audience'),
+        "vocab": list(dict.fromkeys(words)),
+    }
 
-# --- KHO GIỌNG VĂN MẪU THEO LEVEL (LITERARY STYLES) ---
-LITERARY_STYLES = {
-    "PRE A1": [
-        "Style of Eric Carle: Very simple, repetitive, focuses on nature, colors, and sensory details.",
-        "Style of Margaret Wise Brown (Goodnight Moon): Gentle, rhythmic, soothing, listing objects in the room.",
-        "Style of Mo Willems: Dialogue-heavy, simple, repetitive but expressive and funny."
-    ],
-    "A1": [
-        "Style of Arnold Lobel (Frog and Toad): Simple but warm friendship stories, cozy atmosphere.",
-        "Style of Beatrix Potter: Gentle, pastoral, focuses on small animals and rural settings.",
-        "Style of Dr. Seuss (Prose version): Whimsical, playful, simple vocabulary but creative concepts."
-    ],
-    "A2": [
-        "Style of Roald Dahl: Mischievous, energetic, vivid adjectives, funny exaggerations of characters.",
-        "Style of Enid Blyton: Clear adventure, group of friends, descriptive but accessible.",
-        "Style of Jeff Kinney (Wimpy Kid): Casual diary format, relatable school life struggles, humorous."
-    ],
-    "B1": [
-        "Style of Ernest Hemingway: Short, punchy sentences. Focus on action and concrete details. No fluffy adjectives.",
-        "Style of E.B. White (Charlotte's Web): Clear, elegant, touching, focuses on nature and loyalty.",
-        "Style of R.L. Stine (Goosebumps): Suspenseful, cliffhangers, engaging plot twists (good for mysteries)."
-    ],
-    "B2": [
-        "Style of Mark Twain: Folksy, observational, rich in local color and dialect nuances.",
-        "Style of C.S. Lewis: Descriptive, slightly magical tone, clear moral compass.",
-        "Style of Neil Gaiman (Coraline): Atmospheric, slightly dark/mysterious, rich imagery."
-    ],
-    "C1": [
-        "Style of Jane Austen: Social observation, irony, complex sentence structures, focus on manners/relationships.",
-        "Style of Sherlock Holmes (Conan Doyle): Deductive, analytical, detailed descriptions of settings.",
-        "Style of Jack London: Raw nature, survival, intense description of the environment."
-    ],
-    "C2": [
-        "Style of Oscar Wilde: Witty, aesthetic, sophisticated vocabulary, paradoxical humor.",
-        "Style of Edgar Allan Poe: Melancholic, poetic, complex grammar, psychological depth.",
-        "Style of Virginia Woolf: Stream of consciousness, focus on internal thoughts and fleeing moments."
-    ]
-}
+@event.listens_for(db.session, 'before_flush')
+def sync_story_metadata(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Story): continue
+        if obj not in session.new and not db.inspect(obj).attrs.prompt_data.history.has_changes(): continue
+        meta = prompt_metadata(obj.prompt_data)
+        obj.cefr_level, obj.word_count = meta['cefr_level'], meta['word_count']
+        obj.theme, obj.target_audience = meta['theme'], meta['target_audience']
+        existing = {v.word: v for v in obj.vocab}  # giữ dòng cũ nếu từ không đổi (tránh trùng unique khi insert trước delete)
+        obj.vocab = [existing.get(w) or StoryVocab(word=w) for w in meta['vocab']]
+
+# --- VERSION CỦA STORY/COMIC (cho ETag + fragment cache) ---
+def touch_row(obj, now):
+    # version = version + 1 chạy trong SQL: 2 request sửa cùng lúc vẫn ra 2 version khác nhau
+    obj.version = type(obj).version + 1
+    obj.updated_at = now
+    fragment_cache.discard('story-card' if isinstance(obj, Story) else 'comic-panels', obj.id)
+
+def touch_comic(comic_id):
+    # Cho các chỗ sửa Panel bằng bulk UPDATE (không đi qua before_flush)
+    Comic.query.filter_by(id=comic_id).update({Comic.version: Comic.version + 1, Comic.updated_at: datetime.utcnow()}, synchronize_session=False)
+    fragment_cache.discard('comic-panels', comic_id)
+
+@event.listens_for(db.session, 'before_flush')
+def bump_row_versions(session, flush_context, instances):
+    now = datetime.utcnow()
+    comics, stories = set(), set()
+    for obj in session.dirty:
+        if isinstance(obj, (Story, Comic)) and session.is_modified(obj, include_collections=False): touch_row(obj, now)
+        elif isinstance(obj, Panel) and session.is_modified(obj): comics.add(obj.comic_id)
+        elif isinstance(obj, Worksheet) and session.is_modified(obj): stories.add(obj.story_id)
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Panel) and obj.comic_id: comics.add(obj.comic_id)
+        elif isinstance(obj, Worksheet) and obj.story_id: stories.add(obj.story_id)
+    for obj in session.deleted:
+        if isinstance(obj, Story): fragment_cache.discard('story-card', obj.id)
+    for model, ids in ((Comic, comics), (Story, stories)):
+        for row_id in ids:
+            row = session.get(model, row_id)
+            if row is not None and row not in session.new and row not in session.deleted and not session.is_modified(row, include_collections=False):
+                touch_row(row, now)
+
+# --- HTML CỦA TRUYỆN: parse + render 1 lần cho mỗi version, lưu lại cho mọi worker dùng chung ---
+def story_html_key(version):
+    return f"{version}.{storydoc.VERSION}"
+
+def story_html(story_id, version, content, content_html=None, content_html_key=None):
+    key = story_html_key(version)
+    if content_html is not None and content_html_key == key: return content_html
+    html = str(storydoc.render(full_story_text(story_id, content)))
+    # Bulk UPDATE: không đi qua before_flush nên không làm tăng version; có điều kiện version -> không ghi đè bản sửa mới hơn
+    Story.query.filter_by(id=story_id, version=version).update({"content_html": html, "content_html_key": key}, synchronize_session=False)
+    db.session.commit()
+    return html
+
+def worksheets_of(story_ids):
+    # {story_id: [worksheet 1, worksheet 2...]} cho cả lô trong 1 query
+    found = {}
+    for story_id, content in (db.session.query(Worksheet.story_id, Worksheet.content)
+                              .filter(Worksheet.story_id.in_(story_ids)).order_by(Worksheet.story_id, Worksheet.version)):
+        found.setdefault(story_id, []).append(content)
+    return found
+
+def full_story_text(story_id, content):
+    # Thân truyện + các worksheet, ghép đúng định dạng cũ -> storydoc/PDF hiển thị như trước
+    return storydoc.join_worksheets(content, worksheets_of([story_id]).get(story_id, []))
+
+def next_worksheet_version(story_id):
+    return (db.session.query(db.func.max(Worksheet.version)).filter_by(story_id=story_id).scalar() or 0) + 1
+
+def add_worksheet(story_id, kind, content):
+    # 2 job quiz cùng truyện có thể lấy trùng version -> unique constraint báo lỗi thì lấy số tiếp theo
+    for _ in range(5):
+        try:
+            with db.session.begin_nested():
+                sheet = Worksheet(story_id=story_id, kind=kind[:50], version=next_worksheet_version(story_id), content=content)
+                db.session.add(sheet)
+            return sheet
+        except IntegrityError:
+            continue
+    raise RuntimeError("Could not save the worksheet. Please try again.")
+
+def sync_worksheets(story, contents, kind='mix'):
+    # Sau khi sửa tay: giữ dòng cũ theo thứ tự, chỉ ghi những worksheet đổi nội dung
+    sheets = list(story.worksheets)
+    for sheet, content in zip(sheets, contents):
+        if sheet.content != content: sheet.content = content
+    for sheet in sheets[len(contents):]: db.session.delete(sheet)
+    last = sheets[-1].version if sheets else 0
+    for version, content in enumerate(contents[len(sheets):], last + 1):
+        db.session.add(Worksheet(story_id=story.id, kind=kind, version=version, content=content))
+
+def split_legacy_worksheets(batch_size=200):
+    # Migration 1 lần: truyện cũ có worksheet nối sau "## 🎓 PEDAGOGICAL WORKSHEET" -> tách ra bảng Worksheet
+    last_id, moved = 0, 0
+    while True:
+        rows = (db.session.query(Story.id, Story.user_id, Story.title, Story.content, Story.prompt_data)
+                .filter(Story.id > last_id, Story.content.contains(storydoc.WORKSHEET_MARK), ~Story.worksheets.any())
+                .order_by(Story.id).limit(batch_size).all())
+        if not rows: break
+        for row in rows:
+            body, sheets = storydoc.split_worksheets(row.content)
+            if not sheets: continue
+            db.session.execute(insert(Worksheet), [{"story_id": row.id, "kind": 'legacy', "version": i, "content": c, "created_at": datetime.utcnow()}
+                                                   for i, c in enumerate(sheets, 1)])
+            Story.query.filter_by(id=row.id).update({Story.content: body, Story.version: Story.version + 1, Story.updated_at: datetime.utcnow()},
+                                                    synchronize_session=False)
+            if search_index: index_story(db.session.connection(), row.id, row.user_id, row.title, body, row.prompt_data)
+            moved += 1
+        last_id = rows[-1].id
+        db.session.commit()
+    if moved: print(f"--> MIGRATION: moved worksheets out of {moved} stories")
+
+def render_stale_stories(batch_size=200):
+    # Dựng sẵn HTML cho các truyện chưa có (hoặc render theo version cũ), mỗi lô 1 commit
+    last_id, rendered = 0, 0
+    while True:
+        rows = (db.session.query(Story.id, Story.version, Story.content, Story.content_html_key)
+                .filter(Story.id > last_id).order_by(Story.id).limit(batch_size).all())
+        if not rows: return rendered
+        for row in rows:
+            if row.content_html_key == story_html_key(row.version): continue
+            story_html(row.id, row.version, row.content)
+            rendered += 1
+        last_id = rows[-1].id
+
+def backfill_story_metadata(batch_size=500):
+    # Migration: tách prompt_data của các truyện cũ ra cột riêng + bảng story_vocab, mỗi lô 1 commit
+    last_id = 0
+    while True:
+        rows = (db.session.query(Story.id, Story.prompt_data)
+                .filter(Story.id > last_id, Story.prompt_data.isnot(None), Story.cefr_level.is_(None),
+                        Story.theme.is_(None), Story.word_count.is_(None), ~Story.vocab.any())
+                .order_by(Story.id).limit(batch_size).all())
+        if not rows: break
+        updates, words = [], []
+        for story_id, prompt_data in rows:
+            meta = prompt_metadata(prompt_data)
+            updates.append({"id": story_id, "updated_at": datetime.utcnow(), **{k: meta[k] for k in ("cefr_level", "word_count", "theme", "target_audience")}})
+            words += [{"story_id": story_id, "word": w} for w in meta['vocab']]
+        db.session.execute(update(Story), updates)
+        if words: db.session.execute(insert(StoryVocab), words)
+        last_id = rows[-1].id
+        db.session.commit()
 
-def create_prompt_for_ai(inputs):
-    cefr_level = inputs['level'].upper()
-    vocab_list_str = ", ".join(inputs['vocab'])
-    
+def index_story(conn, story_id, user_id, title, content, prompt_data):
+    meta = prompt_metadata(prompt_data)
+    search_index.index_story(conn, story_id, user_id, title, content, meta['vocab'], meta['cefr_level'], meta['theme'])
+
+# --- TÌM KIẾM TOÀN VĂN: index cập nhật trong cùng transaction mỗi khi Story/Style được thêm/sửa/xóa ---
+search_index = search.for_dialect(make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name(),
+                                  pg_config=os.environ.get('SEARCH_TS_CONFIG', 'english'))
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+
+@event.listens_for(db.session, 'after_flush')
+def index_search_changes(session, flush_context):
+    if not search_index: return
+    conn = session.connection()
+    for obj in list(session.new) + list(session.dirty):
+        if obj not in session.new and not session.is_modified(obj): continue
+        if isinstance(obj, Story): index_story(conn, obj.id, obj.user_id, obj.title, obj.content, obj.prompt_data)
+        elif isinstance(obj, Style): search_index.index_style(conn, obj.id, obj.user_id, obj.name, obj.content)
+    for obj in session.deleted:
+        if isinstance(obj, Story): search_index.delete(conn, search.STORY, obj.id)
+        elif isinstance(obj, Style): search_index.delete(conn, search.STYLE, obj.id)
+
+def setup_search(batch_size=200, rebuild=False):
+    # Tạo bảng index; lần đầu (index rỗng) thì nạp toàn bộ truyện/style có sẵn theo từng lô
+    global search_index
+    if not search_index: return
     try:
-        word_count = int(inputs['count'])
-    except:
-        word_count = 250
-        
-    setting_val = inputs['setting'].strip()
-    setting_instr = f"**SETTING:** {setting_val}" if setting_val else "**SETTING:** A realistic setting in Vietnam. Atmosphere is key."
+        search_index.setup(db.session.connection())
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"--> SEARCH DISABLED: {e}")
+        search_index = None
+        return
+    conn = db.session.connection()
+    if rebuild: search_index.clear(conn)
+    elif search_index.count(conn) or not db.session.query(Story.id).first(): return
+    for model, columns in ((Story, (Story.id, Story.user_id, Story.title, Story.content, Story.prompt_data)),
+                           (Style, (Style.id, Style.user_id, Style.name, Style.content))):
+        last_id = 0
+        while True:
+            rows = db.session.query(*columns).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows: break
+            conn = db.session.connection()
+            for row in rows:
+                if model is Story: index_story(conn, *row)
+                else: search_index.index_style(conn, *row)
+            last_id = rows[-1].id
+            db.session.commit()
+    print("--> SEARCH INDEX BUILT")
 
-    # --- 1. CHỌN STYLE TỰ ĐỘNG THEO LEVEL ---
-    suggested_styles = LITERARY_STYLES.get(cefr_level, [])
-    style_selection_instr = ""
-    
-    if suggested_styles:
-        style_list_str = "\n".join([f"- {s}" for s in suggested_styles])
-        style_selection_instr = f"""
-    **LITERARY VOICE (CRITICAL):**
-    Choose ONE of the following styles that BEST fits the story idea below:
-    {style_list_str}
-    -> **Apply the chosen style consistently.**
-    """
-
-    # --- 2. LOGIC CẤU TRÚC (UPDATE: Thêm Narrative Flow) ---
-    target_audience = inputs.get('target_audience', 'General')
-
-    if target_audience == 'Children' and cefr_level in ["PRE A1", "A1", "A2"]:
-        structure_type = "PICTURE BOOK"
-        if word_count < 150: num_pages = "4-5"
-        elif word_count < 300: num_pages = "6-8"
-        else: num_pages = "8-10"
-            
-        structure_instr = f"""
-        **STRUCTURE: PICTURE BOOK FORMAT**
-        - Divide the story into **{num_pages} PAGES**.
-        - Label each part clearly as: `--- PAGE [X] ---`
-        - **IMPORTANT:** Write a meaningful paragraph (3-5 sentences) per page.
-        - **FLOW:** Ensure smooth transitions between pages. Use connecting words (Then, Next, Suddenly) so the story reads as one continuous narrative, not disjointed scenes.
-        """
-        opening_rule = "Start with a **# Title**. Then immediately start with `--- PAGE 1 ---`."
-        
-    elif word_count < 400:
-        structure_type = "SHORT STORY (Continuous)"
-        structure_instr = """
-        **STRUCTURE: CONTINUOUS STORY**
-        - Do NOT use Chapter headings.
-        - Start directly with the story content after the Title.
-        - Organize into clear paragraphs.
-        """
-        opening_rule = "Start with a **# Title**. Then immediately start the story text."
-    else:
-        structure_type = "CHAPTER BOOK"
-        structure_instr = """
-        **STRUCTURE: CHAPTERS**
-        - Divide into **3-5 CHAPTERS**. Label: `### CHAPTER [X]: [Title]`
-        - **IMPORTANT:** The story must start immediately with **CHAPTER 1**.
-        """
-        opening_rule = "Start with a **# Title**. Immediately follow with **CHAPTER 1**. Introduce the character INSIDE Chapter 1."
-
-    repetition_rule = "Weave target words into the story naturally (approx 3-5 times each)."
-
-    # --- 3. XỬ LÝ MAGIC DUST (Giữ nguyên) ---
-    support_instr = ""
-    raw_num = inputs.get('num_support')
-    if raw_num and str(raw_num).strip(): 
+# --- MEDIA STORAGE (refcount trong bảng StoredFile) ---
+def store_media(data, ext):
+    key, _ = media_store.put(data, ext)
+    updated = StoredFile.query.filter_by(key=key).update({"touched_at": datetime.utcnow()})
+    if not updated:
         try:
-            num = int(raw_num)
-            if num > 0:
-                support_instr = f"- **Supporting Characters:** Include exactly {num} supporting character(s). Ensure meaningful interaction."
-            else:
-                support_instr = "- **Supporting Characters:** No supporting characters. Focus on internal thoughts."
-        except:
-            support_instr = "- **Supporting Characters:** Automatically introduce 1-2 supporting characters. **MANDATORY:** Include natural dialogue."
-    else:
-        support_instr = "- **Supporting Characters:** Automatically introduce 1-2 supporting characters. **MANDATORY:** Include natural dialogue."
-
-    negative_instr = ""
-    if inputs.get('negative_keywords'):
-        negative_instr = f"- **NEGATIVE CONSTRAINTS:** Strictly AVOID: {inputs['negative_keywords']}."
-
-    user_style_instr = ""
-    if inputs.get('style_samples'):
-        style_sample_text = inputs['style_samples'][:500].replace("\n", " ")
-        user_style_instr = f"- **USER OVERRIDE STYLE:** MIMIC this specific tone: '{style_sample_text}...'"
+            with db.session.begin_nested(): db.session.add(StoredFile(key=key, size=len(data), refcount=0))
+        except IntegrityError:
+            pass  # request khác vừa thêm cùng file
+    return key
+
+def retain_media(keys, n=1):
+    for key in keys:
+        StoredFile.query.filter_by(key=key).update({StoredFile.refcount: StoredFile.refcount + n, "touched_at": datetime.utcnow()},
+                                                   synchronize_session=False)
+
+def release_media(keys, n=1):
+    for key in keys:
+        StoredFile.query.filter_by(key=key).update({StoredFile.refcount: StoredFile.refcount - n}, synchronize_session=False)
+
+def panel_media_keys(image_url, image_variants):
+    urls = [image_url]
+    if image_variants:
+        for entry in json.loads(image_variants).values():
+            urls += [v for k, v in entry.items() if k != 'width']
+    return [k for k in (media_store.key_from_url(u) for u in urls) if k]
+
+def read_media_url(url):
+    key = media_store.key_from_url(url)
+    if key: return media_store.read(key)
+    with open(os.path.join(UPLOAD_FOLDER, os.path.basename(url)), 'rb') as f: return f.read()  # ảnh cũ trong static/uploads
+
+def add_missing_columns():
+    # db.create_all() không thêm cột mới vào bảng đã tồn tại -> tự ALTER TABLE cho các cột còn thiếu
+    # (cột mới phải nullable hoặc có server_default)
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing: continue
+            ddl_type = column.type.compile(dialect=db.engine.dialect)
+            default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+            db.session.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {ddl_type}{default}'))
+            print(f"--> MIGRATION: added column {table.name}.{column.name}")
+        existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes: continue
+            index.create(bind=db.session.connection())
+            print(f"--> MIGRATION: added index {index.name}")
+    db.session.commit()
 
-    # --- 4. MASTER PROMPT ---
-    prompt = f"""
-    **Role:** Best-selling Author of Graded Readers.
-    **Goal:** Write a {structure_type} that is engaging, emotional, and educational.
-    
-    **CORE INPUTS:**
-    - Level: {cefr_level}
-    - Length: ~{word_count} words.
-    - Theme: {inputs['theme']}
-    - Main Character: {inputs.get('main_char', 'A relatable character')}
-    {support_instr}
-    
-    **MANDATORY GUIDELINES:**
-    
-    1. **OPENING & STRUCTURE:** - {opening_rule}
-       - {structure_instr}
-    
-    2. **VOCABULARY INTEGRATION:**
-       - **Target Words:** [{vocab_list_str}]
-       - {repetition_rule}
-       - Do NOT use backticks/bold for target words.
-    
-    3. {setting_instr}
-    
-    4. **GRAMMAR & TONE:**
-       - **Grammar Level:** {CEFR_LEVEL_GUIDELINES.get(cefr_level, "Standard grammar")}
-       - **CRITICAL:** Even at low levels (A1/A2), use **NATURAL English phrasing**. ALWAYS use proper articles (a, an, the) and pronouns. Do NOT write in "pidgin" or broken English (e.g., write "He stays in his bedroom", NOT "He stay in bedroom").
-       {style_selection_instr}
-       - **Tone:** Encouraging, Relatable, Human.
-    
-    5. **ADDITIONAL CONSTRAINTS:**
-       {negative_instr}
-       {user_style_instr}
-       - **LANGUAGE:** Write in standard English. Use English terms for family members (Mom, Dad, Grandma) unless strictly instructed otherwise.
-
-    **OUTPUT FORMAT:**
-    # [Creative Title]
-    [Story content...]
-    ---
-    Graded Definitions ({cefr_level})
-    *Format:*
-    - word: definition.
-    """
-    return prompt
-    
-def create_comic_script_prompt(story_content):
-    return f"""
-    **Role:** Cinematic Art Director.
-    **Task:** Convert the story below into a list of 12 visual descriptions for image generation.
-    **INPUT STORY:** {story_content}
-    
-    **VISUAL RULES:**
-    - **Style:** Disney/Pixar 3D style, vibrant colors, expressive lighting.
-    - **Consistency:** Use specific descriptions (e.g., "A 4-year-old Vietnamese boy named Nhan, wearing a blue t-shirt").
-    - **Content:** Create visuals that match the emotional tone of the story.
+def backfill_panels(batch_size=200):
+    # Migration 1 lần: tách panels_content (JSON) của các comic cũ thành các dòng Panel
+    last_id = 0
+    while True:
+        comics = (Comic.query.filter(Comic.id > last_id, ~Comic.panels.any())
+                  .order_by(Comic.id).limit(batch_size).all())
+        if not comics: break
+        for comic in comics:
+            try: panels_data = json.loads(comic.panels_content)
+            except ValueError: panels_data = []
+            if isinstance(panels_data, dict): panels_data = [panels_data]
+            for panel in panels_from_json(panels_data):
+                panel.comic_id = comic.id
+                db.session.add(panel)
+        last_id = comics[-1].id
+        db.session.commit()
 
-    **OUTPUT FORMAT (STRICT JSON ONLY):**
-    Return a valid JSON object. Do not add any introductory text or markdown formatting outside the JSON.
-    
-    {{
-      "panels": [ 
-        {{ 
-            "panel_number": 1, 
-            "visual_description": "Detailed description of the scene...", 
-            "caption": "Short text from the story" 
-        }}
-      ]
-    }}
-    """
-
-def create_translation_prompt(inputs):
-    cefr_level = inputs['level'].upper()
-    return f"""
-    **Role:** Expert Graded Translator & Poet (Folktale Specialist).
-    **Task:** Retell the Vietnamese folktale "{inputs['folktale_name']}" in English.
-    
-    **CRITICAL INSTRUCTIONS:**
-    1. **POETIC TRANSLATION:** Vietnamese folktales often have verses/rhymes. Identify them and translate them into **English Rhyming Couplets**.
-    2. **GRADING:** - Level: {cefr_level}. Length: ~{inputs['count']} words.
-    3. **OUTPUT:** Start with # English Title.
-    """
-
-def create_pedagogical_quiz_prompt(story_content, quiz_preference):
-    return f"""
-    **Role:** Quiz Generator Engine.
-    **MODE:** STRICT OUTPUT ONLY.
-    **Forbidden:** Do NOT include internal reasoning, notes about distractors, or conversational filler (e.g., "Here is the quiz", "Note: I chose...").
-    
-    **Task:** Create a 3-stage quiz for the story below.
-    
-    **INPUT STORY:**
-    {story_content}
-
-    **STRUCTURE:**
-
-    PART 1: CONTROLLED PRACTICE (Recall)
-    *Format:* Based on '{quiz_preference}' (mcq/tf/mix/open).
-    - Create 5 questions.
-
-    PART 2: LESS CONTROLLED PRACTICE (Vocabulary)
-    *Format:* **Gap Fill**.
-    - Create a short summary text with 5-6 blanks.
-    - **CRITICAL:** Use standard underscores for blanks like this: `_______ (1)`.
-    - **MANDATORY:** Provide the Word Bank on a SINGLE LINE exactly like this format (no tables):
-      `[[WORD BANK: word1, word2, word3, word4, word5, distractor1]]`
-
-    PART 3: FREE PRACTICE (Production)
-    1. **Discussion:** 1 Open-ended question connecting to real life.
-    2. **Creative Writing:** 1 Prompt (rewrite ending, dialogue, etc.).
-
-    **ANSWER KEY (At the bottom)**
-    - Provide ONLY the answers.
-    - Do NOT explain why an answer was chosen.
-    - Format strictly:
-      Part 1: 1. A, 2. B...
-      Part 2: 1. word...
-    """
+# --- 4. ADVANCED PROMPT ENGINEERING: xem prompts.py ---
 
 # --- 5. ROUTES ---
+# --- CONDITIONAL GET ---
+def cached_response(parts, last_modified, render):
+    # parts = version các dòng mà trang phụ thuộc. Khớp If-None-Match (hoặc If-Modified-Since) -> 304, không gọi render().
+    # Có flash đang chờ hiển thị thì luôn render, kẻo thông báo bị nuốt mất.
+    tag = httpcache.etag(BUILD_ID, current_user.get_id(), *parts)
+    if last_modified: last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    if request.if_none_match: fresh = tag in request.if_none_match
+    else: fresh = bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+    if fresh and '_flashes' not in session:
+        http_cache_events.inc(endpoint=request.endpoint, result='not_modified')
+        response = Response(status=304)
+    else:
+        http_cache_events.inc(endpoint=request.endpoint, result='rendered')
+        response = app.make_response(render())
+    response.set_etag(tag)
+    if last_modified: response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # trình duyệt luôn hỏi lại, server trả 304 nếu chưa đổi
+    return response
+
+# --- ADMISSION CONTROL ---
+def rejected_response(e):
+    admission_rejections.inc(endpoint=request.endpoint, reason='busy' if e.status == 503 else 'rate_limit')
+    retry_after = str(max(1, math.ceil(e.retry_after)))
+    if request.accept_mimetypes.best == 'text/html':
+        # Form submit thường (không qua fetch) -> báo lỗi bằng flash như các route khác
+        flash(str(e), 'warning')
+        return redirect(request.referrer or url_for('index'))
+    response = jsonify({"error": str(e), "story_result": f"ERROR: {e}", "retry_after": int(retry_after)})
+    response.status_code = e.status
+    response.headers['Retry-After'] = retry_after
+    return response
+
+def missing_key_response():
+    if request.accept_mimetypes.best == 'text/html':
+        flash('API Key Missing', 'danger')
+        return redirect(request.referrer or url_for('index'))
+    return jsonify({"error": "API Key Missing", "story_result": "API Key Missing"}), 500
+
+def rate_limited(cost=lambda: 1, queued=True, needs_ai=True):
+    # cost: số lượt AI của request (vd: batch 3 level = 3). queued: route có đẩy job vào hàng đợi
+    # needs_ai: thiếu API key thì trả lỗi ngay, không trừ lượt của user cho request chắc chắn hỏng
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if needs_ai and not configure_ai(): return missing_key_response()
+            try:
+                if queued and request.values.get('stream') != '1':
+                    pending = job_queue.pending_by_user()
+                    if pending.get(current_user.id, 0) >= MAX_PENDING_JOBS_PER_USER:
+                        raise admission.Rejected(f"You already have {MAX_PENDING_JOBS_PER_USER} generations running. Please wait for one to finish.", 10)
+                    if sum(pending.values()) >= MAX_QUEUED_JOBS:
+                        raise admission.Rejected("The server is busy right now. Please try again in a moment.", 30, status=503)
+                admission_control.take(current_user.id, cost())
+            except admission.Rejected as e:
+                return rejected_response(e)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def admitted_stream(pieces, async_pieces=None):
+    # Giữ 1 slot AI toàn cục trong suốt thời gian stream (có thể phải chờ trong hàng đợi)
+    ticket = admission_control.acquire(current_user.id, request.endpoint)
+    if async_pieces is not None and async_mode():
+        return deferred_response(async_sse(async_pieces), 'text/event-stream', lambda: admission_control.release(ticket),
+                                 {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    def run():
+        try: yield from pieces
+        finally: admission_control.release(ticket)
+    return stream_text_response(run())
+
+def llm_call_cost():
+    return 1 + len(quiz_variants(request.form.get('quiz_type')))
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -489,24 +999,39 @@ def logout(): logout_user(); return redirect(url_for('login'))
 @app.route('/')
 @login_required
 def index():
-    user_styles = Style.query.filter_by(user_id=current_user.id).all()
-    return render_template('index.html', all_styles=user_styles, previous_inputs={}, user=current_user)
+    # Style chỉ thêm/xóa (không sửa) -> số lượng + id lớn nhất đủ để biết danh sách có đổi không
+    styles_state = db.session.query(db.func.count(Style.id), db.func.max(Style.id)).filter(Style.user_id == current_user.id).one()
+    return cached_response(('index', tuple(styles_state)), None, lambda: render_template(
+        'index.html', all_styles=Style.query.filter_by(user_id=current_user.id).all(), previous_inputs={}, user=current_user))
 
 @app.route('/generate-story', methods=['POST'])
 @login_required
+@rate_limited(cost=llm_call_cost)
 def handle_generation():
     api_key = configure_ai()
     if not api_key: return jsonify({"story_result": "API Key Missing"}), 500
     data = request.form
     
-    selected_style_names = request.form.getlist('selected_styles')
+    payload = {"inputs": story_inputs_from_form(), "quiz_type": data.get('quiz_type'), "fresh": wants_fresh(),
+               "prompt_versions": prompts.assign(current_user.id)}
+    if data.get('stream') == '1':
+        try: return admitted_stream(story_pieces(api_key, payload), async_story_pieces(api_key, payload))
+        except admission.Rejected as e: return rejected_response(e)
+    job_id = job_queue.enqueue('story', payload, user_id=current_user.id)
+    return job_accepted(job_id)
+
+def story_inputs_from_form():
+    return story_inputs(request.form, request.form.getlist('selected_styles'), current_user.id)
+
+def story_inputs(data, selected_style_names, user_id):
+    # data: request.form hoặc dict cùng tên field (1 dòng của file bulk)
     style_content_str = ""
     if selected_style_names:
         # Sửa truy vấn: Lọc theo tên VÀ user_id
-        styles = Style.query.filter(Style.name.in_(selected_style_names), Style.user_id == current_user.id).all()
+        styles = Style.query.filter(Style.name.in_(selected_style_names), Style.user_id == user_id).all()
         style_content_str = "\n".join([s.content for s in styles])
 
-    inputs = {
+    return {
         "idea": data.get('idea'), 
         "vocab": data.get('vocab_str', '').split(','),
         "level": data.get('cefr_level'), 
@@ -519,112 +1044,601 @@ def handle_generation():
         "target_audience": data.get('target_audience'), 
         "num_support": data.get('num_support_char')
     }
+
+QUIZ_LABELS = {"mcq": "Multiple Choice", "tf": "True/False", "open": "Open Questions", "mix": "Mix"}
+
+def is_ai_error(text):
+    return not text or text.lstrip().startswith(llm_cache.ERROR_PREFIXES)
+
+def quiz_variants(quiz_type):
+    # "mcq" -> ["mcq"]; "mcq,tf,open" -> 3 biến thể chạy song song
+    if not quiz_type: return []
+    return [q.strip() for q in quiz_type.split(',') if q.strip() and q.strip() != 'none']
+
+def build_worksheet(api_key, story_content, variants, use_cache, version=None):
+    # Tầng 2 của pipeline: mỗi biến thể quiz là 1 task song song, gộp lại thành 1 khối worksheet
+    def make_task(variant):
+        def task():
+            text = generate_story_ai(api_key, prompts.create_pedagogical_quiz_prompt(story_content, variant, version), use_cache=use_cache)
+            if is_ai_error(text): raise RuntimeError(text)
+            return text
+        return task
+
+    results = quiz_stage.run([(v, make_task(v)) for v in variants], timeout=QUIZ_TIMEOUT)
+    return worksheet_text([(r.name, r.value if r.ok else f"(Quiz could not be generated: {r.error})") for r in results])
+
+def worksheet_text(sections):
+    # [(biến thể, nội dung)] -> 1 khối worksheet; nhiều biến thể thì mỗi phần có tiêu đề riêng
+    if len(sections) == 1: return sections[0][1]
+    return "\n\n".join(f"### 🧩 {QUIZ_LABELS.get(name, name)}\n\n{body}" for name, body in sections)
+
+async def async_build_worksheet(api_key, story_content, variants, use_cache, version=None):
+    async def task(variant):
+        text = await async_generate_story_ai(api_key, prompts.create_pedagogical_quiz_prompt(story_content, variant, version), use_cache=use_cache)
+        if is_ai_error(text): raise RuntimeError(text)
+        return text
+    results = await asyncio.gather(*[asyncio.wait_for(task(v), QUIZ_TIMEOUT) for v in variants], return_exceptions=True)
+    return worksheet_text([(v, f"(Quiz could not be generated: {str(r) or type(r).__name__})" if isinstance(r, BaseException) else r)
+                           for v, r in zip(variants, results)])
+
+def story_pieces(api_key, payload):
+    # Tầng 1 stream truyện; khi truyện xong thì chuyển ngay sang tầng quiz
+    use_cache = not payload.get('fresh')
+    versions = payload.get('prompt_versions') or {}
+    story_parts = []
+    for piece in stream_story_ai(api_key, prompts.create_prompt_for_ai(payload['inputs'], versions.get(prompts.STORY)), use_cache=use_cache):
+        story_parts.append(piece); yield piece
+    story_content = "".join(story_parts)
     
-    prompt = create_prompt_for_ai(inputs)
-    story_content = generate_story_ai(api_key, prompt)
-    
-    if "ERROR" in story_content:
-        return jsonify({"story_result": story_content})
+    if "ERROR" in story_content: return
+
+    variants = quiz_variants(payload.get('quiz_type'))
+    if len(variants) == 1:
+        # 1 biến thể thì stream luôn, giữ định dạng cũ
+        quiz_prompt = prompts.create_pedagogical_quiz_prompt(story_content, variants[0], versions.get(prompts.QUIZ))
+        yield storydoc.WORKSHEET_HEADER
+        yield from stream_story_ai(api_key, quiz_prompt, use_cache=use_cache)
+    elif variants:
+        yield storydoc.WORKSHEET_HEADER
+        yield build_worksheet(api_key, story_content, variants, use_cache, versions.get(prompts.QUIZ))
+
+async def async_story_pieces(api_key, payload):
+    # Như story_pieces nhưng chạy trên event loop (chế độ ASGI)
+    use_cache = not payload.get('fresh')
+    versions = payload.get('prompt_versions') or {}
+    story_parts = []
+    async for piece in async_stream_story_ai(api_key, prompts.create_prompt_for_ai(payload['inputs'], versions.get(prompts.STORY)), use_cache=use_cache):
+        story_parts.append(piece); yield piece
+    story_content = "".join(story_parts)
+
+    if "ERROR" in story_content: return
+
+    variants = quiz_variants(payload.get('quiz_type'))
+    if len(variants) == 1:
+        quiz_prompt = prompts.create_pedagogical_quiz_prompt(story_content, variants[0], versions.get(prompts.QUIZ))
+        yield storydoc.WORKSHEET_HEADER
+        async for piece in async_stream_story_ai(api_key, quiz_prompt, use_cache=use_cache): yield piece
+    elif variants:
+        yield storydoc.WORKSHEET_HEADER
+        yield await async_build_worksheet(api_key, story_content, variants, use_cache, versions.get(prompts.QUIZ))
+
+@job_queue.handler('story')
+def run_story_job(job):
+    # Ghi phần đã viết vào job.progress (tối đa ~2 lần/giây) để trang index hiện chữ dần dần
+    parts = []
+    last_flush = 0
+    for piece in story_pieces(configure_ai(), job['payload']):
+        parts.append(piece)
+        if time.monotonic() - last_flush > 0.5:
+            job_queue.set_progress(job['id'], "".join(parts))
+            last_flush = time.monotonic()
+    text = "".join(parts)
+    return {"story_result": text, "story_html": str(storydoc.render(text))}
+
+@app.route('/generate-story-batch', methods=['POST'])
+@login_required
+@rate_limited(cost=lambda: len(request.form.getlist('batch_levels')) * llm_call_cost())
+def handle_batch_generation():
+    # Cùng 1 đề bài, sinh N truyện ở N level CEFR song song
+    if not configure_ai(): return jsonify({"error": "API Key Missing"}), 500
+    levels = [l for l in request.form.getlist('batch_levels') if l.upper() in prompts.CEFR_LEVEL_GUIDELINES]
+    if not levels: return jsonify({"error": "Choose at least one CEFR level."}), 400
+    job_id = job_queue.enqueue('story_batch', {
+        "inputs": story_inputs_from_form(), "levels": levels,
+        "quiz_type": request.form.get('quiz_type'), "fresh": wants_fresh(),
+        "prompt_versions": prompts.assign(current_user.id)
+    }, user_id=current_user.id)
+    return job_accepted(job_id)
+
+@job_queue.handler('story_batch')
+def run_story_batch_job(job):
+    payload = job['payload']
+    api_key = configure_ai()
 
-    quiz_type = data.get('quiz_type')
-    if quiz_type and quiz_type != 'none':
-        quiz_prompt = create_pedagogical_quiz_prompt(story_content, quiz_type)
-        quiz_content = generate_story_ai(api_key, quiz_prompt)
-        story_content += f"\n\n\n{'='*20}\n## 🎓 PEDAGOGICAL WORKSHEET\n{'='*20}\n\n{quiz_content}"
+    def make_task(level):
+        level_payload = dict(payload, inputs=dict(payload['inputs'], level=level))
+        def task():
+            text = "".join(story_pieces(api_key, level_payload))
+            if is_ai_error(text): raise RuntimeError(text)
+            return text
+        return task
+
+    finished = []
+    def on_done(result):
+        finished.append(result.name)
+        job_queue.set_progress(job['id'], f"{len(finished)}/{len(payload['levels'])} levels done")
+
+    results = batch_stage.run([(lvl, make_task(lvl)) for lvl in payload['levels']], timeout=BATCH_TIMEOUT, on_done=on_done)
+    return {"results": [dict(r.as_dict(), html=str(storydoc.render(r.value)) if r.ok else "") for r in results],
+            "failed": [r.name for r in results if not r.ok]}
+
+# --- BULK TỪ CSV/XLSX (bulk.py): mỗi dòng 1 truyện, chạy song song có giới hạn, lưu theo lô, chạy tiếp được khi bị ngắt ---
+def bulk_counts(run_ids):
+    # {run_id: {status: số dòng}} cho cả trang trong 1 query
+    counts = {run_id: {BULK_PENDING: 0, BULK_DONE: 0, BULK_FAILED: 0} for run_id in run_ids}
+    rows = (db.session.query(BulkRow.run_id, BulkRow.status, db.func.count(BulkRow.id))
+            .filter(BulkRow.run_id.in_(run_ids)).group_by(BulkRow.run_id, BulkRow.status))
+    for run_id, status, n in rows: counts[run_id][status] = n
+    return counts
+
+def bulk_job(run):
+    # Job đang chờ/chạy của lượt bulk, hoặc None (đã xong / lỗi / bị dọn khỏi hàng đợi / mồ côi vì process chạy nó đã chết)
+    job = job_queue.get(run.job_id) if run.job_id else None
+    return job if job and job['status'] not in jobs.FINISHED and not job_queue.is_orphaned(job) else None
+
+def own_bulk_run(run_id):
+    run = BulkRun.query.get_or_404(run_id)
+    if run.user_id != current_user.id: abort(404)
+    return run
+
+@app.route('/bulk')
+@login_required
+def bulk_page():
+    runs = BulkRun.query.filter_by(user_id=current_user.id).order_by(BulkRun.created_at.desc()).limit(20).all()
+    return render_template('bulk.html', runs=runs, counts=bulk_counts([r.id for r in runs]), active={r.id for r in runs if bulk_job(r)},
+                           limits={"rows": BULK_MAX_ROWS, "mb": BULK_MAX_BYTES // (1024 * 1024)}, user=current_user)
 
-    return jsonify({"story_result": story_content})
+@app.route('/bulk/upload', methods=['POST'])
+@login_required
+@rate_limited(cost=lambda: 0)  # lượt AI trừ theo từng dòng trong run_bulk_job
+def start_bulk_run():
+    if not configure_ai():
+        flash('API Key Missing', 'danger'); return redirect(url_for('bulk_page'))
+    file = request.files.get('bulk_file')
+    try:
+        if not file or not file.filename: raise bulk.BulkError("Choose a CSV or XLSX file.")
+        data = ingest.read_upload(file, BULK_MAX_BYTES)
+        rows = bulk.parse(data, file.filename, BULK_MAX_ROWS, prompts.CEFR_LEVEL_GUIDELINES, QUIZ_LABELS)
+    except (bulk.BulkError, ingest.IngestError) as e:
+        flash(str(e), 'warning'); return redirect(url_for('bulk_page'))
+
+    run = BulkRun(user_id=current_user.id, filename=file.filename[:200], fresh=wants_fresh(),
+                  prompt_versions=json.dumps(prompts.assign(current_user.id)))
+    db.session.add(run)
+    db.session.flush()
+    # Cả file vào DB trong 1 câu INSERT (executemany); dòng không có cột quiz thì dùng loại quiz chọn trên form
+    default_quiz = request.form.get('quiz_type') or 'none'
+    db.session.execute(insert(BulkRow), [{"run_id": run.id, "row_number": number, "status": BULK_PENDING,
+                                          "form": json.dumps(dict(form, quiz_type=form['quiz_type'] or default_quiz))} for number, form in rows])
+    db.session.commit()
+    run.job_id = job_queue.enqueue('bulk_run', {"run_id": run.id}, user_id=current_user.id)
+    db.session.commit()
+    return redirect(url_for('bulk_run_page', run_id=run.id))
+
+@app.route('/bulk/<int:run_id>')
+@login_required
+def bulk_run_page(run_id):
+    run = own_bulk_run(run_id)
+    job = bulk_job(run)
+    titles = dict(db.session.query(Story.id, Story.title).filter(Story.id.in_([r.story_id for r in run.rows if r.story_id])))
+    rows = [dict(json.loads(r.form), number=r.row_number, status=r.status, error=r.error,
+                 story_id=r.story_id if r.story_id in titles else None, title=titles.get(r.story_id)) for r in run.rows]
+    return render_template('bulk_run.html', run=run, rows=rows, counts=bulk_counts([run.id])[run.id], user=current_user,
+                           job={"status_url": url_for('job_status', job_id=job['id']), "events_url": url_for('job_events', job_id=job['id'])} if job else None)
+
+@app.route('/bulk/<int:run_id>/resume', methods=['POST'])
+@login_required
+@rate_limited(cost=lambda: 0)  # như start_bulk_run: chỉ các dòng còn pending bị trừ lượt
+def resume_bulk_run(run_id):
+    # Chạy tiếp: dòng 'done' giữ nguyên, dòng lỗi được thử lại, dòng còn 'pending' (job trước bị ngắt) chạy nốt
+    run = own_bulk_run(run_id)
+    if bulk_job(run):
+        flash('This batch is still running.', 'info'); return redirect(url_for('bulk_run_page', run_id=run.id))
+    # Job cũ bị mồ côi thì bỏ hẳn, để housekeeping không đưa nó chạy song song với job mới (flush() đã chặn lưu trùng)
+    if run.job_id: job_queue.abandon(run.job_id)
+    BulkRow.query.filter_by(run_id=run.id, status=BULK_FAILED).update({"status": BULK_PENDING, "error": None})
+    db.session.commit()
+    run.job_id = job_queue.enqueue('bulk_run', {"run_id": run.id}, user_id=current_user.id)
+    db.session.commit()
+    return redirect(url_for('bulk_run_page', run_id=run.id))
+
+@job_queue.handler('bulk_run')
+def run_bulk_job(job):
+    run = BulkRun.query.get(job['payload']['run_id'])
+    if not run: raise ValueError("Bulk run not found.")
+    api_key = configure_ai()
+    if not api_key: raise ValueError("API Key Missing")
+    run_id, user_id, fresh = run.id, run.user_id, run.fresh
+    versions = json.loads(run.prompt_versions or '{}')
+    # Checkpoint: chỉ lấy các dòng chưa xong -> job bị ngắt (process chết, deploy) chạy lại không sinh lại truyện đã lưu
+    pending = [(r.id, r.row_number, json.loads(r.form)) for r in BulkRow.query.filter_by(run_id=run_id, status=BULK_PENDING).order_by(BulkRow.row_number)]
+    counts = bulk_counts([run_id])[run_id]
+    db.session.commit()
+
+    # Tiến độ (JSON trong job.progress): đếm + trạng thái các dòng xong trong job này, trang /bulk/<id> cập nhật từng dòng
+    state = {"run_id": run_id, "total": sum(counts.values()), "done": counts[BULK_DONE], "failed": counts[BULK_FAILED], "rows": {}}
+    job_queue.set_progress(job['id'], json.dumps(state))
+    rows = {row_id: (number, form) for row_id, number, form in pending}
+
+    def make_task(form):
+        # Style đọc ở thread của job (cần app context), task trên bulk_stage chỉ gọi AI
+        row_payload = {"inputs": story_inputs(form, form.get('selected_styles') or [], user_id), "quiz_type": form.get('quiz_type'),
+                       "fresh": fresh, "prompt_versions": versions}
+        def task():
+            text = "".join(story_pieces(api_key, row_payload))
+            if is_ai_error(text): raise RuntimeError(text)
+            return text
+        return task
+
+    finished = []
+    def flush():
+        # 1 transaction cho cả lô: đánh dấu dòng (có điều kiện 'pending' -> job trùng không lưu 2 lần) + INSERT các truyện
+        claimed = [r for r in finished if BulkRow.query.filter_by(id=r.name, status=BULK_PENDING)
+                   .update({"status": BULK_DONE if r.ok else BULK_FAILED, "error": None if r.ok else (r.error or "")[:1000]})]
+        stories = {}
+        for r in claimed:
+            if not r.ok: continue
+            form = rows[r.name][1]
+            body, sheets = storydoc.split_worksheets(r.value)
+            kind = str(form.get('quiz_type') or 'mix')[:50]
+            stories[r.name] = Story(title=story_title(r.value), content=body, user_id=user_id, prompt_data=json.dumps(form),
+                                    worksheets=[Worksheet(kind=kind, version=i, content=c) for i, c in enumerate(sheets, 1)])
+        db.session.add_all(stories.values())
+        db.session.flush()
+        if stories: db.session.execute(update(BulkRow), [{"id": row_id, "story_id": s.id} for row_id, s in stories.items()])
+        db.session.commit()
+
+        for r in claimed:
+            entry = {"status": BULK_DONE, "story_id": stories[r.name].id, "title": stories[r.name].title} if r.ok else {"status": BULK_FAILED, "error": r.error}
+            state["rows"][str(rows[r.name][0])] = entry
+            state["done" if r.ok else "failed"] += 1
+            bulk_rows.inc(result=entry['status'])
+        finished.clear()
+        job_queue.set_progress(job['id'], json.dumps(state))
+
+    def on_done(result):
+        finished.append(result)
+        if len(finished) >= BULK_FLUSH_ROWS: flush()
+
+    # Từng phần tối đa BULK_CHUNK_ROWS dòng, không timeout tổng (mỗi lời gọi AI đã có timeout riêng).
+    # Mỗi dòng trừ lượt của user như 1 lần sinh ở form (1 + số biến thể quiz): bucket hết thì chạy phần đã trừ được,
+    # bucket rỗng hẳn thì chờ hồi lượt -> 1 file bulk đi đúng tốc độ giới hạn của user, không lách được token bucket
+    queue = list(pending)
+    while queue:
+        chunk = []
+        while queue and len(chunk) < BULK_CHUNK_ROWS:
+            try:
+                admission_control.take(user_id, 1 + len(quiz_variants(queue[0][2].get('quiz_type'))))
+            except admission.Rejected as e:
+                if chunk: break
+                time.sleep(e.retry_after); continue
+            chunk.append(queue.pop(0))
+        bulk_stage.run([(row_id, make_task(form)) for row_id, _, form in chunk], on_done=on_done)
+        flush()
+    return {"run_id": run_id, "total": state["total"], "done": state["done"], "failed": state["failed"]}
 
 @app.route('/create-comic/<int:story_id>', methods=['POST'])
 @login_required
+@rate_limited()
 def create_comic_direct(story_id):
     story = Story.query.get_or_404(story_id)
+    job_id = job_queue.enqueue('comic', {"story_id": story.id, "fresh": wants_fresh(), "prompt_versions": prompts.assign(current_user.id)},
+                               user_id=current_user.id)
+    return job_accepted(job_id)
+
+@job_queue.handler('comic')
+def run_comic_job(job):
+    story = Story.query.get(job['payload']['story_id'])
+    if not story: raise ValueError("Story not found.")
     api_key = configure_ai()
     
+    char_desc = "A relatable character"
     try:
-        clean_story_content = story.content
-        separator = "## 🎓 PEDAGOGICAL WORKSHEET"
-        if separator in clean_story_content:
-            clean_story_content = clean_story_content.split(separator)[0]
-
-        char_desc = "A relatable character"
-        try:
-            if story.prompt_data:
-                saved_inputs = json.loads(story.prompt_data)
-                raw_char = saved_inputs.get('main_char', '')
-                if raw_char:
-                    char_desc = f"{raw_char}, distinct facial features, wearing a signature outfit, consistent character"
-        except: pass
-            
-        consistency_prompt = f"IDENTITY: {char_desc}. (Keep facial features, hair style, and clothing EXACTLY the same in every shot)."
-
-        ai_response_text = generate_story_ai(api_key, create_comic_script_prompt(clean_story_content))
-        data = robust_json_extract(ai_response_text)
+        if story.prompt_data:
+            saved_inputs = json.loads(story.prompt_data)
+            raw_char = saved_inputs.get('main_char', '')
+            if raw_char:
+                char_desc = f"{raw_char}, distinct facial features, wearing a signature outfit, consistent character"
+    except: pass
         
-        if not data: return jsonify({"error": "AI Error. Please try again."}), 500
-
-        panels_data = data.get('panels', data.get('scenes', data))
-        if not isinstance(panels_data, list):
-             if isinstance(panels_data, dict): panels_data = [panels_data]
-             else: return jsonify({"error": "JSON Error."}), 500
-
-        final_panels = []
+    consistency_prompt = f"IDENTITY: {char_desc}. (Keep facial features, hair style, and clothing EXACTLY the same in every shot)."
+
+    # Kịch bản được stream về và đọc dần: mỗi panel vừa đóng ngoặc là dựng prompt ảnh luôn, không chờ model viết xong
+    prompt = prompts.create_comic_script_prompt(story.content, (job['payload'].get('prompt_versions') or {}).get(prompts.COMIC))
+    scanner = jsonscan.JSONScanner()
+    final_panels = []
+    for piece in stream_story_ai(api_key, prompt, use_cache=not job['payload'].get('fresh')):
+        if piece.startswith(llm_cache.ERROR_PREFIXES): raise ValueError("AI Error. Please try again.")
+        for panel in scanner.feed(piece):
+            final_panels.append(comic_panel_entry(panel, consistency_prompt, len(final_panels)))
+            job_queue.set_progress(job['id'], f"{len(final_panels)} panels written")
+
+    if not final_panels:
+        # Không có mảng panels/scenes (vd model trả 1 object panel) -> đọc cả output như trước
+        data = scanner.result()
+        if not data: raise ValueError("AI Error. Please try again.")
+        panels_data = data.get('panels', data.get('scenes', data)) if isinstance(data, dict) else data
+        if isinstance(panels_data, dict): panels_data = [panels_data]
+        if not isinstance(panels_data, list): raise ValueError("JSON Error.")
+        final_panels = [comic_panel_entry(p, consistency_prompt, i) for i, p in enumerate(p for p in panels_data if isinstance(p, dict))]
+
+    new_comic = Comic(story_id=story.id, panels_content=json.dumps(final_panels))
+    new_comic.panels = panels_from_json(final_panels)
+    db.session.add(new_comic)
+    db.session.commit()
+    return {"success": True, "comic_id": new_comic.id}
 
-        for panel in panels_data:
-            raw_action = panel.get('visual_description') or panel.get('description') or "Scene"
-            for w in ["comic", "panel", "page", "grid", "speech bubble", "text"]: 
-                raw_action = raw_action.replace(w, "image")
-            
-            final_prompt = (
-                f"**[1] CHARACTER:** {consistency_prompt} "
-                f"**[2] SCENE ACTION:** {raw_action}. "
-                f"**[3] STYLE:** 3D Disney Pixar Animation style, 8k render, soft lighting. "
-                f"--ar 3:2 --no text speech bubbles comic grid"
-            )
-            
-            final_panels.append({
-                "panel_number": panel.get('panel_number', len(final_panels) + 1),
-                "image_url": "", 
-                "prompt": final_prompt,
-                "caption": panel.get('caption', '')
-            })
-            
-        new_comic = Comic(story_id=story_id, panels_content=json.dumps(final_panels))
-        db.session.add(new_comic)
-        db.session.commit()
-        return jsonify({"success": True, "redirect_url": url_for('view_comic', comic_id=new_comic.id)})
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+def comic_panel_entry(panel, consistency_prompt, index):
+    raw_action = panel.get('visual_description') or panel.get('description') or "Scene"
+    for w in ["comic", "panel", "page", "grid", "speech bubble", "text"]: 
+        raw_action = raw_action.replace(w, "image")
+    
+    final_prompt = (
+        f"**[1] CHARACTER:** {consistency_prompt} "
+        f"**[2] SCENE ACTION:** {raw_action}. "
+        f"**[3] STYLE:** 3D Disney Pixar Animation style, 8k render, soft lighting. "
+        f"--ar 3:2 --no text speech bubbles comic grid"
+    )
+    return {
+        "panel_number": panel.get('panel_number', index + 1),
+        "image_url": "", 
+        "prompt": final_prompt,
+        "caption": panel.get('caption', '')
+    }
 
 @app.route('/view-comic/<int:comic_id>')
 @login_required
 def view_comic(comic_id):
     comic = Comic.query.get_or_404(comic_id)
-    return render_template('view_comic.html', panels=json.loads(comic.panels_content), title=comic.story.title, comic_id=comic.id, user=current_user)
+    story = comic.story
+    image_backend = os.environ.get('IMAGE_BACKEND', '')
+    return cached_response(('comic', comic.id, comic.version, story.version, image_backend),
+                           max(filter(None, (comic.updated_at, story.updated_at)), default=None),
+                           lambda: render_template('view_comic.html', panels=comic.panels, title=story.title, comic_id=comic.id,
+                                                   comic_version=comic.version, image_backend=image_backend, user=current_user))
 
 @app.route('/get-batch-prompt/<int:comic_id>')
 @login_required
 def get_batch_prompt(comic_id):
-    comic = Comic.query.get_or_404(comic_id)
-    panels = json.loads(comic.panels_content)
-    scenes = [p['prompt'] for p in panels]
-    return jsonify({"batch_prompt": " ".join(scenes)})
+    comic = db.session.query(Comic.id, Comic.version, Comic.updated_at).filter_by(id=comic_id).first()
+    if not comic: abort(404)
+    def render():
+        scenes = [p for (p,) in db.session.query(Panel.prompt).filter_by(comic_id=comic.id).order_by(Panel.position)]
+        return jsonify({"batch_prompt": " ".join(scenes)})
+    return cached_response(('batch-prompt', comic.id, comic.version), comic.updated_at, render)
 
 @app.route('/upload-panel-image', methods=['POST'])
 @login_required
 def upload_panel_image():
     if 'file' not in request.files: return jsonify({"error": "No file"}), 400
-    file = request.files['file']
+    data = request.files['file'].read(image_pipeline.MAX_UPLOAD_BYTES + 1)
+    try:
+        ext = image_pipeline.validate(data)
+    except image_pipeline.InvalidImage as e:
+        return jsonify({"error": str(e)}), 400
     comic = Comic.query.get(request.form.get('comic_id'))
-    fname = f"comic_{comic.id}_p{request.form.get('panel_number')}_{uuid.uuid4().hex[:6]}.png"
-    file.save(os.path.join(UPLOAD_FOLDER, fname))
+    if not comic: return jsonify({"error": "Comic not found"}), 404
+    if comic.story.user_id != current_user.id: abort(404)
+    panel_number = request.form.get('panel_number', type=int)
+    panel = Panel.query.filter_by(comic_id=comic.id, panel_number=panel_number).first()
+    if not panel: return jsonify({"error": "Panel not found"}), 404
+
+    url = replace_panel_image(comic.id, panel.id, panel_number, panel.image_url, panel.image_variants, data, ext, current_user.id)
+    if not url: return jsonify({"error": "This panel was just changed by another upload. Please try again."}), 409
+    return jsonify({"url": url})
+
+def replace_panel_image(comic_id, panel_id, panel_number, old_url, old_variants, data, ext, user_id):
+    # Dùng chung cho upload tay và ảnh do imagegen sinh. Trả về URL mới, hoặc None nếu panel vừa bị ảnh khác ghi đè
+    key = store_media(data, ext)
+    url = media_store.url(key)
     
-    panels = json.loads(comic.panels_content)
-    for p in panels:
-        if str(p['panel_number']) == str(request.form.get('panel_number')): p['image_url'] = f"/static/uploads/{fname}"
-    comic.panels_content = json.dumps(panels)
+    # Chỉ cập nhật đúng 1 dòng Panel, có điều kiện theo ảnh cũ -> 2 lượt upload cùng lúc không ghi đè lẫn nhau
+    updated = Panel.query.filter_by(id=panel_id, image_url=old_url).update({"image_url": url, "image_variants": None, "image_error": None})
+    if not updated:
+        db.session.rollback()
+        return None
+    touch_comic(comic_id)
+    retain_media([key])
+    release_media(panel_media_keys(old_url, old_variants))
     db.session.commit()
-    return jsonify({"url": f"/static/uploads/{fname}"})
+    # Resize/nén chạy ở worker nền, không giữ request
+    if image_pipeline.enabled():
+        job_queue.enqueue('panel_images', {"comic_id": comic_id, "panel_number": panel_number, "url": url}, user_id=user_id)
+    return url
+
+# --- SINH ẢNH CHO CẢ COMIC (imagegen.py): mọi panel chạy song song, kết quả ghi thẳng vào Panel ---
+@app.route('/comic/<int:comic_id>/render-images', methods=['POST'])
+@login_required
+@rate_limited(needs_ai=False)  # dùng image backend, không cần API key của LLM
+def render_comic_images(comic_id):
+    comic = Comic.query.get_or_404(comic_id)
+    if comic.story.user_id != current_user.id: abort(404)
+    if not imagegen.get_backend(): return jsonify({"error": "Image generation is not configured."}), 404
+    numbers = None
+    if request.form.get('retry') == '1':
+        numbers = [n for (n,) in db.session.query(Panel.panel_number).filter(Panel.comic_id == comic.id, Panel.image_error.isnot(None))]
+        if not numbers: return jsonify({"error": "No failed panels to retry."}), 400
+    job_id = job_queue.enqueue('panel_render', {"comic_id": comic.id, "panel_numbers": numbers, "overwrite": request.form.get('overwrite') == '1'},
+                               user_id=current_user.id)
+    return job_accepted(job_id)
+
+@job_queue.handler('panel_render')
+def run_panel_render_job(job):
+    # Mặc định chỉ render panel chưa có ảnh; panel_numbers = chỉ các panel đó (retry); overwrite = vẽ lại tất cả
+    payload = job['payload']
+    backend = imagegen.get_backend()
+    if not backend: raise ValueError("Image generation is not configured.")
+    query = Panel.query.filter(Panel.comic_id == payload['comic_id'], Panel.panel_number != 999)  # 999 = dữ liệu bìa sau
+    if payload.get('panel_numbers') is not None: query = query.filter(Panel.panel_number.in_(payload['panel_numbers']))
+    elif not payload.get('overwrite'): query = query.filter(Panel.image_url == '')
+    panels = {p.id: (p.panel_number, p.prompt, p.image_url, p.image_variants) for p in query.order_by(Panel.position)}
+    db.session.commit()
+
+    # Tiến độ từng panel (JSON trong job.progress): {"total": 12, "panels": {"3": {"status": "done", "url": ...}}}
+    state = {"total": len(panels), "backend": backend.name, "panels": {}}
+    job_queue.set_progress(job['id'], json.dumps(state))
+
+    def on_done(result):
+        # Gọi trên thread của job khi từng panel xong -> ghi DB ngay, không chờ cả comic
+        number, _, old_url, old_variants = panels[result.name]
+        entry = {"status": "failed", "error": result.error}
+        if result.ok:
+            try:
+                url = replace_panel_image(payload['comic_id'], result.name, number, old_url, old_variants,
+                                          result.value, image_pipeline.validate(result.value), None)  # job resize không tính vào giới hạn của user
+                entry = {"status": "done", "url": url} if url else {"status": "skipped", "error": "Panel was changed by an upload."}
+            except image_pipeline.InvalidImage as e:
+                entry = {"status": "failed", "error": f"Backend returned an invalid image: {e}"}
+        if entry['status'] == 'failed':
+            Panel.query.filter_by(id=result.name).update({"image_error": entry['error'][:1000]})
+            db.session.commit()
+        panel_image_renders.inc(backend=backend.name, result=entry['status'])
+        state["panels"][str(number)] = entry
+        job_queue.set_progress(job['id'], json.dumps(state))
+
+    results = imagegen.render_all(image_stage, backend, [(panel_id, number, prompt) for panel_id, (number, prompt, _, _) in panels.items()],
+                                  attempts=IMAGE_ATTEMPTS, timeout=IMAGE_TIMEOUT, on_done=on_done)
+    for result in results:
+        if str(panels[result.name][0]) not in state["panels"]: on_done(result)  # quá giờ: FanOut không gọi on_done
+    failed = [int(n) for n, entry in state["panels"].items() if entry['status'] == 'failed']
+    return {"comic_id": payload['comic_id'], "rendered": sum(1 for e in state["panels"].values() if e['status'] == 'done'), "failed": failed}
+
+@job_queue.handler('panel_images')
+def run_panel_images_job(job):
+    payload = job['payload']
+    (fallback_data, fallback_ext), variants_data = image_pipeline.process(read_media_url(payload['url']))
+    fallback_key = store_media(fallback_data, fallback_ext)
+    new_keys = [fallback_key]
+    variants = {}
+    for name, width, fmt, blob in variants_data:
+        key = store_media(blob, fmt)
+        new_keys.append(key)
+        variants.setdefault(name, {"width": width})[fmt] = media_store.url(key)
+
+    # Chỉ ghi nếu panel vẫn đang dùng ảnh này (chưa bị upload ảnh khác đè lên)
+    updated = Panel.query.filter_by(comic_id=payload['comic_id'], panel_number=payload['panel_number'], image_url=payload['url']) \
+        .update({"image_url": media_store.url(fallback_key), "image_variants": json.dumps(variants)})
+    if updated:
+        touch_comic(payload['comic_id'])
+        # Bản gốc còn metadata (EXIF/GPS) -> bỏ tham chiếu, storage-gc sẽ dọn
+        retain_media(new_keys, n=updated)
+        release_media(panel_media_keys(payload['url'], None), n=updated)
+    db.session.commit()
+    return {"url": media_store.url(fallback_key), "variants": variants, "applied": bool(updated)}
+
+@app.route('/media/<path:key>')
+def media_file(key):
+    # Tên file = hash nội dung -> nội dung không bao giờ đổi -> cho trình duyệt/CDN cache 1 năm
+    if isinstance(media_store, storage.LocalStorage):
+        response = send_from_directory(media_store.root, key, max_age=31536000)
+    else:
+        try: data = media_store.read(key)
+        except Exception: abort(404)
+        response = Response(data, mimetype=storage.content_type_for(key))
+        response.cache_control.max_age = 31536000
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# --- XUẤT PDF PHÍA SERVER (render trong job nền, cache theo hash nội dung, tải về có ETag) ---
+EXPORT_KINDS = ('story', 'comic')
+
+def media_ref(url):
+    # Ảnh trong media_store: key đã là hash nội dung. Ảnh cũ trong static/uploads: tên + mtime + cỡ file
+    # (chỉ stat, không đọc/hash cả file mỗi lần tải PDF). File cũ đã mất -> ref rỗng, PDF render không có ảnh đó
+    if not url: return ""
+    key = media_store.key_from_url(url)
+    if key: return key
+    try: st = os.stat(os.path.join(UPLOAD_FOLDER, os.path.basename(url)))
+    except OSError: return ""
+    return f"{os.path.basename(url)}:{st.st_mtime_ns}:{st.st_size}"
+
+def export_source(kind, ref_id):
+    # -> {"user_id", "title", "key"} hoặc None. Key đổi khi chữ hoặc ảnh đổi -> file cũ không bao giờ bị trả nhầm
+    if kind == 'story':
+        story = Story.query.get(ref_id)
+        if not story: return None
+        return {"user_id": story.user_id, "title": story.title, "key": export.cache_key(kind, story.title, full_story_text(story.id, story.content))}
+    if kind == 'comic':
+        comic = Comic.query.get(ref_id)
+        if not comic: return None
+        panels = [[p.panel_number, p.caption, media_ref(p.image_url)] for p in comic.panels]
+        return {"user_id": comic.story.user_id, "title": comic.story.title, "key": export.cache_key(kind, comic.story.title, panels)}
+    return None
+
+def render_export(kind, ref_id):
+    if kind == 'story':
+        story = Story.query.get(ref_id)
+        return export.story_pdf(story.title, full_story_text(story.id, story.content))
+    comic = Comic.query.get(ref_id)
+    panels, back_cover = [], None
+    for p in comic.panels:
+        if p.panel_number == 999:  # panel 999 = dữ liệu bìa sau (summary/theme/level) dạng JSON
+            try: back_cover = json.loads(p.caption)
+            except ValueError: pass
+            continue
+        try: data = read_media_url(p.image_url) if p.image_url else None
+        except (OSError, ValueError): data = None
+        panels.append((p.panel_number, p.caption, data))
+    return export.comic_pdf(comic.story.title, panels, back_cover)
+
+def own_export_source(kind, ref_id):
+    if kind not in EXPORT_KINDS or not export.enabled(): abort(404)
+    source = export_source(kind, ref_id)
+    if not source or source['user_id'] != current_user.id: abort(404)
+    return source
+
+@app.route('/export/<kind>/<int:ref_id>', methods=['POST'])
+@login_required
+def request_export(kind, ref_id):
+    source = own_export_source(kind, ref_id)
+    if export_store.exists(export.file_key(source['key'])):
+        return jsonify({"url": url_for('download_export', kind=kind, ref_id=ref_id)})
+    if job_queue.pending_by_user().get(current_user.id, 0) >= MAX_PENDING_JOBS_PER_USER:
+        return rejected_response(admission.Rejected(f"You already have {MAX_PENDING_JOBS_PER_USER} jobs running. Please wait for one to finish.", 10))
+    export_requests.inc(kind=kind, result='queued')
+    return job_accepted(job_queue.enqueue('export_pdf', {"kind": kind, "ref_id": ref_id}, user_id=current_user.id))
+
+@app.route('/export/<kind>/<int:ref_id>.pdf')
+@login_required
+def download_export(kind, ref_id):
+    source = own_export_source(kind, ref_id)
+    if source['key'] in request.if_none_match:
+        # Bản trong cache trình duyệt vẫn đúng nội dung hiện tại -> 304, không đọc file
+        export_requests.inc(kind=kind, result='not_modified')
+        response = Response(status=304)
+    else:
+        path = export.file_key(source['key'])
+        if not export_store.exists(path): return request_export(kind, ref_id)
+        export_requests.inc(kind=kind, result='cached')
+        response = send_from_directory(export_store.root, path, mimetype='application/pdf', as_attachment=True,
+                                       download_name=f"{secure_filename(source['title']) or kind}.pdf", conditional=False)
+    response.set_etag(source['key'])
+    response.cache_control.private = True
+    response.cache_control.no_cache = True  # luôn hỏi lại bằng If-None-Match, nội dung đổi thì ETag đổi
+    return response
+
+@job_queue.handler('export_pdf')
+def run_export_job(job):
+    payload = job['payload']
+    source = export_source(payload['kind'], payload['ref_id'])
+    if not source: raise ValueError("Story or comic not found.")
+    path = export.file_key(source['key'])
+    if not export_store.exists(path):  # 2 job cùng nội dung: job sau dùng lại file của job trước
+        job_queue.set_progress(job['id'], "Rendering pages")
+        export_store.write(path, render_export(payload['kind'], payload['ref_id']))
+        export_requests.inc(kind=payload['kind'], result='rendered')
+    return {"kind": payload['kind'], "ref_id": payload['ref_id']}
 
 @app.route('/reuse-prompt/<int:story_id>')
 @login_required
@@ -646,13 +1660,17 @@ def reuse_prompt(story_id):
 @app.route('/styles')
 @login_required
 def styles_page(): 
-    return render_template('manage_styles.html', styles=Style.query.filter_by(user_id=current_user.id).all(), user=current_user)
+    return render_template('manage_styles.html', styles=Style.query.filter_by(user_id=current_user.id).all(), user=current_user,
+                           ingest_limits={"mb": style_extractor.max_bytes // (1024 * 1024), "pages": style_extractor.max_pages})
 
 @app.route('/add-style', methods=['POST'])
 @login_required
 def add_style():
     content = request.form.get('style_content', '')
-    if request.files.get('style_file'): content = extract_text_from_file(request.files['style_file']) or content
+    if request.files.get('style_file'):
+        try: content = style_extractor.extract_upload(request.files['style_file'])
+        except ingest.IngestError as e:
+            flash(str(e), 'warning'); return redirect(url_for('styles_page'))
     
     # Kiểm tra trùng tên (chỉ trong phạm vi user đó)
     existing = Style.query.filter_by(name=request.form['style_name'], user_id=current_user.id).first()
@@ -670,15 +1688,120 @@ def delete_style():
     if s: db.session.delete(s); db.session.commit()
     return redirect(url_for('styles_page'))
 
+SAVED_PAGE_SIZE = int(os.environ.get('SAVED_PAGE_SIZE', 20))
+
 @app.route('/saved-stories')
 @login_required
-def saved_stories_page(): return render_template('saved_stories.html', stories=Story.query.filter_by(user_id=current_user.id).order_by(Story.id.desc()).all(), user=current_user)
+def saved_stories_page():
+    # Keyset pagination (?before=<id>): chỉ lấy id/title/cờ quiz, KHÔNG tải cột content.
+    # Nội dung truyện được tải qua /story/<id>/content khi mở accordion.
+    before = request.args.get('before', type=int)
+    filters = library_filters()
+    # Dấu vân tay của thư viện: thêm/sửa/xóa truyện hoặc tạo comic đều làm đổi 1 trong các số này
+    story_state = db.session.query(db.func.count(Story.id), db.func.max(Story.updated_at), db.func.sum(Story.version)) \
+        .filter(Story.user_id == current_user.id).one()
+    comic_state = db.session.query(db.func.count(Comic.id), db.func.max(Comic.id)).join(Story, Comic.story_id == Story.id) \
+        .filter(Story.user_id == current_user.id).one()
+
+    def render():
+        has_quiz = db.or_(Story.worksheets.any(), Story.content.contains('Extra Quiz'), Story.content.contains('Reading Quiz')).label('has_quiz')
+        query = db.session.query(Story.id, Story.title, Story.cefr_level, Story.created_at, Story.version, has_quiz).filter(Story.user_id == current_user.id)
+        query = apply_library_filters(query, filters)
+        if before: query = query.filter(Story.id < before)
+        rows = query.order_by(Story.id.desc()).limit(SAVED_PAGE_SIZE + 1).all()
+        stories, has_more = rows[:SAVED_PAGE_SIZE], len(rows) > SAVED_PAGE_SIZE
+
+        # Số truyện mỗi level: GROUP BY trên cột có index, không đọc content
+        level_counts = stories_per_level(Story.user_id == current_user.id)
+
+        # 1 query gộp thay vì story.comics cho từng truyện (N+1)
+        latest_comics = {}
+        if stories:
+            latest_comics = dict(db.session.query(Comic.story_id, db.func.max(Comic.id))
+                                 .filter(Comic.story_id.in_([st.id for st in stories]))
+                                 .group_by(Comic.story_id).all())
+
+        return render_template('saved_stories.html', stories=stories, latest_comics=latest_comics,
+                               total_count=sum(level_counts.values()), level_counts=level_counts, filters=filters,
+                               next_before=stories[-1].id if has_more else None, is_first_page=not before,
+                               user=current_user)
+    return cached_response(('library', sorted(filters.items()), before, tuple(story_state), tuple(comic_state)), None, render)
+
+def library_filters():
+    # ?level=B1&from=2026-01-01&to=2026-02-01 (ngày dạng YYYY-MM-DD, "to" tính cả ngày đó)
+    filters = {}
+    if request.args.get('level'): filters['level'] = request.args['level'].upper()
+    for key in ('from', 'to'):
+        try: datetime.strptime(request.args.get(key, ''), '%Y-%m-%d'); filters[key] = request.args[key]
+        except ValueError: pass
+    return filters
+
+def apply_library_filters(query, filters):
+    if 'level' in filters: query = query.filter(Story.cefr_level == filters['level'])
+    if 'from' in filters: query = query.filter(Story.created_at >= datetime.strptime(filters['from'], '%Y-%m-%d'))
+    if 'to' in filters: query = query.filter(Story.created_at < datetime.strptime(filters['to'], '%Y-%m-%d') + timedelta(days=1))
+    return query
+
+def stories_per_level(*criteria):
+    # {level: số truyện} theo thứ tự CEFR; truyện không có level nằm ở key None (cuối cùng)
+    counts = dict(db.session.query(Story.cefr_level, db.func.count(Story.id)).filter(*criteria).group_by(Story.cefr_level).all())
+    order = {lvl: i for i, lvl in enumerate(prompts.CEFR_LEVEL_GUIDELINES)}
+    return {lvl: counts[lvl] for lvl in sorted(counts, key=lambda l: (l is None, order.get(l, len(order)), l or ''))}
+
+@app.route('/search')
+@login_required
+def search_page():
+    q = request.args.get('q', '').strip()
+    level = request.args.get('level') or None
+    kind = request.args.get('kind') if request.args.get('kind') in (search.STORY, search.STYLE) else None
+    page = max(1, request.args.get('page', 1, type=int))
+    results, total = [], 0
+    if q and search_index:
+        results, total = search_index.search(db.session.connection(), current_user.id, q, level=level, kind=kind,
+                                             limit=SEARCH_PAGE_SIZE, offset=(page - 1) * SEARCH_PAGE_SIZE)
+    for r in results: r['snippet'] = search.highlight(r['snippet'])
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+
+    if request.accept_mimetypes.best == 'application/json' or request.args.get('format') == 'json':
+        return jsonify({"query": q, "total": total, "page": page, "pages": pages, "enabled": bool(search_index),
+                        "results": [dict(r, snippet=str(r['snippet'])) for r in results]})
+    return render_template('search.html', q=q, level=level, kind=kind, page=page, pages=pages, total=total,
+                           results=results, levels=list(prompts.CEFR_LEVEL_GUIDELINES), enabled=bool(search_index), user=current_user)
+
+@app.route('/story/<int:story_id>/content')
+@login_required
+def story_content(story_id):
+    row = db.session.query(Story.user_id, Story.version, Story.updated_at).filter_by(id=story_id).first()
+    if not row: abort(404)
+    if row.user_id != current_user.id: return jsonify({"error": "Not found"}), 404
+    def render():
+        s = db.session.query(Story.id, Story.title, Story.content, Story.content_html, Story.content_html_key).filter_by(id=story_id).one()
+        html = story_html(s.id, row.version, s.content, s.content_html, s.content_html_key)
+        sheets = [{"kind": w.kind, "version": w.version, "content": w.content} for w in Worksheet.query.filter_by(story_id=s.id).order_by(Worksheet.version)]
+        return jsonify({"id": s.id, "title": s.title, "content": s.content, "worksheets": sheets, "html": html})
+    return cached_response(('story-content', story_id, row.version, storydoc.VERSION), row.updated_at, render)
 
 @app.route('/save-story', methods=['POST'])
 @login_required
 def handle_save_story():
     content = request.form.get('story_content', '')
-    
+    title = story_title(content)
+
+    # Worksheet sinh cùng truyện (sau WORKSHEET_HEADER) được lưu riêng, Story.content chỉ giữ thân truyện
+    body, sheets = storydoc.split_worksheets(content)
+    try: quiz_type = json.loads(request.form.get('prompt_data_json') or '{}').get('quiz_type') or 'mix'
+    except (ValueError, AttributeError): quiz_type = 'mix'
+    db.session.add(Story(
+        title=title, 
+        content=body, 
+        user_id=current_user.id, 
+        prompt_data=request.form.get('prompt_data_json'),
+        worksheets=[Worksheet(kind=str(quiz_type)[:50], version=i, content=c) for i, c in enumerate(sheets, 1)]
+    ))
+    db.session.commit()
+    return redirect(url_for('saved_stories_page'))
+
+def story_title(content):
     # --- LOGIC MỚI: Tự động trích xuất tiêu đề thông minh hơn ---
     title = "Untitled Story"
     if content:
@@ -698,15 +1821,7 @@ def handle_save_story():
         if len(title) > 100:
             title = title[:97] + "..."
     # -----------------------------------------------------------
-
-    db.session.add(Story(
-        title=title, 
-        content=content, 
-        user_id=current_user.id, 
-        prompt_data=request.form.get('prompt_data_json')
-    ))
-    db.session.commit()
-    return redirect(url_for('saved_stories_page'))
+    return title
 
 @app.route('/delete-story', methods=['POST'])
 @login_required
@@ -716,8 +1831,8 @@ def handle_delete_story():
     
     if s and s.user_id == current_user.id:
         try:
-            # 1. Xóa tất cả Comic liên quan đến truyện này trước
-            Comic.query.filter_by(story_id=s.id).delete()
+            # 1. Xóa tất cả Comic (và Panel) liên quan đến truyện này trước
+            delete_comics_for_stories([s.id])
             
             # 2. Sau đó mới xóa Truyện
             db.session.delete(s)
@@ -735,8 +1850,12 @@ def handle_delete_story():
 def edit_story_page(story_id):
     s = Story.query.get_or_404(story_id)
     if s.user_id != current_user.id: return redirect(url_for('saved_stories_page'))
-    if request.method == 'POST': s.title = request.form['title']; s.content = request.form['content']; db.session.commit(); return redirect(url_for('saved_stories_page'))
-    return render_template('edit_story.html', story=s, user=current_user)
+    if request.method == 'POST':
+        body, sheets = storydoc.split_worksheets(request.form['content'])
+        s.title = request.form['title']; s.content = body; sync_worksheets(s, sheets); db.session.commit()
+        return redirect(url_for('saved_stories_page'))
+    # Sửa truyện + worksheet trong 1 ô như trước; khi lưu thì tách lại theo WORKSHEET_HEADER
+    return render_template('edit_story.html', story=s, content=full_story_text(s.id, s.content), user=current_user)
 
 @app.route('/translate-story')
 @login_required
@@ -744,6 +1863,7 @@ def translate_page(): return render_template('translate_story.html', user=curren
 
 @app.route('/handle-translation', methods=['POST'])
 @login_required
+@rate_limited(queued=False)
 def handle_translation():
     api_key = configure_ai()
     if not api_key: return jsonify({"story_result": "API Key Missing"}), 500
@@ -754,21 +1874,92 @@ def handle_translation():
         "level": data.get('cefr_level'), 
         "count": data.get('word_count')
     }
-    return jsonify({"story_result": generate_story_ai(api_key, create_translation_prompt(inputs))})
+    prompt = prompts.create_translation_prompt(inputs, prompts.choose(prompts.TRANSLATION, current_user.id))
+    try:
+        if data.get('stream') == '1':
+            return admitted_stream(stream_story_ai(api_key, prompt, use_cache=not wants_fresh()),
+                                   async_stream_story_ai(api_key, prompt, use_cache=not wants_fresh()))
+        if async_mode():
+            ticket = admission_control.acquire(current_user.id, request.endpoint)
+            use_cache = not wants_fresh()
+            async def body():
+                yield json.dumps({"story_result": await async_generate_story_ai(api_key, prompt, use_cache=use_cache)})
+            return deferred_response(body(), 'application/json', lambda: admission_control.release(ticket))
+        with admission_control.slot(current_user.id, request.endpoint):
+            return jsonify({"story_result": generate_story_ai(api_key, prompt, use_cache=not wants_fresh())})
+    except admission.Rejected as e:
+        return rejected_response(e)
 
 @app.route('/add-quiz-to-saved', methods=['POST'])
 @login_required
+@rate_limited(cost=lambda: len(quiz_variants(request.form.get('quiz_type'))) or 1)
 def add_quiz_to_saved():
     s = Story.query.get(request.form.get('story_id'))
     if s and s.user_id == current_user.id:
-        quiz_type = request.form.get('quiz_type')
-        api_key = configure_ai()
-        prompt = create_pedagogical_quiz_prompt(s.content, quiz_type)
-        quiz_content = generate_story_ai(api_key, prompt)
-        s.content += f"\n\n\n{'='*20}\n## 🎓 PEDAGOGICAL WORKSHEET\n{'='*20}\n\n{quiz_content}"
-        db.session.commit()
+        job_id = job_queue.enqueue('quiz', {
+            "story_id": s.id, "quiz_type": request.form.get('quiz_type'), "fresh": wants_fresh(),
+            "prompt_versions": prompts.assign(current_user.id)
+        }, user_id=current_user.id)
+        if request.accept_mimetypes.best == 'application/json': return job_accepted(job_id)
+        flash('Quiz is being generated. Refresh in a minute to see it.', 'info')
     return redirect(url_for('saved_stories_page'))
 
+@job_queue.handler('quiz')
+def run_quiz_job(job):
+    payload = job['payload']
+    s = Story.query.get(payload['story_id'])
+    if not s: raise ValueError("Story not found.")
+    variants = quiz_variants(payload['quiz_type']) or ['mix']
+    # Chỉ gửi thân truyện (không kèm worksheet cũ) -> prompt không phình ra sau mỗi lần thêm quiz
+    quiz_content = build_worksheet(configure_ai(), s.content, variants, not payload.get('fresh'),
+                                   (payload.get('prompt_versions') or {}).get(prompts.QUIZ))
+    sheet = add_worksheet(s.id, ",".join(variants), quiz_content)
+    db.session.commit()
+    return {"story_id": s.id, "worksheet_version": sheet.version}
+
+# --- JOB STATUS (POLLING + SERVER-SENT EVENTS) ---
+def job_accepted(job_id):
+    return jsonify({
+        "job_id": job_id,
+        "status_url": url_for('job_status', job_id=job_id),
+        "events_url": url_for('job_events', job_id=job_id)
+    }), 202
+
+def job_view(job):
+    data = jobs.public_view(job)
+    if job['kind'] == 'comic' and job['status'] == jobs.DONE:
+        data['result']['redirect_url'] = url_for('view_comic', comic_id=job['result']['comic_id'])
+    if job['kind'] == 'story' and job['status'] == jobs.RUNNING and job['progress']:
+        data['progress_html'] = str(storydoc.render(job['progress']))  # phần truyện đã viết, hiện dần trên trang index
+    if job['kind'] in ('panel_render', 'bulk_run') and job['progress']:
+        data['progress'] = json.loads(job['progress'])
+    if job['kind'] == 'export_pdf' and job['status'] == jobs.DONE:
+        data['result']['url'] = url_for('download_export', kind=job['result']['kind'], ref_id=job['result']['ref_id'])
+    return data
+
+def get_own_job(job_id):
+    job = job_queue.get(job_id)
+    if not job or job['user_id'] != current_user.id: return None
+    return job
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = get_own_job(job_id)
+    if not job: return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_view(job))
+
+@app.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    if not get_own_job(job_id): return jsonify({"error": "Job not found"}), 404
+
+    def stream():
+        for job in job_queue.wait(job_id, timeout=600):
+            yield sse_event('status', job_view(job))
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/send-feedback', methods=['POST'])
 @login_required
 def send_feedback():
@@ -779,7 +1970,25 @@ def send_feedback():
 @login_required
 def admin_dashboard():
     if current_user.username != 'admin': return "Access Denied", 403
-    return render_template('admin.html', users=User.query.all(), feedbacks=Feedback.query.order_by(Feedback.id.desc()).all())
+    story_counts = dict(db.session.query(Story.user_id, db.func.count(Story.id)).group_by(Story.user_id).all())
+    return render_template('admin.html', users=User.query.all(), feedbacks=Feedback.query.order_by(Feedback.id.desc()).all(),
+                           usage=admission_control.usage(), pending_jobs=job_queue.pending_by_user(), job_depth=job_queue.depth(),
+                           story_counts=story_counts, level_counts=stories_per_level(),
+                           recent_count=Story.query.filter(Story.created_at >= datetime.utcnow() - timedelta(days=7)).count())
+
+@app.route('/metrics')
+def metrics_page():
+    if not metrics.ENABLED: abort(404)
+    token = os.environ.get('METRICS_TOKEN')  # đặt token nếu /metrics mở ra internet
+    if token and request.headers.get('Authorization') != f'Bearer {token}': return "Unauthorized", 401
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/admin/llm-stats')
+@login_required
+def admin_llm_stats():
+    if current_user.username != 'admin': return "Access Denied", 403
+    cache = llm_cache.get_cache(instance_folder)
+    return jsonify({"client": llm_client.get_client().stats(), "cache": cache.stats() if cache else None})
 
 @app.route('/admin/reset-pass/<int:user_id>', methods=['POST'])
 @login_required
@@ -796,10 +2005,102 @@ def admin_toggle_lock(user_id):
 @app.route('/admin/delete/<int:user_id>', methods=['POST'])
 @login_required
 def admin_delete_user(user_id):
-    if current_user.username == 'admin': u = User.query.get(user_id); Story.query.filter_by(user_id=u.id).delete(); db.session.delete(u); db.session.commit()
+    if current_user.username == 'admin':
+        u = User.query.get(user_id)
+        delete_comics_for_stories([sid for (sid,) in db.session.query(Story.id).filter_by(user_id=u.id)])
+        StoryVocab.query.filter(StoryVocab.story_id.in_(db.session.query(Story.id).filter_by(user_id=u.id))).delete(synchronize_session=False)
+        Worksheet.query.filter(Worksheet.story_id.in_(db.session.query(Story.id).filter_by(user_id=u.id))).delete(synchronize_session=False)
+        BulkRow.query.filter(BulkRow.run_id.in_(db.session.query(BulkRun.id).filter_by(user_id=u.id))).delete(synchronize_session=False)
+        BulkRun.query.filter_by(user_id=u.id).delete()
+        Story.query.filter_by(user_id=u.id).delete()
+        if search_index: search_index.delete_user(db.session.connection(), u.id)  # bulk delete không qua after_flush
+        db.session.delete(u); db.session.commit()
     return redirect(url_for('admin_dashboard'))
 
-with app.app_context(): db.create_all()
+# --- LỆNH QUẢN TRỊ STORAGE (flask --app app storage-gc / storage-import-legacy) ---
+def collect_garbage(apply=False, grace_seconds=3600):
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    report = {"unreferenced": [], "orphans": [], "legacy": [], "exports": []}
+
+    # 1. File không còn Panel nào trỏ tới (và không ai vừa chạm vào trong thời gian grace)
+    for f in StoredFile.query.filter(StoredFile.refcount <= 0, StoredFile.touched_at < cutoff):
+        report["unreferenced"].append(f.key)
+    # 2. File có trong backend nhưng không có dòng StoredFile (process chết giữa lúc ghi)
+    known = {k for (k,) in db.session.query(StoredFile.key)}
+    report["orphans"] = [k for k, mtime in media_store.list_keys() if k not in known and mtime < cutoff.timestamp()]
+    # 3. File kiểu cũ trong static/uploads mà không Panel nào dùng (vd: comic_1_p2_* upload lại nhiều lần)
+    referenced = set()
+    for image_url, image_variants in db.session.query(Panel.image_url, Panel.image_variants):
+        urls = [image_url] + ([v for e in json.loads(image_variants).values() for k, v in e.items() if k != 'width'] if image_variants else [])
+        referenced.update(os.path.basename(u) for u in urls if u and u.startswith('/static/uploads/'))
+    for name in os.listdir(UPLOAD_FOLDER):
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if name not in referenced and os.path.isfile(path) and os.path.getmtime(path) < cutoff.timestamp():
+            report["legacy"].append(name)
+
+    # 4. PDF đã xuất lâu không được render lại (nội dung đổi thì key đổi, file cũ không còn ai tải)
+    export_cutoff = time.time() - EXPORT_CACHE_DAYS * 86400
+    report["exports"] = [k for k, mtime in export_store.list_keys() if mtime < export_cutoff]
+
+    if apply:
+        for key in report["unreferenced"]:
+            # Xóa có điều kiện: nếu vừa có upload dùng lại file này thì giữ nguyên
+            if StoredFile.query.filter(StoredFile.key == key, StoredFile.refcount <= 0, StoredFile.touched_at < cutoff).delete():
+                media_store.delete(key)
+        for key in report["orphans"]: media_store.delete(key)
+        for name in report["legacy"]: os.remove(os.path.join(UPLOAD_FOLDER, name))
+        for key in report["exports"]: export_store.delete(key)
+        db.session.commit()
+    return report
+
+@app.cli.command('storage-gc')
+@click.option('--apply', is_flag=True, help='Actually delete files (default is a dry run).')
+@click.option('--grace-hours', default=1.0, help='Skip files touched more recently than this.')
+def storage_gc_command(apply, grace_hours):
+    report = collect_garbage(apply=apply, grace_seconds=grace_hours * 3600)
+    for kind, items in report.items(): print(f"{kind}: {len(items)}")
+    if not apply: print("Dry run. Re-run with --apply to delete.")
+
+@app.cli.command('storage-import-legacy')
+def storage_import_legacy_command():
+    # Chuyển ảnh panel cũ (static/uploads) sang media_store theo hash -> bản trùng được gộp
+    def import_url(url):
+        if not url or not url.startswith('/static/uploads/'): return url
+        path = os.path.join(UPLOAD_FOLDER, os.path.basename(url))
+        if not os.path.exists(path): return url
+        with open(path, 'rb') as f: key = store_media(f.read(), os.path.splitext(path)[1] or '.png')
+        retain_media([key])
+        return media_store.url(key)
+
+    moved = 0
+    for panel in Panel.query.filter(db.or_(Panel.image_url.like('/static/uploads/%'), Panel.image_variants.like('%/static/uploads/%'))):
+        panel.image_url = import_url(panel.image_url)
+        if panel.image_variants:
+            variants = json.loads(panel.image_variants)
+            for entry in variants.values():
+                for fmt in [k for k in entry if k != 'width']: entry[fmt] = import_url(entry[fmt])
+            panel.image_variants = json.dumps(variants)
+        moved += 1
+        if moved % 100 == 0: db.session.commit()
+    db.session.commit()
+    print(f"Imported images for {moved} panels. Run storage-gc to remove the old copies.")
+
+with app.app_context():
+    db.create_all()
+    add_missing_columns()
+    backfill_panels()
+    backfill_story_metadata()
+    setup_search()
+    split_legacy_worksheets()
+
+@app.cli.command('search-reindex')
+def search_reindex_command():
+    setup_search(rebuild=True)
+
+@app.cli.command('render-stories')
+def render_stories_command():
+    # Dựng sẵn HTML (storydoc) cho các truyện cũ hoặc sau khi tăng storydoc.VERSION
+    print(f"Rendered {render_stale_stories()} stories.")
 
 @app.route('/reset-password', methods=['GET', 'POST'])
 def reset_password():
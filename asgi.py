@@ -0,0 +1,151 @@
+import os
+import sys
+import asyncio
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import app as storycraft
+
+# --- CHẾ ĐỘ ASGI: uvicorn asgi:application --workers 2 ---
+# Chế độ cũ vẫn chạy như trước: gunicorn app:app (mỗi request giữ 1 thread/worker tới khi model trả lời xong).
+# Ở đây Flask vẫn chạy trong thread pool (đăng nhập, DB, template không đổi), nhưng các route gọi AI có bản async
+# (stream truyện, dịch truyện) chỉ dùng thread cho phần nhanh rồi đặt body async vào environ[ASYNC_BODY]:
+# event loop chờ model qua llm_client.AsyncLLMClient -> 1 process giữ được hàng trăm lượt sinh truyện cùng lúc.
+# Nhớ nâng LLM_MAX_CONCURRENT / LLM_MAX_WAITING (admission dùng chung mọi worker) cho khớp.
+# Job nền (story/quiz/comic) vẫn chạy trong thread của jobs.py như chế độ sync.
+
+THREADS = int(os.environ.get('ASGI_THREADS', 32))
+SPOOL_BYTES = 1024 * 1024  # body upload lớn hơn mức này thì ghi ra file tạm thay vì giữ trong RAM
+
+
+class ASGIBridge:
+    def __init__(self, wsgi_app, threads=THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan': return await self.lifespan(receive, send)
+        if scope['type'] != 'http': return
+        environ = await self.environ(scope, receive)
+        loop = asyncio.get_running_loop()
+        queue, stop = asyncio.Queue(), threading.Event()
+        worker = loop.run_in_executor(self.executor, self.run_wsgi, environ, loop, queue, stop)
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            kind, status, headers = await queue.get()
+            if kind == 'error': raise status
+            deferred = environ.get(storycraft.ASYNC_BODY)
+            if deferred: headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+            await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+            if deferred: await self.send_async_body(deferred, send, disconnected)
+            else: await self.send_wsgi_body(queue, send, disconnected)
+            if not disconnected.done(): await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            stop.set()
+            disconnected.cancel()
+            await worker
+
+    # --- PHẦN WSGI: gọi Flask + đọc body trong cùng 1 thread (context của stream_with_context gắn với thread) ---
+    def run_wsgi(self, environ, loop, queue, stop):
+        def put(*item): loop.call_soon_threadsafe(queue.put_nowait, item)
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return lambda data: put('body', data, None)
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except Exception as e:
+            put('error', e, None); return
+        try:
+            put('start', *started)
+            if environ.get(storycraft.ASYNC_BODY): return  # body do event loop gửi
+            for chunk in result:
+                if stop.is_set(): break  # client đã ngắt
+                if chunk: put('body', chunk, None)
+        except Exception as e:
+            print(f"ASGI bridge: error while streaming {environ.get('PATH_INFO')}: {e}", file=sys.stderr)
+        finally:
+            if hasattr(result, 'close'): result.close()
+            put('end', None, None)
+
+    async def send_wsgi_body(self, queue, send, disconnected):
+        while True:
+            get = asyncio.ensure_future(queue.get())
+            await asyncio.wait({get, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel(); return
+            kind, data, _ = get.result()
+            if kind != 'body': return
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    # --- PHẦN ASYNC: body chờ model chạy trên event loop, client ngắt thì hủy và trả slot admission ---
+    async def send_async_body(self, deferred, send, disconnected):
+        body, on_close = deferred
+        async def pump():
+            async for chunk in body:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8') if isinstance(chunk, str) else chunk, 'more_body': True})
+        task = asyncio.ensure_future(pump())
+        try:
+            await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not task.done(): task.cancel()
+            error, = await asyncio.gather(task, return_exceptions=True)
+            if isinstance(error, Exception): print(f"ASGI bridge: async body failed: {error}", file=sys.stderr)
+        finally:
+            await body.aclose()
+            if on_close: await asyncio.get_running_loop().run_in_executor(self.executor, on_close)
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect': pass
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'}); return
+
+    async def environ(self, scope, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect': break
+            body.write(message.get('body', b''))
+            more = message.get('more_body', False)
+        body.seek(0)
+
+        root = scope.get('root_path', '')
+        path = scope['path'][len(root):] if root and scope['path'].startswith(root) else scope['path']
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1] or 80),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            storycraft.ASYNC_BODY: None,  # view có bản async sẽ thay bằng (async generator, on_close)
+        }
+        for name, value in scope.get('headers', []):
+            name, value = name.decode('latin-1'), value.decode('latin-1')
+            if name == 'content-type': key = 'CONTENT_TYPE'
+            elif name == 'content-length': key = 'CONTENT_LENGTH'
+            else: key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+
+application = ASGIBridge(storycraft.app)
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fake_llm import start_server
+
+# --- BENCHMARK: số request AI đồng thời / worker, chế độ sync (WSGI + thread) vs ASGI (asgi.py) ---
+# python -m bench.bench_asgi [--concurrency 50 200 500 --llm-latency 1.0 --threads 8]
+# Cả 2 chế độ chạy trong process này, gọi thẳng vào app (không qua socket):
+#   sync  = 1 worker gunicorn gthread: --threads request chạy song song, còn lại xếp hàng
+#   asgi  = 1 worker uvicorn: asgi.application trên 1 event loop
+# Mỗi request là POST /handle-translation stream=1 (SSE), fake LLM chờ --llm-latency giây trước khi trả lời.
+
+PATH = "/handle-translation"
+PASSWORD = "bench-password"
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+def form(i):
+    # fresh=1: bỏ qua LLM cache để request nào cũng phải chờ model
+    return urlencode({"folktale_name": f"Tale {i}", "cefr_level": "b1", "word_count": "300", "stream": "1", "fresh": "1"}).encode()
+
+def setup_app(args, llm):
+    tmp = tempfile.mkdtemp(prefix="bench-asgi-")
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{tmp}/bench.db", "LLM_BASE_URL": llm.base_url, "GOOGLE_API_KEY": "bench-key",
+        "JOB_DB_PATH": f"{tmp}/jobs.db", "LLM_CACHE_PATH": f"{tmp}/cache.db", "ADMISSION_DB_PATH": f"{tmp}/admission.db",
+        # bench đo khả năng giữ request của 1 worker, không đo admission -> nới hết giới hạn
+        "RATE_LIMIT_PER_MINUTE": "1000000", "RATE_LIMIT_BURST": "1000000", "LLM_MAX_CONCURRENT": "100000",
+        "LLM_MAX_WAITING": "100000", "LLM_WAIT_TIMEOUT": "600", "LLM_POOL_SIZE": str(args.threads),
+        "LLM_ASYNC_POOL_SIZE": str(max(args.concurrency)), "ASGI_THREADS": str(args.threads),
+    })
+    import asgi
+    from werkzeug.security import generate_password_hash
+    app = asgi.storycraft
+    with app.app.app_context():
+        app.db.session.add(app.User(username="bench", password_hash=generate_password_hash(PASSWORD)))
+        app.db.session.commit()
+    client = app.app.test_client()
+    client.post("/login", data={"username": "bench", "password": PASSWORD})
+    return app, asgi.application, client.get_cookie("session").value
+
+
+# --- SYNC: thread pool cỡ --threads gọi WSGI app ---
+def run_sync(app, cookie, n, threads):
+    local = threading.local()
+    start = time.perf_counter()  # latency tính cả thời gian xếp hàng chờ thread, như client thật thấy
+    def one(i):
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+            local.client.set_cookie("session", cookie)
+        res = local.client.post(PATH, data=form(i), content_type="application/x-www-form-urlencoded")
+        ok = res.status_code == 200 and b"event: done" in res.data
+        return time.perf_counter() - start, ok
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(one, range(n)))
+
+
+# --- ASGI: client ASGI tối thiểu, mọi request trên 1 event loop ---
+async def asgi_post(application, body, cookie):
+    scope = {"type": "http", "http_version": "1.1", "method": "POST", "scheme": "http", "path": PATH, "raw_path": PATH.encode(),
+             "root_path": "", "query_string": b"", "server": ("127.0.0.1", 8000), "client": ("127.0.0.1", 50000),
+             "headers": [(b"host", b"127.0.0.1:8000"), (b"content-type", b"application/x-www-form-urlencoded"),
+                         (b"content-length", str(len(body)).encode()), (b"cookie", f"session={cookie}".encode())]}
+    finished = asyncio.Event()
+    pending = [{"type": "http.request", "body": body, "more_body": False}]
+    status, chunks = None, []
+    async def receive():
+        if pending: return pending.pop()
+        await finished.wait()
+        return {"type": "http.disconnect"}
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start": status = message["status"]
+        else:
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"): finished.set()
+    await application(scope, receive, send)
+    return status, b"".join(chunks)
+
+async def run_asgi(application, cookie, n):
+    async def one(i):
+        start = time.perf_counter()
+        status, data = await asgi_post(application, form(i), cookie)
+        return time.perf_counter() - start, status == 200 and b"event: done" in data
+    return await asyncio.gather(*[one(i) for i in range(n)])
+
+
+def report(mode, n, elapsed, results, llm):
+    latencies = [t for t, _ in results]
+    ok = sum(1 for _, good in results if good)
+    print(f"{mode:5s} {n:6d} {ok:6d} {elapsed:8.2f} {n / elapsed:8.1f} {percentile(latencies, 50):8.2f} {percentile(latencies, 95):8.2f} {llm.peak_in_flight:9d}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--threads', type=int, default=8, help='threads per sync worker (gunicorn --threads) and ASGI bridge threads')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'asgi'], choices=['sync', 'asgi'])
+    args = parser.parse_args()
+
+    llm = start_server(latency=args.llm_latency)
+    app, application, cookie = setup_app(args, llm)
+    print(f"LLM latency {args.llm_latency}s, {args.threads} threads per worker\n")
+    print(f"{'mode':5s} {'reqs':>6s} {'ok':>6s} {'wall s':>8s} {'req/s':>8s} {'p50 s':>8s} {'p95 s':>8s} {'in-flight':>9s}")
+    loop = asyncio.new_event_loop()
+    for n in args.concurrency:
+        for mode in args.modes:
+            llm.peak_in_flight = 0
+            start = time.perf_counter()
+            results = run_sync(app, cookie, n, args.threads) if mode == 'sync' else loop.run_until_complete(run_asgi(application, cookie, n))
+            report(mode, n, time.perf_counter() - start, results, llm)
+    print("\nin-flight = most LLM calls one worker had waiting at the same time")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import os
+import re
+import json
+import time
+import random
+import argparse
+
+import jsonscan
+
+# --- BENCHMARK + FUZZ: robust_json_extract (regex) vs jsonscan (1 lượt, đọc theo stream) ---
+# python -m bench.bench_json_extract [--repeat 200 --fuzz 2000 --big-panels 2000]
+# Corpus: bench/comic_outputs/*.txt, số panel mong đợi trong manifest.json
+
+CORPUS = os.path.join(os.path.dirname(__file__), "comic_outputs")
+
+
+def legacy_extract(text):
+    # Bản cũ trong app.py (giữ nguyên để so sánh)
+    try:
+        match = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", text, re.DOTALL)
+        if match:
+            text = match.group(1)
+        else:
+            start_match = re.search(r"[\{\[]", text)
+            if start_match:
+                start_idx = start_match.start()
+                end_idx = max(text.rfind('}'), text.rfind(']'))
+                if end_idx > start_idx:
+                    text = text[start_idx : end_idx + 1]
+            else:
+                return None
+        text = re.sub(r'//.*', '', text)
+        text = re.sub(r',\s*([\]}])', r'\1', text)
+        return json.loads(text)
+    except Exception:
+        return None
+
+def panels_of(data):
+    # Cùng logic với run_comic_job
+    if data is None: return None
+    panels = data.get('panels', data.get('scenes', data)) if isinstance(data, dict) else data
+    if isinstance(panels, dict): panels = [panels]
+    return panels if isinstance(panels, list) else None
+
+def streamed(text, sizes):
+    scanner, items, pos = jsonscan.JSONScanner(), [], 0
+    for size in sizes:
+        items += scanner.feed(text[pos:pos + size]); pos += size
+    items += scanner.feed(text[pos:])
+    return items, scanner.result()
+
+def random_sizes(rng, n):
+    sizes = []
+    while sum(sizes) < n: sizes.append(rng.randint(1, 40))
+    return sizes
+
+def load_corpus():
+    with open(os.path.join(CORPUS, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    corpus = []
+    for name, expected in manifest.items():
+        with open(os.path.join(CORPUS, name), encoding="utf-8", newline="") as f:
+            corpus.append((name, f.read(), expected))
+    return corpus
+
+def big_script(panels):
+    body = ",\n".join(json.dumps({"panel_number": i + 1, "visual_description": f"Scene {i} with a lantern // glowing", "caption": "Hello, world!"})
+                      for i in range(panels))
+    return "Here you go:\n```json\n{\"panels\": [\n" + body + ",\n]}\n```\n"
+
+def timeit(fn, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat): fn(text)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def check_corpus(corpus):
+    print(f"{'file':24s} {'expected':>8s} {'legacy':>8s} {'jsonscan':>8s} {'streamed':>8s}")
+    failures = 0
+    for name, text, expected in corpus:
+        legacy = panels_of(legacy_extract(text))
+        items, _ = streamed(text, [7] * (len(text) // 7))
+        new = panels_of(jsonscan.extract(text))
+        got = len(items) if items else len(new or [])
+        if got != expected: failures += 1
+        fmt = lambda p: "fail" if p is None else str(len(p))
+        print(f"{name:24s} {expected:8d} {fmt(legacy):>8s} {fmt(new):>8s} {len(items):8d}")
+    return failures
+
+def fuzz(corpus, rounds, seed):
+    # 1) chia chunk ngẫu nhiên phải cho đúng kết quả như đọc 1 lần; 2) text bị sửa ngẫu nhiên không được làm scanner văng lỗi
+    rng = random.Random(seed)
+    mismatches = crashes = 0
+    alphabet = '{}[]",:/*\\\n `x1'
+    for i in range(rounds):
+        _, text, _ = corpus[i % len(corpus)]
+        if i % 2:
+            chars = list(text)
+            for _ in range(rng.randint(1, 6)):
+                op, at = rng.random(), rng.randrange(len(chars) + 1)
+                if op < 0.4: chars.insert(at, rng.choice(alphabet))
+                elif op < 0.8 and at < len(chars): del chars[at]
+                else: chars = chars[:at]
+            text = "".join(chars)
+        try:
+            one = jsonscan.JSONScanner()
+            whole_items = one.feed(text)
+            whole = one.result()
+            items, result = streamed(text, random_sizes(rng, len(text)))
+        except Exception as e:
+            crashes += 1
+            print(f"crash: {type(e).__name__}: {e} on {text[:60]!r}")
+            continue
+        if items != whole_items or result != whole: mismatches += 1
+    return mismatches, crashes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--fuzz', type=int, default=2000)
+    parser.add_argument('--big-panels', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    failures = check_corpus(corpus)
+    mismatches, crashes = fuzz(corpus, args.fuzz, args.seed)
+    print(f"\ncorpus failures={failures}  fuzz rounds={args.fuzz} stream mismatches={mismatches} crashes={crashes}")
+
+    print()
+    samples = [("fenced", corpus[0][1]),
+               (f"big script ({args.big_panels} panels)", big_script(args.big_panels))]
+    for label, text in samples:
+        repeat = max(1, args.repeat // 20) if "big" in label else args.repeat
+        old = timeit(legacy_extract, text, repeat)
+        new = timeit(jsonscan.extract, text, repeat)
+        print(f"{label:28s} {len(text):9d} chars  legacy {old:8.3f} ms  jsonscan {new:8.3f} ms")
+
+    # Độ trễ tới panel đầu tiên khi stream: bản cũ phải chờ hết output
+    text = big_script(args.big_panels)
+    scanner, start = jsonscan.JSONScanner(), time.perf_counter()
+    for pos in range(0, len(text), 64):
+        if scanner.feed(text[pos:pos + 64]): break
+    print(f"first panel after {pos + 64} of {len(text)} chars ({(time.perf_counter() - start) * 1000:.3f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_client import LLMClient, insecure_ssl_context
+from bench.fake_llm import start_server
+
+# --- BENCHMARK: 1 kết nối / lần gọi  vs  pool keep-alive ---
+# python -m bench.bench_llm_pool --calls 500 --threads 8 [--certfile cert.pem --keyfile key.pem]
+
+
+def run(client, calls, threads):
+    def one(_):
+        status, _ = client.chat("bench-key", "Write a story about a lantern.")
+        return status
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(one, range(calls)))
+    elapsed = time.perf_counter() - start
+    return elapsed, statuses.count(200)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--certfile'); parser.add_argument('--keyfile')
+    args = parser.parse_args()
+
+    server = start_server(args.latency, certfile=args.certfile, keyfile=args.keyfile)
+    ctx = insecure_ssl_context() if args.certfile else None
+
+    for label, keep_alive in (("handshake-per-call", False), ("pooled keep-alive", True)):
+        client = LLMClient(server.base_url, size=args.threads, keep_alive=keep_alive, ssl_context=ctx)
+        elapsed, ok = run(client, args.calls, args.threads)
+        stats = client.stats()
+        print(f"{label:20s} {args.calls / elapsed:8.1f} req/s  {elapsed * 1000 / args.calls:6.2f} ms/call  "
+              f"ok={ok}/{args.calls}  connections={stats['created']}  reused={stats['reused']}")
+        client.pool.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_client import LLMClient
+from resilience import ResilientClient, RetryPolicy, CircuitBreaker, CircuitOpenError
+from bench.fake_llm import start_server
+
+# --- KIỂM TRA LỚP RETRY / HEDGING / CIRCUIT BREAKER VỚI STUB SERVER CÓ LỖI GIẢ LẬP ---
+# python -m bench.bench_llm_resilience [--calls 200 --threads 8]
+# Mỗi kịch bản so sánh gọi trần (1 lần) với ResilientClient và kiểm tra kết quả mong đợi (✔/✘).
+# Repo không có test suite: script này là bài test của lớp resilience -> có kiểm tra sai (hoặc kịch bản
+# bị lỗi) thì in danh sách và thoát với mã 1, dùng được trong CI.
+
+FAILED = []
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+def drive(client, calls, threads):
+    def one(_):
+        started = time.perf_counter()
+        try:
+            status, _ = client.chat("bench-key", "Write a story about a lantern.")
+        except CircuitOpenError:
+            status = "open"
+        except OSError:
+            status = "network"
+        return status, time.perf_counter() - started
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(one, range(calls)))
+    latencies = [t for _, t in results]
+    return {"ok": sum(1 for s, _ in results if s == 200), "calls": calls,
+            "p50": percentile(latencies, 50), "p99": percentile(latencies, 99), "total": sum(latencies)}
+
+def report(label, stats, extra=""):
+    print(f"  {label:18s} ok={stats['ok']:4d}/{stats['calls']:<4d} p50={stats['p50'] * 1000:7.1f}ms "
+          f"p99={stats['p99'] * 1000:7.1f}ms {extra}")
+
+def check(name, passed):
+    print(f"  {'✔' if passed else '✘'} {name}")
+    if not passed: FAILED.append(name)
+    return passed
+
+def resilient(server, **kwargs):
+    policy = kwargs.pop('policy', RetryPolicy(max_attempts=4, base_delay=0.02, max_delay=0.2))
+    return ResilientClient(LLMClient(server.base_url, size=16), policy=policy, **kwargs)
+
+
+def scenario_errors(args):
+    print(f"\n[1] {int(args.error_rate * 100)}% of requests fail with 503")
+    server = start_server(error_rate=args.error_rate, seed=1)
+    bare = drive(LLMClient(server.base_url, size=16), args.calls, args.threads)
+    client = resilient(server, breaker=CircuitBreaker(failure_threshold=50))
+    retried = drive(client, args.calls, args.threads)
+    report("single attempt", bare); report("retry+backoff", retried, f"retries={client.counters['retries']}")
+    server.shutdown()
+    return check("retries recover most failed calls", retried["ok"] > bare["ok"] and retried["ok"] >= args.calls * 0.97)
+
+def scenario_retry_after(args):
+    print("\n[2] 429 with Retry-After: 1 on the first attempt")
+    server = start_server(error_status=429, retry_after=1)
+    server.fail_next = 1
+    client = resilient(server)
+    started = time.perf_counter()
+    status, _ = client.chat("bench-key", "hello")
+    waited = time.perf_counter() - started
+    print(f"  status={status} waited={waited:.2f}s")
+    ok = check("waits at least Retry-After before retrying", status == 200 and waited >= 1.0)
+    server.retry_after = 120  # quá LLM_MAX_RETRY_AFTER -> trả lỗi ngay thay vì giữ worker 2 phút
+    server.fail_next = 1
+    started = time.perf_counter()
+    status, _ = client.chat("bench-key", "hello")
+    ok &= check("gives up at once when Retry-After exceeds the cap", status == 429 and time.perf_counter() - started < 0.5)
+    server.shutdown()
+    return ok
+
+def scenario_hedging(args):
+    print(f"\n[3] Tail latency: {int(args.slow_rate * 100)}% of requests take {args.slow_latency}s")
+    server = start_server(latency=0.01, slow_rate=args.slow_rate, slow_latency=args.slow_latency, seed=2)
+    plain = drive(resilient(server), args.calls, args.threads)
+    client = resilient(server, hedge_percentile=90, hedge_min_samples=20)
+    drive(client, 40, args.threads)  # làm nóng cửa sổ latency
+    hedged = drive(client, args.calls, args.threads)
+    report("no hedging", plain)
+    report("hedge after p90", hedged, f"hedges={client.counters['hedges']} wins={client.counters['hedge_wins']}")
+    server.shutdown()
+    return check("hedging cuts p99 latency", hedged["p99"] < plain["p99"] / 2)
+
+def scenario_outage(args):
+    print("\n[4] Upstream is down (every request 503)")
+    server = start_server(latency=0.05)
+    server.down = True
+    no_breaker = drive(resilient(server, breaker=CircuitBreaker(failure_threshold=10 ** 9)), args.calls // 4, args.threads)
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=0.5)
+    client = resilient(server, breaker=breaker)
+    before = server.requests
+    with_breaker = drive(client, args.calls // 4, args.threads)
+    sent = server.requests - before
+    report("retries only", no_breaker)
+    report("circuit breaker", with_breaker, f"short_circuited={client.counters['short_circuited']} upstream_requests={sent}")
+    ok = check("breaker fails fast and stops hammering the upstream",
+               with_breaker["total"] < no_breaker["total"] / 3 and sent < args.calls // 4)
+    server.down = False
+    time.sleep(0.6)
+    status, _ = client.chat("bench-key", "hello")
+    ok &= check("half-open probe closes the circuit once upstream recovers", status == 200 and breaker.state == breaker.CLOSED)
+    server.shutdown()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--error-rate', type=float, default=0.3)
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-latency', type=float, default=0.5)
+    args = parser.parse_args()
+    scenarios = [scenario_errors, scenario_retry_after, scenario_hedging, scenario_outage]
+    for scenario in scenarios:
+        try: scenario(args)
+        except Exception as e:
+            print(f"  ✘ {scenario.__name__} crashed: {e!r}")
+            FAILED.append(f"{scenario.__name__} crashed: {e!r}")
+    if FAILED:
+        print(f"\nFAILED ({len(FAILED)}):\n" + "\n".join(f"  - {name}" for name in FAILED))
+        raise SystemExit(1)
+    print(f"\nall {len(scenarios)} scenarios passed")
+
+
+if __name__ == '__main__':
+    main()
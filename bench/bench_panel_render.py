@@ -0,0 +1,47 @@
+import time
+import argparse
+
+import imagegen
+import pipeline
+
+# --- BENCHMARK: sinh ảnh cho 1 comic, tuần tự vs song song (imagegen.render_all trên FanOut) ---
+# python -m bench.bench_panel_render [--panels 12 --delay 0.5 --jitter 1.5 --fail-rate 0.1]
+# Backend placeholder có độ trễ giả lập -> so thời gian cả comic với panel chậm nhất
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--panels', type=int, default=12)
+    parser.add_argument('--delay', type=float, default=0.5, help='base render time per panel (s)')
+    parser.add_argument('--jitter', type=float, default=1.5, help='extra random render time per panel (s)')
+    parser.add_argument('--fail-rate', type=float, default=0.1)
+    parser.add_argument('--attempts', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    panels = [(i, i, f"Panel {i}: Lan holds her lantern by the river.") for i in range(1, args.panels + 1)]
+    no_sleep = lambda s: None  # backoff không tính vào phép đo
+
+    backend = imagegen.PlaceholderBackend(delay=args.delay, jitter=args.jitter, fail_rate=args.fail_rate, seed=args.seed)
+    start = time.perf_counter()
+    sequential = imagegen.render_all(pipeline.FanOut(1, 'bench-seq'), backend, panels, attempts=args.attempts, sleep=no_sleep)
+    seq_time = time.perf_counter() - start
+
+    durations = {}
+    def on_done(result): durations[result.name] = time.perf_counter() - start
+    backend = imagegen.PlaceholderBackend(delay=args.delay, jitter=args.jitter, fail_rate=args.fail_rate, seed=args.seed)
+    start = time.perf_counter()
+    parallel = imagegen.render_all(pipeline.FanOut(args.workers, 'bench-par'), backend, panels, attempts=args.attempts,
+                                   on_done=on_done, sleep=no_sleep)
+    par_time = time.perf_counter() - start
+
+    ok = lambda results: sum(1 for r in results if r.ok)
+    print(f"{args.panels} panels, render {args.delay:.1f}-{args.delay + args.jitter:.1f} s each, fail rate {args.fail_rate:.0%}")
+    print(f"sequential: {seq_time:6.2f} s  ({ok(sequential)}/{args.panels} ok)")
+    print(f"parallel:   {par_time:6.2f} s  ({ok(parallel)}/{args.panels} ok)  first panel at {min(durations.values()):.2f} s, "
+          f"slowest at {max(durations.values()):.2f} s  -> {seq_time / par_time:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
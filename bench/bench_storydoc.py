@@ -0,0 +1,83 @@
+import time
+import random
+import argparse
+
+import storydoc
+
+# --- BENCHMARK: parse + render HTML của truyện (storydoc) trên 1 thư viện lớn ---
+# python -m bench.bench_storydoc [--stories 5000 --pages 8 --seed 1]
+# So sánh: render mỗi lần mở truyện  vs  render 1 lần / version rồi dùng lại HTML đã lưu
+
+WORDS = ("lantern market river friend happy brave little small garden school morning night teacher "
+         "mountain rain window bread music forest secret smile light village kite").split()
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 14))]
+    if rng.random() < 0.3: words[rng.randrange(len(words))] = f"**{rng.choice(WORDS)}**"
+    return " ".join(words).capitalize() + "."
+
+def story(rng, pages):
+    lines = [f"# The {rng.choice(WORDS).title()} {rng.choice(WORDS).title()}", ""]
+    for page in range(1, pages + 1):
+        lines += [f"--- PAGE {page} ---", ""]
+        for _ in range(rng.randint(2, 4)): lines += [" ".join(sentence(rng) for _ in range(rng.randint(2, 5))), ""]
+    lines += ["Graded Definitions (A2)", ""] + [f"- **{w}**: {sentence(rng)}" for w in rng.sample(WORDS, 5)]
+    lines += ["", "## 🎓 PEDAGOGICAL WORKSHEET", "", "### PART A: Vocabulary", f"[[WORD BANK: {', '.join(rng.sample(WORDS, 6))}]]"]
+    lines += [f"{i}. {sentence(rng)}" for i in range(1, 6)]
+    lines += ["", "### PART B: True or False", "| Word Bank |", "|:---:|", "| " + " | ".join(rng.sample(WORDS, 4)) + " |", ""]
+    lines += [f"{i}. {sentence(rng)} (T/F)" for i in range(1, 6)]
+    return "\n".join(lines)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stories', type=int, default=5000)
+    parser.add_argument('--pages', type=int, default=8)
+    parser.add_argument('--opens', type=int, default=5, help='times each story is opened (accordion/reload)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    library = [story(rng, args.pages) for _ in range(args.stories)]
+    size = sum(len(t) for t in library)
+    print(f"library: {args.stories} stories, {size / 1e6:.1f} MB of text, {size // args.stories} chars/story")
+
+    parse_times, render_times = [], []
+    rendered = {}
+    for i, text in enumerate(library):
+        start = time.perf_counter()
+        doc = storydoc.parse(text)
+        parsed = time.perf_counter()
+        rendered[i] = (storydoc.VERSION, str(doc.html()))
+        parse_times.append(parsed - start); render_times.append(time.perf_counter() - parsed)
+    total = sum(parse_times) + sum(render_times)
+    print(f"parse  p50 {percentile(parse_times, .5) * 1000:6.3f} ms  p95 {percentile(parse_times, .95) * 1000:6.3f} ms")
+    print(f"render p50 {percentile(render_times, .5) * 1000:6.3f} ms  p95 {percentile(render_times, .95) * 1000:6.3f} ms")
+    print(f"whole library: {total:.2f} s ({args.stories / total:.0f} stories/s, {size / total / 1e6:.1f} MB/s)")
+
+    # Mỗi truyện được mở args.opens lần: render lại mỗi lần  vs  kiểm tra key rồi trả HTML đã lưu
+    start = time.perf_counter()
+    for _ in range(args.opens):
+        for text in library: storydoc.render(text)
+    every_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.opens):
+        for i in range(len(library)):
+            version, html = rendered[i]
+            if version != storydoc.VERSION: html = str(storydoc.render(library[i]))
+    cached = time.perf_counter() - start
+    opens = args.opens * args.stories
+    print(f"{opens} opens: render every time {every_time:.2f} s ({every_time / opens * 1e6:.0f} us/open)  "
+          f"render once per version {cached * 1000:.1f} ms ({cached / opens * 1e6:.2f} us/open)")
+
+    doc = storydoc.parse(library[0])
+    print("sections of story 0:", ", ".join(f"{s.kind}:{s.heading or ''}" for s in doc.sections), f"| word bank: {len(doc.word_bank)} words")
+
+
+if __name__ == '__main__':
+    main()
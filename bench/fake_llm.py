@@ -0,0 +1,171 @@
+import json
+import ssl
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# --- STUB SERVER CHO /v1/chat/completions ---
+# Dùng cho benchmark: trả lời giống định dạng OpenAI, có keep-alive (HTTP/1.1).
+# Có thể giả lập sự cố: tỉ lệ lỗi (429/5xx kèm Retry-After), đuôi latency chậm, upstream sập hẳn.
+# Câu trả lời theo loại prompt (truyện / kịch bản comic JSON / quiz) để load test chạy trọn luồng của app.
+
+STORY_REPLY = "# The **Lantern** Night\n\nLan walked home with her lantern.\n---\nGraded Definitions\n- lantern: a light you can carry."
+COMIC_REPLY = "```json\n" + json.dumps({"panels": [
+    {"panel_number": i, "visual_description": f"Lan holds her lantern, scene {i}.", "caption": f"Lan walks, part {i}."}
+    for i in range(1, 13)]}) + "\n```"
+QUIZ_REPLY = ("PART 1: CONTROLLED PRACTICE\n1. Who walked home? A. Lan B. Nam\n\n"
+              "PART 2: LESS CONTROLLED PRACTICE\nLan carried a _______ (1).\n[[WORD BANK: lantern, river]]\n\n"
+              "PART 3: FREE PRACTICE\n1. Discussion: When do you use a light?\n\nANSWER KEY\nPart 1: 1. A\nPart 2: 1. lantern")
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args): pass
+
+    def do_POST(self):
+        self.server.track(1)
+        try: self._handle_post()
+        finally: self.server.track(-1)
+
+    def _handle_post(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.count_request(self)
+        latency = self.server.latency_for()
+        if latency: time.sleep(latency)
+        error = self.server.error_for()
+        if error:
+            headers = {"Retry-After": str(self.server.retry_after)} if self.server.retry_after is not None else None
+            self._send_json(error, {"error": {"message": "injected failure", "code": error}}, headers); return
+
+        prompt = body.get("messages", [{}])[-1].get("content", "")
+        content = self.server.reply_for(prompt)
+        if body.get("stream"):
+            self._send_stream(content, body.get("model")); return
+        self._send_json(200, {
+            "id": "fake-1", "object": "chat.completion", "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(content.split())}
+        })
+
+    def _send_stream(self, content, model):
+        # SSE kiểu OpenAI, chunked transfer-encoding để giữ được keep-alive
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = self.server.chunk_chars
+        for i in range(0, len(content), size):
+            delta = {"id": "fake-1", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": content[i:i + size]}}]}
+            self._write_chunk(f"data: {json.dumps(delta)}\n\n")
+            if self.server.chunk_delay: time.sleep(self.server.chunk_delay)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def _send_json(self, status, payload, extra_headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (extra_headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # bench ASGI mở hàng trăm kết nối cùng lúc
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, reply=None, chunk_chars=7, chunk_delay=0.0,
+                 error_rate=0.0, error_status=503, retry_after=None, slow_rate=0.0, slow_latency=0.0, seed=None):
+        super().__init__(address, FakeLLMHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.down = False
+        self.fail_next = 0  # n request kế tiếp chắc chắn lỗi (kịch bản cố định)
+        self.random = random.Random(seed)
+        self.reply = reply
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self.connections = set()
+        self.in_flight = self.peak_in_flight = 0  # số request đang được xử lý cùng lúc (đo độ song song của client)
+        self._lock = threading.Lock()
+
+    def count_request(self, handler):
+        with self._lock:
+            self.requests += 1
+            self.connections.add(handler.client_address)
+
+    def track(self, delta):
+        with self._lock:
+            self.in_flight += delta
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def latency_for(self):
+        with self._lock: slow = self.slow_rate and self.random.random() < self.slow_rate
+        return self.slow_latency if slow else self.latency
+
+    def error_for(self):
+        with self._lock:
+            if self.down: return self.error_status
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return self.error_status
+            if self.error_rate and self.random.random() < self.error_rate: return self.error_status
+        return None
+
+    def reply_for(self, prompt):
+        if self.reply is not None: return self.reply
+        if '"panels"' in prompt: return COMIC_REPLY
+        if "Quiz Generator" in prompt: return QUIZ_REPLY
+        return STORY_REPLY
+
+    @property
+    def base_url(self):
+        scheme = "https" if isinstance(self.socket, ssl.SSLSocket) else "http"
+        return f"{scheme}://127.0.0.1:{self.server_address[1]}"
+
+
+def start_server(latency=0.0, reply=None, certfile=None, keyfile=None, port=0, **faults):
+    server = FakeLLMServer(("127.0.0.1", port), latency=latency, reply=reply, **faults)
+    if certfile:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certfile, keyfile)
+        server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stub of the chat-completions endpoint")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=int)
+    parser.add_argument('--slow-rate', type=float, default=0.0)
+    parser.add_argument('--slow-latency', type=float, default=0.0)
+    parser.add_argument('--certfile'); parser.add_argument('--keyfile')
+    args = parser.parse_args()
+    srv = start_server(args.latency, certfile=args.certfile, keyfile=args.keyfile, port=args.port,
+                       error_rate=args.error_rate, error_status=args.error_status, retry_after=args.retry_after,
+                       slow_rate=args.slow_rate, slow_latency=args.slow_latency, chunk_delay=args.chunk_delay)
+    print(f"--> FAKE LLM ON {srv.base_url} (set LLM_BASE_URL to use it)")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt: srv.shutdown()
@@ -0,0 +1,304 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from http.cookies import SimpleCookie
+from collections import defaultdict
+from urllib.parse import urlsplit, urlencode
+
+from bench.fake_llm import start_server
+
+# --- LOAD TEST CẢ APP QUA HTTP THẬT ---
+# python -m bench.load_test [--users 8 --duration 30 --llm-latency 0.2 --error-rate 0.02]
+#     -> tự chạy fake LLM + app (werkzeug threaded) với SQLite tạm, in p50/p95/p99 + req/s mỗi endpoint
+# python -m bench.load_test --database-url postgresql://user:pw@localhost/storybench
+# python -m bench.load_test --compare sqlite postgresql://user:pw@localhost/storybench
+#     -> mỗi backend chạy trong 1 process riêng (app đọc DATABASE_URL lúc import), in bảng so sánh
+# python -m bench.load_test --url http://127.0.0.1:8000 --code <REGISTRATION_CODE_VIP>
+#     -> bắn vào server đang chạy (vd gunicorn với LLM_BASE_URL trỏ tới python -m bench.fake_llm)
+# Mỗi user ảo: đăng ký, đăng nhập, rồi chọn ngẫu nhiên (seed cố định) các thao tác theo trọng số ACTIONS.
+
+ACTIONS = (("saved_stories", 30), ("view_comic", 20), ("generate_story", 15), ("upload_panel_image", 15),
+           ("save_story", 10), ("create_comic", 10))
+PASSWORD = "bench-password"
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)  # tên -> [(giây, status)]
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, status):
+        with self._lock: self.samples[name].append((seconds, status))
+
+    def summary(self, elapsed):
+        rows = {}
+        for name, samples in sorted(self.samples.items()):
+            latencies = [s for s, _ in samples]
+            rows[name] = {"n": len(samples), "errors": sum(1 for _, st in samples if st >= 400),
+                          "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99),
+                          "rps": len(samples) / elapsed}
+        http = [r for name, r in rows.items() if not name.startswith("job ")]
+        return {"elapsed": elapsed, "requests": sum(r["n"] for r in http), "rps": sum(r["n"] for r in http) / elapsed,
+                "errors": sum(r["errors"] for r in http), "endpoints": rows}
+
+
+class Response:
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = body.decode("utf-8", "replace")
+
+    def json(self): return json.loads(self.text)
+
+
+class Client:
+    # http.client + cookie phiên (đủ cho Flask session/Flask-Login), giữ kết nối nếu server cho keep-alive
+    def __init__(self, base_url, timeout=60):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.conn = None
+        self.cookies = {}
+
+    def request(self, method, path, data=None, files=None):
+        headers, body = {}, None
+        if files:
+            boundary = f"bench{random.getrandbits(64):x}"
+            chunks = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode() for k, v in (data or {}).items()]
+            for field, (filename, content, ctype) in files.items():
+                chunks.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                              f'Content-Type: {ctype}\r\n\r\n'.encode() + content + b"\r\n")
+            body = b"".join(chunks) + f"--{boundary}--\r\n".encode()
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        elif data is not None:
+            body = urlencode(data).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookies: headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        for attempt in range(2):
+            try:
+                if self.conn is None: self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                self.conn.request(method, path, body, headers)
+                resp = self.conn.getresponse()
+                raw = resp.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # keep-alive bị server đóng giữa 2 request -> mở lại 1 lần
+                if self.conn: self.conn.close()
+                self.conn = None
+                if attempt: raise
+        for header in resp.headers.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items(): self.cookies[name] = morsel.value
+        return Response(resp.status, resp.headers, raw)
+
+
+def png_bytes(seed):
+    # Mỗi lần upload 1 ảnh khác nhau (media store khử trùng lặp theo hash, ảnh giống nhau không tốn gì)
+    from PIL import Image
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (64, 64), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    image.putpixel((rnd.randrange(64), rnd.randrange(64)), (rnd.randrange(256), 0, 0))
+    out = io.BytesIO(); image.save(out, "PNG")
+    return out.getvalue()
+
+
+class VirtualUser:
+    def __init__(self, base_url, name, code, recorder, seed, job_timeout):
+        self.base_url = base_url.rstrip("/")
+        self.name = name
+        self.code = code
+        self.recorder = recorder
+        self.random = random.Random(seed)
+        self.job_timeout = job_timeout
+        self.client = Client(self.base_url)
+        self.story_ids, self.comic_ids = [], []
+        self.uploads = 0
+
+    def request(self, label, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except (OSError, http.client.HTTPException):
+            response, status = None, 599
+        self.recorder.add(label, time.perf_counter() - started, status)
+        return response
+
+    def wait_job(self, label, accepted, started):
+        # Thời gian từ lúc gửi tới lúc job xong -> dòng "job <tên>" trong báo cáo
+        if accepted is None or accepted.status_code != 202: return None
+        status_url = accepted.json()["status_url"]
+        deadline = time.monotonic() + self.job_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            r = self.request("GET /jobs/<id>", "GET", status_url)
+            if r is None or r.status_code != 200: continue
+            job = r.json()
+            if job["status"] in ("done", "failed"):
+                self.recorder.add(f"job {label}", time.perf_counter() - started, 200 if job["status"] == "done" else 500)
+                return job if job["status"] == "done" else None
+        self.recorder.add(f"job {label}", time.perf_counter() - started, 504)
+        return None
+
+    # --- THAO TÁC ---
+    def setup(self):
+        self.client.request("POST", "/register", data={"username": self.name, "password": PASSWORD, "secret_code": self.code})
+        r = self.client.request("POST", "/login", data={"username": self.name, "password": PASSWORD})
+        if r.status_code != 302 or "/login" in r.headers.get("Location", ""):
+            raise RuntimeError(f"login failed for {self.name} (is the registration code right?)")
+        self.save_story()
+        self.create_comic()
+
+    def saved_stories(self):
+        self.request("GET /saved-stories", "GET", "/saved-stories")
+
+    def save_story(self):
+        before = set(self.story_ids)
+        self.request("POST /save-story", "POST", "/save-story", data={
+            "story_content": f"# Lantern {self.random.randrange(10 ** 6)}\n\nLan walked home with her lantern.",
+            "prompt_data_json": json.dumps({"cefr_level": "A2", "word_count": "150", "vocab_str": "lantern, river"})})
+        r = self.request("GET /saved-stories", "GET", "/saved-stories")
+        if r is not None and r.status_code == 200:
+            # id truyện mới nhất nằm trong link edit đầu tiên của trang
+            ids = [int(x) for x in re.findall(r"/edit-story/(\d+)", r.text)]
+            self.story_ids += [i for i in ids[:1] if i not in before]
+
+    def generate_story(self):
+        started = time.perf_counter()
+        r = self.request("POST /generate-story", "POST", "/generate-story", data={
+            "idea": "A girl and her lantern", "cefr_level": "A2", "word_count": "150", "theme": "Friendship",
+            "main_char": "Lan", "setting": "", "vocab_str": "lantern, river", "target_audience": "Children", "quiz_type": "none"})
+        self.wait_job("generate-story", r, started)
+
+    def create_comic(self):
+        if not self.story_ids: return self.save_story()
+        started = time.perf_counter()
+        r = self.request("POST /create-comic/<id>", "POST", f"/create-comic/{self.random.choice(self.story_ids)}")
+        job = self.wait_job("create-comic", r, started)
+        if job: self.comic_ids.append(job["result"]["comic_id"])
+
+    def view_comic(self):
+        if not self.comic_ids: return self.create_comic()
+        self.request("GET /view-comic/<id>", "GET", f"/view-comic/{self.random.choice(self.comic_ids)}")
+
+    def upload_panel_image(self):
+        if not self.comic_ids: return self.create_comic()
+        self.uploads += 1
+        self.request("POST /upload-panel-image", "POST", "/upload-panel-image",
+                     data={"comic_id": self.random.choice(self.comic_ids), "panel_number": self.random.randint(1, 12)},
+                     files={"file": ("panel.png", png_bytes(f"{self.name}-{self.uploads}"), "image/png")})
+
+    def run(self, deadline):
+        names = [n for n, _ in ACTIONS]
+        weights = [w for _, w in ACTIONS]
+        while time.monotonic() < deadline:
+            getattr(self, self.random.choices(names, weights)[0])()
+
+
+def drive(base_url, users, duration, code, seed=1, job_timeout=60.0):
+    recorder = Recorder()
+    run_id = f"{int(time.time())}{os.getpid() % 1000}"
+    vusers = [VirtualUser(base_url, f"bench{run_id}u{i}", code, recorder, seed + i, job_timeout) for i in range(users)]
+    for u in vusers: u.setup()
+    recorder.samples.clear()  # chỉ đo phần chạy tải, không tính bước chuẩn bị
+    started = time.perf_counter()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=u.run, args=(deadline,)) for u in vusers]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return recorder.summary(time.perf_counter() - started)
+
+
+# --- CHẠY APP TRONG PROCESS NÀY ---
+def serve_app(args):
+    tmp = tempfile.mkdtemp(prefix="storybench-")
+    llm = start_server(args.llm_latency, chunk_delay=args.chunk_delay, error_rate=args.error_rate, seed=args.seed)
+    database_url = args.database_url if args.database_url and args.database_url != "sqlite" else f"sqlite:///{tmp}/bench.db"
+    os.environ.update({
+        "DATABASE_URL": database_url, "LLM_BASE_URL": llm.base_url, "GOOGLE_API_KEY": "bench-key",
+        "REGISTRATION_CODE_VIP": args.code, "LLM_CACHE_ENABLED": "0",
+        "JOB_DB_PATH": f"{tmp}/jobs.db", "ADMISSION_DB_PATH": f"{tmp}/admission.db", "INGEST_CACHE_PATH": f"{tmp}/ingest.db",
+        "STORAGE_ROOT": f"{tmp}/media", "JOB_WORKERS": str(args.job_workers),
+        # load test đo app, không đo rate limit
+        "RATE_LIMIT_PER_MINUTE": "1000000", "RATE_LIMIT_BURST": "1000000",
+        "MAX_PENDING_JOBS_PER_USER": "1000", "MAX_QUEUED_JOBS": "100000", "LLM_MAX_WAITING": "1000",
+    })
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import app as story_app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs): pass
+
+    server = make_server("127.0.0.1", 0, story_app.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", database_url.split(":", 1)[0]
+
+
+def report(label, result):
+    print(f"\n== {label}: {result['requests']} requests in {result['elapsed']:.1f}s -> "
+          f"{result['rps']:.1f} req/s, {result['errors']} errors")
+    print(f"  {'endpoint':28s} {'n':>6s} {'err':>5s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'req/s':>8s}")
+    for name, r in result["endpoints"].items():
+        print(f"  {name:28s} {r['n']:6d} {r['errors']:5d} {r['p50'] * 1000:9.1f} {r['p95'] * 1000:9.1f} "
+              f"{r['p99'] * 1000:9.1f} {r['rps']:8.1f}")
+
+def compare(args):
+    # Mỗi backend 1 process con (cấu hình DB được đọc lúc import app), kết quả trả về dạng JSON
+    results = {}
+    for url in args.compare:
+        cmd = [sys.executable, "-m", "bench.load_test", "--database-url", url, "--json",
+               "--users", str(args.users), "--duration", str(args.duration), "--llm-latency", str(args.llm_latency),
+               "--chunk-delay", str(args.chunk_delay), "--error-rate", str(args.error_rate), "--seed", str(args.seed),
+               "--job-workers", str(args.job_workers)]
+        out = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        if out.returncode != 0:
+            print(f"{url}: failed\n{out.stderr[-2000:]}"); continue
+        results[url.split(":", 1)[0]] = json.loads(out.stdout.strip().splitlines()[-1])
+    for label, result in results.items(): report(label, result)
+    if len(results) > 1:
+        labels = list(results)
+        print(f"\n  {'p95 ms':28s} " + " ".join(f"{l:>12s}" for l in labels))
+        names = sorted(set().union(*(r["endpoints"] for r in results.values())))
+        for name in names:
+            print(f"  {name:28s} " + " ".join(f"{results[l]['endpoints'].get(name, {}).get('p95', 0) * 1000:12.1f}" for l in labels))
+        print(f"  {'req/s':28s} " + " ".join(f"{results[l]['rps']:12.1f}" for l in labels))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the Story Craft web app")
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--url', help="drive an already running server instead of starting one")
+    parser.add_argument('--code', default="bench-code", help="registration code (REGISTRATION_CODE_VIP)")
+    parser.add_argument('--database-url', help="sqlite (default, temp file) or a postgresql:// URL")
+    parser.add_argument('--compare', nargs='+', metavar="DATABASE_URL", help="run once per backend and compare")
+    parser.add_argument('--llm-latency', type=float, default=0.05)
+    parser.add_argument('--chunk-delay', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--job-workers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the result as one JSON line")
+    args = parser.parse_args()
+
+    if args.compare: return compare(args)
+    base_url, label = (args.url, args.url) if args.url else serve_app(args)
+    result = drive(base_url, args.users, args.duration, args.code, args.seed)
+    if args.json: print(json.dumps(result))
+    else: report(label, result)
+
+
+if __name__ == '__main__':
+    main()
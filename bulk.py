@@ -0,0 +1,125 @@
+import io
+import re
+import csv
+import zipfile
+import xml.etree.ElementTree as ET
+
+# --- ĐỌC FILE BULK (CSV/XLSX): mỗi dòng = 1 truyện, cột giống các ô của form index.html ---
+# Trả về dict theo đúng tên field của form (vocab_str, cefr_level, word_count...) -> app dùng chung
+# story_inputs() với form thường, và lưu luôn làm prompt_data (nút "Reuse prompt" điền lại form được).
+# XLSX đọc bằng zipfile + ElementTree (chỉ cần sheet đầu, chữ/số), không thêm thư viện Excel.
+
+SUPPORTED = (".csv", ".xlsx")
+
+# Tên cột chấp nhận (đã chuẩn hóa: chữ thường, khoảng trắng/gạch -> _) -> field của form
+COLUMNS = {
+    "vocab": "vocab_str", "vocab_str": "vocab_str", "vocabulary": "vocab_str", "words": "vocab_str",
+    "level": "cefr_level", "cefr": "cefr_level", "cefr_level": "cefr_level",
+    "count": "word_count", "word_count": "word_count", "length": "word_count",
+    "idea": "idea", "story_idea": "idea", "prompt": "idea",
+    "theme": "theme",
+    "main_char": "main_char", "main_character": "main_char", "character": "main_char",
+    "setting": "setting",
+    "negative_keywords": "negative_keywords", "avoid": "negative_keywords",
+    "target_audience": "target_audience", "audience": "target_audience",
+    "num_support": "num_support_char", "num_support_char": "num_support_char", "support_characters": "num_support_char",
+    "quiz": "quiz_type", "quiz_type": "quiz_type",
+    "style": "selected_styles", "styles": "selected_styles",
+}
+FIELDS = sorted(set(COLUMNS.values()) - {"selected_styles"})
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+CELL_REF = re.compile(r"([A-Z]+)")
+
+
+class BulkError(Exception):
+    pass
+
+
+def column_name(header):
+    return re.sub(r"[\s\-]+", "_", str(header or "").strip().lower())
+
+
+# --- CSV ---
+def read_csv(data):
+    # Excel "CSV UTF-8" có BOM; "CSV" thường thì theo code page của Windows (tiếng Việt: cp1258)
+    try: text = data.decode("utf-8-sig")
+    except UnicodeDecodeError: text = data.decode("cp1258", errors="replace")
+    try: dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error: dialect = csv.excel
+    return list(csv.reader(io.StringIO(text), dialect))
+
+
+# --- XLSX: sheet đầu tiên, giá trị hiển thị dạng chữ ---
+def column_index(ref):
+    index = 0
+    for ch in CELL_REF.match(ref).group(1):
+        index = index * 26 + ord(ch) - 64
+    return index - 1
+
+def read_xlsx(data):
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            names = z.namelist()
+            shared = []
+            if "xl/sharedStrings.xml" in names:
+                for si in ET.fromstring(z.read("xl/sharedStrings.xml")).iter(f"{XLSX_NS}si"):
+                    shared.append("".join(t.text or "" for t in si.iter(f"{XLSX_NS}t")))
+            sheets = sorted(n for n in names if n.startswith("xl/worksheets/sheet") and n.endswith(".xml"))
+            if not sheets: raise BulkError("This workbook has no worksheets.")
+            sheet = "xl/worksheets/sheet1.xml" if "xl/worksheets/sheet1.xml" in names else sheets[0]
+            root = ET.fromstring(z.read(sheet))
+    except (zipfile.BadZipFile, ET.ParseError, KeyError):
+        raise BulkError("Could not read this XLSX file.")
+
+    rows = []
+    for row in root.iter(f"{XLSX_NS}row"):
+        values = {}
+        for position, cell in enumerate(row.iter(f"{XLSX_NS}c")):
+            kind = cell.get("t")
+            if kind == "inlineStr":
+                value = "".join(t.text or "" for t in cell.iter(f"{XLSX_NS}t"))
+            else:
+                v = cell.find(f"{XLSX_NS}v")
+                value = v.text if v is not None and v.text is not None else ""
+                if kind == "s" and value: value = shared[int(value)]
+                elif kind is None and value.endswith(".0"): value = value[:-2]  # số nguyên Excel lưu dạng 250.0
+            values[column_index(cell.get("r")) if cell.get("r") else position] = value
+        rows.append([values.get(i, "") for i in range(max(values) + 1)] if values else [])
+    return rows
+
+
+# --- DÒNG -> FIELD CỦA FORM ---
+def parse(data, filename, max_rows, levels, quiz_types):
+    # -> [(số dòng trong file, {field form: giá trị})]; lỗi ở dòng nào thì báo đúng dòng đó, không nhận nửa file
+    filename = (filename or "").lower()
+    if not filename.endswith(SUPPORTED): raise BulkError("Only CSV and XLSX files are supported.")
+    table = read_xlsx(data) if filename.endswith(".xlsx") else read_csv(data)
+    table = [r for r in table if any(str(c).strip() for c in r)]
+    if len(table) < 2: raise BulkError("The file needs a header row and at least one row of vocabulary.")
+
+    headers = [COLUMNS.get(column_name(h)) for h in table[0]]
+    if "vocab_str" not in headers and "idea" not in headers:
+        raise BulkError("Missing a 'vocab' (or 'idea') column. Expected columns: vocab, level, count, theme, main_char, ...")
+    if len(table) - 1 > max_rows: raise BulkError(f"Too many rows (limit {max_rows} per file).")
+
+    rows = []
+    for number, cells in enumerate(table[1:], 2):
+        form = dict.fromkeys(FIELDS, "")  # như form index.html: ô để trống vẫn có field (chuỗi rỗng)
+        for field, value in zip(headers, cells):
+            value = str(value).strip()
+            if field and value: form[field] = value
+        if not form["vocab_str"] and not form["idea"]:
+            raise BulkError(f"Row {number}: needs vocabulary or a story idea.")
+        form["vocab_str"] = ",".join(w.strip() for w in re.split(r"[,;]", form["vocab_str"]) if w.strip())
+        level = form["cefr_level"] or "B1"
+        if level.upper() not in levels: raise BulkError(f"Row {number}: unknown CEFR level '{level}'.")
+        form["cefr_level"] = level
+        if form["word_count"] and not form["word_count"].isdigit():
+            raise BulkError(f"Row {number}: word count must be a number.")
+        quiz = [q.strip() for q in form["quiz_type"].split(",") if q.strip()]
+        if any(q not in quiz_types and q != "none" for q in quiz):
+            raise BulkError(f"Row {number}: unknown quiz type '{form['quiz_type']}'.")
+        if "selected_styles" in form:
+            form["selected_styles"] = [s.strip() for s in re.split(r"[,;]", form["selected_styles"]) if s.strip()]
+        rows.append((number, form))
+    return rows
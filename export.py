@@ -0,0 +1,187 @@
+import os
+import io
+import re
+import json
+import hashlib
+from functools import lru_cache
+import storydoc
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+except ImportError:  # Pillow là tùy chọn: thiếu thì nút Export PDF quay về bản in của trình duyệt
+    Image = None
+
+# --- XUẤT PDF PHÍA SERVER (TRUYỆN + COMIC) ---
+# Bản in trên trình duyệt (window.print) chậm với comic 12 ảnh lớn và mỗi máy ra 1 kiểu.
+# Ở đây dựng từng trang A4 thành ảnh bằng Pillow rồi ghép thành PDF, chạy trong job nền.
+# Key cache = sha256 của mọi thứ ảnh hưởng tới file (tiêu đề, chữ, hash ảnh, cỡ trang, RENDER_VERSION)
+# -> cùng nội dung thì dùng lại file cũ, key cũng là ETag khi tải về.
+
+RENDER_VERSION = 1  # tăng khi đổi layout để bỏ cache cũ
+DPI = int(os.environ.get('EXPORT_DPI', 150))
+PAGE = (int(8.27 * DPI), int(11.69 * DPI))  # A4
+MARGIN = int(DPI * 0.8)
+FONT_FILES = {
+    False: [os.environ.get('EXPORT_FONT', ''), "/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf",
+            "/usr/share/fonts/dejavu/DejaVuSerif.ttf", "/Library/Fonts/Times New Roman.ttf", "C:/Windows/Fonts/times.ttf"],
+    True: [os.environ.get('EXPORT_FONT_BOLD', ''), "/usr/share/fonts/truetype/dejavu/DejaVuSerif-Bold.ttf",
+           "/usr/share/fonts/dejavu/DejaVuSerif-Bold.ttf", "/Library/Fonts/Times New Roman Bold.ttf", "C:/Windows/Fonts/timesbd.ttf"],
+}
+NAVY, CREAM, RED, INK, GREY, ORANGE = (13, 59, 102), (253, 246, 227), (200, 0, 0), (20, 20, 20), (150, 150, 150), (211, 84, 0)
+EMOJI = re.compile("[\U0001F000-\U0010FFFF\u2600-\u27BF\uFE0F]")  # font serif không có emoji -> bỏ thay vì in ô vuông
+
+
+def enabled():
+    return Image is not None
+
+def cache_key(kind, *parts):
+    blob = json.dumps([RENDER_VERSION, DPI, kind, parts], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def file_key(digest):
+    return f"{digest[:2]}/{digest}.pdf"
+
+def pt(size):
+    return int(size * DPI / 72)
+
+
+@lru_cache(maxsize=32)
+def font(size, bold=False):
+    for path in FONT_FILES[bold]:
+        if path and os.path.exists(path): return ImageFont.truetype(path, pt(size))
+    return ImageFont.load_default(pt(size))  # font dựng sẵn của Pillow (thiếu dấu tiếng Việt)
+
+
+# --- DỰNG TRANG ---
+def wrap(text, fnt, width, indent=0):
+    lines, line = [], ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        limit = width - (indent if not lines else 0)
+        if line and fnt.getlength(candidate) > limit:
+            lines.append(line); line = word
+        else:
+            line = candidate
+    if line: lines.append(line)
+    return lines
+
+
+class Pages:
+    def __init__(self, background=(255, 255, 255)):
+        self.pages = []
+        self.background = background
+        self.width = PAGE[0] - 2 * MARGIN
+        self.new_page()
+
+    def new_page(self, background=None):
+        self.page = Image.new("RGB", PAGE, background or self.background)
+        self.draw = ImageDraw.Draw(self.page)
+        self.pages.append(self.page)
+        self.y = MARGIN
+
+    def room(self, height):
+        if self.y + height > PAGE[1] - MARGIN: self.new_page()
+
+    def text(self, text, size, bold=False, fill=INK, align="left", indent=0, left=0, space_after=0.4):
+        fnt = font(size, bold)
+        text = EMOJI.sub("", text)
+        line_height = int(pt(size) * 1.45)
+        for i, line in enumerate(wrap(text, fnt, self.width - left, indent)):
+            self.room(line_height)
+            x = MARGIN + left + (indent if i == 0 else 0)
+            if align == "center": x = (PAGE[0] - fnt.getlength(line)) / 2
+            self.draw.text((x, self.y), line, font=fnt, fill=fill)
+            self.y += line_height
+        self.y += int(pt(size) * space_after)
+
+    def image(self, img, box):
+        # Thu nhỏ giữ tỉ lệ vừa box (x, y, w, h), căn giữa theo chiều ngang, sát mép trên
+        x, y, w, h = box
+        img = ImageOps.contain(img, (w, h))
+        self.page.paste(img, (x + (w - img.width) // 2, y))
+        return img.height
+
+    def pdf(self, title):
+        out = io.BytesIO()
+        self.pages[0].save(out, "PDF", save_all=True, append_images=self.pages[1:], resolution=DPI, title=title or "")
+        return out.getvalue()
+
+
+def open_image(data):
+    if not data: return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.convert("RGBA").split()[-1])
+            img = background
+        return img
+    except Exception:
+        return None  # ảnh hỏng không làm hỏng cả file PDF
+
+
+def story_pdf(title, content):
+    doc = Pages()
+    for kind, value in storydoc.parse(content).blocks():
+        if kind in ("title", "item", "body"): value = value.replace("**", "")
+        if kind == "title": doc.text(value, 26, bold=True, fill=RED, align="center", space_after=1)
+        elif kind == "chapter": doc.y += pt(20); doc.text(value, 20, bold=True, align="center", space_after=0.8)
+        elif kind == "section": doc.y += pt(14); doc.text(value, 16, bold=True, fill=(44, 62, 80), space_after=0.6)
+        elif kind == "worksheet":
+            doc.new_page()
+            doc.text(value, 20, bold=True, fill=ORANGE, space_after=0.2)
+            doc.draw.line((MARGIN, doc.y, PAGE[0] - MARGIN, doc.y), fill=ORANGE, width=max(2, DPI // 50))
+            doc.y += pt(14)
+        elif kind in ("rule", "page"):
+            doc.room(pt(30)); doc.y += pt(12)
+            for x in range(MARGIN, PAGE[0] - MARGIN, pt(8)):
+                doc.draw.line((x, doc.y, x + pt(4), doc.y), fill=(204, 204, 204), width=max(2, DPI // 60))
+            doc.y += pt(18)
+        elif kind == "wordbank":
+            doc.text("Word Bank", 14, bold=True, fill=NAVY, space_after=0.2)
+            doc.text("   •   ".join(value), 13, fill=INK, left=pt(10), space_after=0.8)
+        elif kind == "item": doc.text(value, 14, left=pt(20))
+        else: doc.text(value, 14, indent=pt(36))
+    return doc.pdf(title)
+
+
+def comic_pdf(title, panels, back_cover=None):
+    # panels = [(panel_number, caption, image_bytes | None)]; back_cover = {"summary", "theme", "level"} (panel 999)
+    doc = Pages()
+    images = [open_image(data) for _, _, data in panels]
+
+    # Bìa: nền xanh, tiêu đề, ảnh panel 1
+    doc.page.paste(NAVY, (0, 0, PAGE[0], PAGE[1]))
+    doc.draw.rectangle((0, 0, PAGE[0] - 1, PAGE[1] - 1), outline=CREAM, width=pt(11))
+    doc.y = MARGIN + pt(20)
+    doc.text("Graded Readers Library", 12, fill=CREAM, align="center", space_after=1.5)
+    doc.text(title or "", 40, bold=True, fill=(255, 255, 255), align="center", space_after=0.8)
+    cover = next((img for img in images if img), None)
+    if cover:
+        top = doc.y + pt(10)
+        doc.y = top + doc.image(cover, (MARGIN, top, doc.width, PAGE[1] - top - MARGIN - pt(60))) + pt(20)
+    doc.y = max(doc.y, PAGE[1] - MARGIN - pt(40))
+    doc.text("Created with Story Weaver", 14, fill=CREAM, align="center")
+
+    # 1 panel / trang: ảnh ở trên, lời dẫn ở dưới, số trang ở chân
+    for index, ((_, caption, _), img) in enumerate(zip(panels, images), 1):
+        doc.new_page()
+        if img:
+            doc.y += doc.image(img, (MARGIN, MARGIN, doc.width, int((PAGE[1] - 2 * MARGIN) * 0.72))) + pt(24)
+        doc.text((caption or "").replace('"', ''), 18, align="center")
+        footer = f"- {index} -"
+        fnt = font(10)
+        doc.draw.text(((PAGE[0] - fnt.getlength(footer)) / 2, PAGE[1] - MARGIN // 2), footer, font=fnt, fill=GREY)
+
+    # Bìa sau
+    doc.new_page(background=CREAM)
+    doc.draw.rectangle((0, 0, PAGE[0] - 1, PAGE[1] - 1), outline=NAVY, width=pt(11))
+    doc.y = MARGIN + pt(20)
+    doc.text("Story Craft Graded Readers", 18, bold=True, fill=NAVY, align="center", space_after=2)
+    back_cover = back_cover or {}
+    doc.text(back_cover.get("summary") or "A wonderful story waiting for you.", 16, align="center", space_after=1.5)
+    doc.text(f"Level: {back_cover.get('level') or 'Beginner'}    Theme: {back_cover.get('theme') or 'General'}", 12, fill=GREY, align="center")
+    doc.y = PAGE[1] - MARGIN - pt(30)
+    doc.text("Story Craft Press", 14, bold=True, fill=NAVY, align="center")
+    return doc.pdf(title)
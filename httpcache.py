@@ -0,0 +1,63 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from markupsafe import Markup
+
+# --- CACHE HTTP: ETAG TỪ VERSION CỦA DÒNG DỮ LIỆU + CACHE ĐOẠN HTML ĐÃ RENDER ---
+# ETag ghép từ (build, user, version các dòng mà trang phụ thuộc) -> tính được bằng 1 query nhỏ,
+# trùng với If-None-Match thì trả 304 mà không render template.
+# Fragment cache: key chứa version -> dữ liệu đổi thì key đổi, bản cũ tự rơi khỏi LRU (hoặc bị discard).
+
+
+def etag(*parts):
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class FragmentCache:
+    def __init__(self, max_items=2000, max_bytes=32 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "discarded": 0}
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            html = self._items.get(key)
+            if html is not None:
+                self._items.move_to_end(key)
+                self.counters["hits"] += 1
+                return html
+            self.counters["misses"] += 1
+        html = str(render())  # render ngoài lock: 2 request cùng trượt thì render 2 lần, không chặn nhau
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = html
+                self._bytes += len(html)
+            while self._items and (len(self._items) > self.max_items or self._bytes > self.max_bytes):
+                _, old = self._items.popitem(last=False)
+                self._bytes -= len(old)
+                self.counters["evictions"] += 1
+        return html
+
+    def discard(self, kind, object_id):
+        # Key dạng (user_id, kind, object_id, ...): bỏ mọi bản của 1 truyện/comic (vd khi xóa hoặc có version mới)
+        with self._lock:
+            for key in [k for k in self._items if k[1:3] == (kind, object_id)]:
+                self._bytes -= len(self._items.pop(key))
+                self.counters["discarded"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._items), bytes=self._bytes)
+
+
+class TemplateFragments:
+    # Dùng trong Jinja: {% call cache_fragment('story-card', story.id, story.version) %}...{% endcall %}
+    def __init__(self, cache, user_id):
+        self.cache = cache
+        self.user_id = user_id
+
+    def __call__(self, kind, object_id, *version, caller):
+        return Markup(self.cache.get_or_render((self.user_id(), kind, object_id) + version, caller))
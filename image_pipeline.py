@@ -0,0 +1,103 @@
+import os
+import io
+import json
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow là tùy chọn: thiếu thì vẫn nhận upload như cũ, chỉ không tạo biến thể
+    Image = None
+
+# --- XỬ LÝ ẢNH PANEL: KIỂM TRA, BỎ METADATA, TẠO CÁC CỠ ẢNH ---
+
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_PANEL_UPLOAD_BYTES', 15 * 1024 * 1024))
+MAX_PIXELS = int(os.environ.get('MAX_PANEL_PIXELS', 40_000_000))
+ALLOWED_FORMATS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp", "GIF": "gif"}
+
+# Tên biến thể -> chiều rộng tối đa (không phóng to ảnh nhỏ hơn)
+VARIANTS = {"thumb": 320, "screen": 1280, "print": 2480}
+QUALITY = {"webp": 80, "avif": 55}
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def enabled():
+    return Image is not None
+
+def output_formats():
+    formats = []
+    if features.check('avif'): formats.append("avif")
+    if features.check('webp'): formats.append("webp")
+    return formats
+
+
+def validate(data):
+    # Kiểm tra nhanh trong request (chỉ đọc header, không decode toàn bộ). Trả về đuôi file.
+    if not data: raise InvalidImage("Empty file")
+    if len(data) > MAX_UPLOAD_BYTES: raise InvalidImage(f"File is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    if Image is None: return "png"
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            fmt = img.format
+            width, height = img.size
+            img.verify()
+    except Exception:
+        raise InvalidImage("Not a valid image file")
+    if fmt not in ALLOWED_FORMATS: raise InvalidImage(f"Unsupported image format: {fmt}")
+    if width * height > MAX_PIXELS: raise InvalidImage("Image dimensions are too large")
+    return ALLOWED_FORMATS[fmt]
+
+
+def _decode(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    img = ImageOps.exif_transpose(img)  # xoay đúng chiều trước khi bỏ EXIF
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+    return img
+
+def _encode(img, fmt):
+    # Không truyền exif/icc_profile -> file mới không mang metadata của ảnh gốc
+    out = io.BytesIO()
+    if fmt == "jpg":
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True, progressive=True)
+    elif fmt == "png":
+        img.save(out, "PNG", optimize=True)
+    else:
+        img.save(out, fmt.upper(), quality=QUALITY[fmt])
+    return out.getvalue()
+
+
+def process(data):
+    # Decode, bỏ metadata, tạo thumb/screen/print ở định dạng nén hiện đại.
+    # Trả về (fallback, variants): fallback = (bytes, ext) cỡ "screen" dạng JPEG/PNG cho trình duyệt cũ,
+    # variants = [(tên, chiều rộng, định dạng, bytes)]. Việc lưu file do storage đảm nhận.
+    img = _decode(data)
+    fallback_fmt = "png" if img.mode == "RGBA" else "jpg"
+    screen = img.copy()
+    screen.thumbnail((VARIANTS["screen"], VARIANTS["screen"] * 4))
+    fallback = (_encode(screen, fallback_fmt), fallback_fmt)
+
+    variants = []
+    for name, max_width in VARIANTS.items():
+        sized = img.copy()
+        sized.thumbnail((max_width, max_width * 4))
+        for fmt in output_formats():
+            variants.append((name, sized.width, fmt, _encode(sized, fmt)))
+    return fallback, variants
+
+
+def srcsets(variants_json):
+    # {"avif": "url 320w, url 1280w, ...", "webp": ...} cho thẻ <source srcset>
+    if not variants_json: return {}
+    variants = json.loads(variants_json)
+    result = {}
+    seen_widths = set()
+    for entry in sorted(variants.values(), key=lambda e: e["width"]):
+        if entry["width"] in seen_widths: continue  # ảnh nhỏ: nhiều biến thể cùng cỡ
+        seen_widths.add(entry["width"])
+        for fmt in ("avif", "webp"):
+            if fmt in entry:
+                result.setdefault(fmt, []).append(f"{entry[fmt]} {entry['width']}w")
+    return {fmt: ", ".join(items) for fmt, items in result.items()}
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import zlib
+import base64
+import random
+import struct
+import hashlib
+import threading
+import urllib.request
+
+import llm_client
+import resilience
+
+# --- SINH ẢNH PANEL: BACKEND THAY ĐƯỢC + CHẠY SONG SONG ---
+# Backend = object có .name và .render(prompt, seed) -> bytes ảnh. Lỗi tạm thời (429/5xx, mạng) -> RenderError(retryable=True)
+# hoặc OSError: render_all thử lại panel đó vài lần, panel khác không bị ảnh hưởng.
+# Các panel của 1 comic chạy đồng thời trên pipeline.FanOut dùng chung -> thời gian ~ panel chậm nhất.
+# Thêm backend: register("ten", factory) rồi đặt IMAGE_BACKEND=ten.
+
+IMAGES_PATH = "/v1/images/generations"
+
+
+class RenderError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+# --- BACKEND NỘI BỘ: ảnh placeholder xác định (cùng prompt + seed -> cùng byte), không cần mạng/Pillow ---
+def png(width, height, digest):
+    # Gradient dọc giữa 2 màu lấy từ digest, PNG RGB 8-bit viết tay bằng zlib
+    top, bottom = digest[:3], digest[3:6]
+    rows = []
+    for y in range(height):
+        t = y / max(1, height - 1)
+        rows.append(b"\x00" + bytes(int(a + (b - a) * t) for a, b in zip(top, bottom)) * width)
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) + chunk(b"IEND", b""))
+
+
+class PlaceholderBackend:
+    name = "placeholder"
+
+    def __init__(self, width=768, height=512, delay=0.0, jitter=0.0, fail_rate=0.0, seed=None):
+        self.width = width
+        self.height = height
+        self.delay = delay  # giả lập thời gian render (bench)
+        self.jitter = jitter
+        self.fail_rate = fail_rate  # giả lập lỗi tạm thời để thử retry
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def render(self, prompt, seed=0):
+        with self._lock:
+            fail = self.fail_rate and self._random.random() < self.fail_rate
+            delay = self.delay + self._random.uniform(0, self.jitter) if self.delay or self.jitter else 0
+        if delay: time.sleep(delay)
+        if fail: raise RenderError("Placeholder backend: injected failure")
+        return png(self.width, self.height, hashlib.sha256(f"{seed}:{prompt}".encode("utf-8")).digest())
+
+
+# --- BACKEND TỪ XA: API ảnh kiểu OpenAI (cùng base URL/key với LLM) ---
+class OpenAIImagesBackend:
+    name = "openai"
+
+    def __init__(self, base_url, api_key, model, size="1536x1024", timeout=180.0, pool_size=8):
+        self.api_key = api_key
+        self.model = model
+        self.size = size
+        self.timeout = timeout
+        self.pool = llm_client.ConnectionPool(base_url, size=pool_size, read_timeout=timeout)
+
+    def render(self, prompt, seed=0):
+        body = json.dumps({"model": self.model, "prompt": prompt, "size": self.size, "n": 1, "response_format": "b64_json"})
+        headers = {'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'}
+        status, _, data = self.pool.request("POST", IMAGES_PATH, body, headers)
+        if status != 200:
+            raise RenderError(f"Image API returned {status}", retryable=status in resilience.RETRY_STATUSES)
+        try: item = (json.loads(data).get("data") or [{}])[0]
+        except ValueError: raise RenderError("Image API returned invalid JSON")
+        if item.get("b64_json"): return base64.b64decode(item["b64_json"])
+        if item.get("url"):
+            with urllib.request.urlopen(item["url"], timeout=self.timeout) as res: return res.read()
+        raise RenderError("Image API returned no image", retryable=False)
+
+
+BACKENDS = {
+    "placeholder": lambda: PlaceholderBackend(
+        width=int(os.environ.get('IMAGE_PLACEHOLDER_WIDTH', 768)),
+        height=int(os.environ.get('IMAGE_PLACEHOLDER_HEIGHT', 512)),
+        delay=float(os.environ.get('IMAGE_PLACEHOLDER_DELAY', 0)),
+        fail_rate=float(os.environ.get('IMAGE_PLACEHOLDER_FAIL_RATE', 0)),
+    ),
+    "openai": lambda: OpenAIImagesBackend(
+        os.environ.get('IMAGE_BASE_URL') or os.environ.get('LLM_BASE_URL', llm_client.DEFAULT_BASE_URL),
+        os.environ.get('IMAGE_API_KEY') or os.environ.get('GOOGLE_API_KEY', ''),
+        os.environ.get('IMAGE_MODEL', 'gpt-image-1'),
+        size=os.environ.get('IMAGE_SIZE', '1536x1024'),
+        pool_size=int(os.environ.get('IMAGE_WORKERS', 12)),
+    ),
+}
+_instances = {}
+_lock = threading.Lock()
+
+def register(name, factory):
+    BACKENDS[name] = factory
+
+def get_backend(name=None):
+    # IMAGE_BACKEND rỗng = tắt (nút "Generate Images" không hiện)
+    name = name or os.environ.get('IMAGE_BACKEND', '')
+    if not name: return None
+    with _lock:
+        if name not in _instances:
+            if name not in BACKENDS: raise ValueError(f"Unknown image backend: {name}")
+            _instances[name] = BACKENDS[name]()
+        return _instances[name]
+
+
+# --- CHẠY CẢ COMIC ---
+def render_all(stage, backend, panels, attempts=3, timeout=None, on_done=None, sleep=time.sleep):
+    # panels: [(name, seed, prompt)] -> [pipeline.TaskResult] (value = bytes ảnh), on_done gọi khi từng panel xong
+    def make_task(seed, prompt):
+        def task():
+            for attempt in range(attempts):
+                try:
+                    return backend.render(prompt, seed=seed)
+                except (RenderError, OSError) as e:
+                    if not getattr(e, 'retryable', True) or attempt + 1 >= attempts: raise
+                sleep(min(8.0, 0.5 * 2 ** attempt))
+        return task
+    return stage.run([(name, make_task(seed, prompt)) for name, seed, prompt in panels], timeout=timeout, on_done=on_done)
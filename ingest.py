@@ -0,0 +1,114 @@
+import io
+import os
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import PyPDF2
+import docx
+
+# --- ĐỌC CHỮ TỪ FILE UPLOAD (PDF/DOCX) CHO STYLE ---
+# File chỉ dùng làm văn mẫu nên không cần đọc hết: đọc từng trang/đoạn, đủ max_chars thì dừng.
+# Giới hạn dung lượng upload + số trang, cache chữ đã trích theo sha256 của file, và parse PDF trong
+# process pool riêng để 1 file nặng không giữ request thread / GIL của worker web.
+
+SUPPORTED = (".pdf", ".docx")
+
+
+class IngestError(Exception):
+    pass
+
+
+def iter_pdf(stream, max_pages):
+    reader = PyPDF2.PdfReader(stream)  # trang được parse khi truy cập, không parse cả file lúc mở
+    if reader.is_encrypted: raise IngestError("Encrypted PDFs are not supported.")
+    for index, page in enumerate(reader.pages):
+        if index >= max_pages: return
+        yield page.extract_text() or ""
+
+def iter_docx(stream, max_pages):
+    for para in docx.Document(stream).paragraphs:
+        yield para.text
+
+def iter_text(data, filename, max_pages):
+    stream = io.BytesIO(data)
+    if filename.endswith(".pdf"): return iter_pdf(stream, max_pages)
+    if filename.endswith(".docx"): return iter_docx(stream, max_pages)
+    raise IngestError("Only PDF and DOCX files are supported.")
+
+def extract(data, filename, max_chars, max_pages):
+    # Chạy được trong process con (chỉ nhận/trả kiểu dữ liệu thường)
+    parts, size = [], 0
+    try:
+        for piece in iter_text(data, filename.lower(), max_pages):
+            piece = piece.strip()
+            if not piece: continue
+            parts.append(piece); size += len(piece) + 1
+            if size >= max_chars: break
+    except IngestError:
+        raise
+    except Exception as e:
+        raise IngestError(f"Could not read this file ({type(e).__name__}).")
+    return "\n".join(parts)[:max_chars]
+
+
+def read_upload(file, max_bytes):
+    # Đọc tối đa max_bytes + 1 byte: file lớn hơn thì dừng ngay, không kéo cả file vào RAM
+    data = file.stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise IngestError(f"File is too large (limit {max_bytes // (1024 * 1024)} MB).")
+    if not data: raise IngestError("The uploaded file is empty.")
+    return data
+
+
+class Extractor:
+    def __init__(self, max_bytes=10 * 1024 * 1024, max_pages=30, max_chars=4000, workers=2, timeout=30.0, cache=None):
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.max_chars = max_chars
+        self.workers = workers  # 0 = parse ngay trong thread của request
+        self.timeout = timeout
+        self.cache = cache  # llm_cache.ResponseCache (hoặc None)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # Pool tạo lười và theo pid: gunicorn fork worker sau khi import app
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def key(self, data):
+        return f"{hashlib.sha256(data).hexdigest()}:{self.max_chars}:{self.max_pages}"
+
+    def extract_upload(self, file):
+        filename = (file.filename or "").lower()
+        if not filename.endswith(SUPPORTED): raise IngestError("Only PDF and DOCX files are supported.")
+        data = read_upload(file, self.max_bytes)
+        key = self.key(data)
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached is not None: return cached
+
+        if not self.workers:
+            text = extract(data, filename, self.max_chars, self.max_pages)
+        else:
+            future = self._executor().submit(extract, data, filename, self.max_chars, self.max_pages)
+            try:
+                text = future.result(timeout=self.timeout)
+            except FutureTimeout:
+                future.cancel()
+                raise IngestError("This file took too long to read. Try a smaller file or paste the text instead.")
+            except BrokenProcessPool:
+                with self._lock: self._pool = None  # process con chết (vd hết RAM) -> lần sau tạo pool mới
+                raise IngestError("Could not read this file.")
+        if not text.strip(): raise IngestError("No text could be found in this file (scanned PDFs are not supported).")
+        if self.cache: self.cache.put(key, text)
+        return text
+
+    def stats(self):
+        return self.cache.stats() if self.cache else {}
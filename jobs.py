@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+
+# --- HÀNG ĐỢI JOB NỀN (SQLite, không cần broker) ---
+# Route chỉ enqueue rồi trả job_id ngay; worker thread trong mỗi process nhận job từ file SQLite
+# dùng chung, nên worker nào của gunicorn cũng trả lời được /jobs/<id>.
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+
+class JobQueue:
+    def __init__(self, path, workers=4, context=None, stale_after=120, heartbeat=30, keep_for=24 * 3600):
+        self.path = path
+        self.workers = workers
+        self.context = context  # context(job) -> context manager, vd: app context để handler dùng được db.session
+        self.stale_after = stale_after  # job "running" không có heartbeat lâu hơn mức này = process chạy nó đã chết
+        self.heartbeat = heartbeat
+        self.keep_for = keep_for
+        self.handlers = {}
+        self._running = {}  # {job_id: claim} các job process này đang chạy (thread heartbeat đánh dấu còn sống)
+        self._running_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS job (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id INTEGER, status TEXT NOT NULL,
+                payload TEXT, result TEXT, error TEXT, progress TEXT,
+                created_at REAL NOT NULL, started_at REAL, finished_at REAL, updated_at REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_job_status_created ON job (status, created_at)")
+            # claim: token của lần nhận job hiện tại, heartbeat_at: lần cuối worker sở hữu báo còn sống
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(job)")}
+            for column, ddl in (("claim", "TEXT"), ("heartbeat_at", "REAL")):
+                if column not in existing: conn.execute(f"ALTER TABLE job ADD COLUMN {column} {ddl}")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=15, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def handler(self, kind):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    # --- PHÍA ROUTE ---
+    def enqueue(self, kind, payload, user_id=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO job (id, kind, user_id, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, kind, user_id, QUEUED, json.dumps(payload), now, now))
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM job WHERE id = ?", (job_id,)).fetchone()
+        if row is None: return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def depth(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM job WHERE status IN (?, ?) GROUP BY status", (QUEUED, RUNNING)).fetchall()
+        counts = {QUEUED: 0, RUNNING: 0}
+        counts.update({r[0]: r[1] for r in rows})
+        return counts
+
+    def pending_by_user(self):
+        # {user_id: số job đang chờ/chạy} cho giới hạn theo user và trang admin. Job mồ côi (process chết) không tính
+        with self._connect() as conn:
+            rows = conn.execute("SELECT user_id, COUNT(*) FROM job WHERE status = ? OR (status = ? AND COALESCE(heartbeat_at, updated_at) >= ?) GROUP BY user_id",
+                                (QUEUED, RUNNING, time.time() - self.stale_after)).fetchall()
+        return {r[0]: r[1] for r in rows}
+
+    def is_orphaned(self, job):
+        # Job "running" mà worker sở hữu đã ngừng heartbeat (process bị kill, deploy...)
+        return job["status"] == RUNNING and (job["heartbeat_at"] or job["updated_at"]) < time.time() - self.stale_after
+
+    def abandon(self, job_id):
+        # Bỏ job đang chờ/mồ côi (vd: user bấm Resume tạo job mới). Xóa claim -> worker cũ nếu còn sống cũng không ghi đè kết quả
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("UPDATE job SET status = ?, error = ?, claim = NULL, finished_at = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                         (FAILED, "Abandoned", now, now, job_id, QUEUED, RUNNING))
+
+    # --- PHÍA WORKER ---
+    def _claim(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id FROM job WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT"); return None
+            conn.execute("UPDATE job SET status = ?, claim = ?, started_at = ?, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                         (RUNNING, uuid.uuid4().hex, now, now, now, row["id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK"); raise
+        finally:
+            conn.close()
+        return self.get(row["id"])
+
+    def set_progress(self, job_id, progress):
+        with self._connect() as conn:
+            conn.execute("UPDATE job SET progress = ?, updated_at = ? WHERE id = ?", (progress, time.time(), job_id))
+
+    def _finish(self, job, status, result=None, error=None):
+        # Chỉ ghi nếu vẫn giữ claim: job đã bị đưa lại hàng đợi / bỏ thì kết quả của lần chạy này không đè lên lần sau
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("UPDATE job SET status = ?, result = ?, error = ?, finished_at = ?, updated_at = ? WHERE id = ? AND claim = ?",
+                         (status, json.dumps(result) if result is not None else None, error, now, now, job["id"], job["claim"]))
+
+    def _run(self, job):
+        fn = self.handlers.get(job["kind"])
+        if fn is None:
+            self._finish(job, FAILED, error=f"Unknown job kind: {job['kind']}"); return
+        with self._running_lock: self._running[job["id"]] = job["claim"]
+        try:
+            if self.context:
+                with self.context(job): result = fn(job)
+            else:
+                result = fn(job)
+            self._finish(job, DONE, result=result)
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed: {e}")
+            traceback.print_exc()
+            self._finish(job, FAILED, error=str(e))
+        finally:
+            with self._running_lock: self._running.pop(job["id"], None)
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.OperationalError:
+                job = None  # DB đang bận -> thử lại vòng sau
+            if job is None:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _housekeeping(self):
+        now = time.time()
+        with self._connect() as conn:
+            # Job "running" không còn heartbeat = process cũ đã chết giữa chừng -> đưa lại vào hàng đợi (claim cũ hết hiệu lực).
+            # Lời gọi LLM dài mà không báo progress vẫn có heartbeat nên không bị chạy trùng
+            conn.execute("UPDATE job SET status = ?, claim = NULL, updated_at = ? WHERE status = ? AND COALESCE(heartbeat_at, updated_at) < ?",
+                         (QUEUED, now, RUNNING, now - self.stale_after))
+            conn.execute("DELETE FROM job WHERE status IN (?, ?) AND finished_at < ?", (DONE, FAILED, now - self.keep_for))
+
+    def _heartbeat_loop(self):
+        # Mỗi `heartbeat` giây: đánh dấu các job process này đang chạy còn sống, rồi dọn job mồ côi / job cũ
+        while not self._stop.wait(self.heartbeat):
+            try:
+                with self._running_lock: running = list(self._running.items())
+                with self._connect() as conn:
+                    conn.executemany("UPDATE job SET heartbeat_at = ? WHERE id = ? AND claim = ?", [(time.time(), j, c) for j, c in running])
+                self._housekeeping()
+            except sqlite3.OperationalError:
+                pass  # DB đang bận -> lượt sau
+
+    def start(self):
+        # 1 lần cho mỗi PID (an toàn với gunicorn fork); app gọi ở mỗi request (before_request), enqueue gọi lại cho chắc
+        if self._started_pid == os.getpid(): return
+        with self._start_lock:
+            if self._started_pid == os.getpid(): return
+            self._started_pid = os.getpid()
+            self._housekeeping()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True).start()
+            threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True).start()
+
+    def wait(self, job_id, timeout=None, interval=0.5):
+        # Generator cho SSE: yield job mỗi khi trạng thái/progress thay đổi, dừng khi xong
+        deadline = time.time() + timeout if timeout else None
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None: return
+            marker = (job["status"], job["updated_at"])
+            if marker != last:
+                last = marker
+                yield job
+            if job["status"] in FINISHED: return
+            if deadline and time.time() > deadline: return
+            time.sleep(interval)
+
+
+def public_view(job):
+    return {k: job[k] for k in ("id", "kind", "status", "result", "error", "progress")}
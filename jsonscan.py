@@ -0,0 +1,172 @@
+import re
+import json
+
+# --- ĐỌC JSON "BẨN" TỪ MODEL, 1 LƯỢT, NHẬN DỮ LIỆU STREAM ---
+# Model hay trả JSON kèm ```json fence, câu dẫn, dấu phẩy thừa, comment // hoặc /* */, xuống dòng
+# thật trong chuỗi... Scanner đi qua text đúng 1 lần (có thể theo từng chunk), bỏ phần ngoài object
+# đầu tiên, bỏ comment và dấu phẩy thừa NHƯNG không đụng vào nội dung chuỗi (URL có // vẫn nguyên),
+# và trả về từng phần tử của mảng "panels" ngay khi phần tử đó vừa đóng ngoặc.
+
+ITEM_KEYS = ("panels", "scenes")
+_START = re.compile(r"[{\[]")
+_OUTSIDE = re.compile(r'["{}\[\],/]')  # ký tự cần xử lý khi ở ngoài chuỗi
+_INSIDE = re.compile(r'["\\\n\r\t]')   # ... và khi ở trong chuỗi
+_STRING = re.compile(r'"(?:[^"\\\n\r\t]|\\.)*"')  # chuỗi sạch, trọn vẹn trong chunk -> lấy 1 lần
+_CONTROL = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_CLOSER = {"{": "}", "[": "]"}
+
+
+class JSONScanner:
+    def __init__(self, item_keys=ITEM_KEYS):
+        self.item_keys = item_keys
+        self.out = []          # các mảnh JSON đã làm sạch
+        self.stack = []        # "{" / "[" đang mở
+        self.state = "seek"    # seek -> value -> string / line_comment / block_comment -> done
+        self.carry = ""        # ký tự cuối chunk chưa quyết định được (vd "/" có thể là đầu comment)
+        self.last_comma = None  # vị trí trong out của dấu phẩy cuối cùng (nếu chưa có gì sau nó)
+        self.key = None        # chuỗi vừa đóng gần nhất (= key khi gặp ":")
+        self.string_start = 0
+        self.items_depth = None  # độ sâu của mảng panels
+        self.item_start = None
+        self.items = []
+        self.safe = None       # (vị trí trong out, stack) ngay sau giá trị trọn vẹn gần nhất -> chỗ cắt khi output bị cụt
+
+    # --- API ---
+    def feed(self, chunk):
+        # Trả về các panel (dict) vừa hoàn chỉnh trong chunk này
+        before = len(self.items)
+        text, self.carry = self.carry + chunk, ""
+        self._scan(text)
+        return self.items[before:]
+
+    def result(self):
+        # Object/mảng ngoài cùng đã làm sạch; output bị cắt cụt thì tự đóng các ngoặc còn mở. None nếu không đọc được.
+        if self.carry and self.state == "value": self._emit(self.carry); self.carry = ""
+        if not self.out: return None
+        tail = []
+        if self.state == "string": tail.append('"')
+        if self.stack and self.last_comma is not None: self.out[self.last_comma] = ""
+        tail += [_CLOSER[c] for c in reversed(self.stack)]
+        try:
+            return json.loads("".join(self.out) + "".join(tail))
+        except ValueError:
+            pass
+        # Cụt giữa 1 cặp key/value (vd `{"panels":[{"a":1},{"b":`) -> lùi về giá trị trọn vẹn cuối cùng rồi mới đóng ngoặc
+        if self.safe is None: return None
+        end, stack = self.safe
+        try:
+            return json.loads("".join(self.out[:end]) + "".join(_CLOSER[c] for c in reversed(stack)))
+        except ValueError:
+            return None
+
+    # --- SCANNER ---
+    def _emit(self, piece):
+        self.out.append(piece)
+        if piece.strip(): self.last_comma = None
+
+    def _scan(self, text):
+        pos, n = 0, len(text)
+        while pos < n:
+            state = self.state
+            if state == "done": return
+            if state == "seek":
+                match = _START.search(text, pos)
+                if not match: return
+                pos = match.start()
+                self.state = "value"
+                continue
+            if state == "string":
+                match = _INSIDE.search(text, pos)
+                if not match:
+                    self.out.append(text[pos:]); return
+                ch = match.group()
+                self.out.append(text[pos:match.start()])
+                pos = match.end()
+                if ch == '"':
+                    self.out.append('"'); self.state = "value"
+                    self.key = "".join(self.out[self.string_start:])[1:-1]
+                elif ch == "\\":
+                    if pos >= n:
+                        self.carry = "\\"; return
+                    self.out.append(text[pos - 1:pos + 1]); pos += 1
+                else:
+                    self.out.append(_CONTROL[ch])
+                continue
+            if state == "line_comment":
+                end = text.find("\n", pos)
+                if end < 0: return
+                pos = end; self.state = "value"
+                continue
+            if state == "block_comment":
+                end = text.find("*/", pos)
+                if end < 0:
+                    if text.endswith("*"): self.carry = "*"
+                    return
+                pos = end + 2; self.state = "value"
+                continue
+
+            # state == "value": ngoài chuỗi, bên trong object/mảng
+            match = _OUTSIDE.search(text, pos)
+            if not match:
+                self._emit(text[pos:]); return
+            if match.start() > pos: self._emit(text[pos:match.start()])
+            ch = match.group()
+            pos = match.end()
+            if ch == '"':
+                match = _STRING.match(text, pos - 1)
+                if match:
+                    pos = match.end()
+                    self.key = match.group()[1:-1]
+                    self.out.append(match.group()); self.last_comma = None
+                    continue
+                self.string_start = len(self.out)
+                self.out.append('"'); self.state = "string"; self.last_comma = None
+            elif ch == "/":
+                if pos >= n:
+                    self.carry = "/"; return
+                if text[pos] == "/": self.state = "line_comment"; pos += 1
+                elif text[pos] == "*": self.state = "block_comment"; pos += 1
+                else: self._emit("/")
+            elif ch == ",":
+                self.safe = (len(self.out), tuple(self.stack))
+                self.last_comma = len(self.out); self.out.append(",")
+            elif ch in "{[":
+                self._open(ch)
+            else:
+                self._close(ch)
+
+    def _open(self, ch):
+        depth = len(self.stack)
+        if ch == "{" and self.items_depth is not None and depth == self.items_depth:
+            self.item_start = len(self.out)
+            if self.last_comma is None: self.safe = (self.item_start, tuple(self.stack))  # sau dấu phẩy: safe đã đặt trước dấu phẩy
+        if ch == "[" and self.items_depth is None and (depth == 0 or (depth == 1 and self.key in self.item_keys)):
+            self.items_depth = depth + 1
+        self.stack.append(ch)
+        self._emit(ch)
+
+    def _close(self, ch):
+        if not self.stack: return
+        if self.last_comma is not None: self.out[self.last_comma] = ""; self.last_comma = None
+        # Ngoặc đóng sai loại (model quên đóng 1 cấp) -> đóng luôn các cấp còn thiếu
+        while self.stack and _CLOSER[self.stack[-1]] != ch:
+            self._emit(_CLOSER[self.stack.pop()])
+        if not self.stack: self.state = "done"; return
+        self.stack.pop()
+        self._emit(ch)
+        self.safe = (len(self.out), tuple(self.stack))
+        depth = len(self.stack)
+        if ch == "}" and self.item_start is not None and depth == self.items_depth:
+            try: item = json.loads("".join(self.out[self.item_start:]))
+            except ValueError: item = None
+            if isinstance(item, dict): self.items.append(item)
+            self.item_start = None
+        if ch == "]" and depth + 1 == self.items_depth: self.items_depth = -1  # chỉ lấy mảng panels đầu tiên
+        if not self.stack: self.state = "done"
+
+
+def extract(text):
+    # Thay cho robust_json_extract: cả output trong 1 lần
+    scanner = JSONScanner()
+    scanner.feed(text or "")
+    return scanner.result()
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- CACHE KẾT QUẢ LLM (2 TẦNG) ---
+# Tầng 1: LRU trong RAM của từng process. Tầng 2: file SQLite dùng chung giữa các gunicorn worker.
+# Key = sha256(model, prompt, temperature) -> cùng prompt thì không phải trả tiền gọi lại model.
+
+# Không bao giờ lưu các chuỗi lỗi mà generate_story_ai trả về
+ERROR_PREFIXES = ("ERROR", "System Error", "Error parsing response")
+
+
+def make_key(model, prompt, temperature):
+    raw = json.dumps([model, prompt, temperature], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def is_cacheable(text):
+    return bool(text) and not text.lstrip().startswith(ERROR_PREFIXES)
+
+
+class MemoryTier:
+    def __init__(self, max_items=256, ttl=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            value, stored_at = item
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]; return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value, stored_at=None):
+        with self._lock:
+            self._data[key] = (value, stored_at or time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items: self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock: self._data.clear()
+
+    def __len__(self): return len(self._data)
+
+
+class DiskTier:
+    def __init__(self, path, max_bytes=200 * 1024 * 1024, ttl=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,
+                created_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed ON llm_cache (accessed_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            if self.ttl and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,)); return None
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row
+
+    def put(self, key, value):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        if self.ttl: conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_bytes: return
+        # Xóa các entry lâu không dùng nhất cho tới khi còn ~90% dung lượng
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for key, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at"):
+            victims.append((key,)); freed += size
+            if freed >= target: break
+        conn.executemany("DELETE FROM llm_cache WHERE key = ?", victims)
+
+    def stats(self):
+        with self._connect() as conn:
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        return {"entries": count, "bytes": total}
+
+    def clear(self):
+        with self._connect() as conn: conn.execute("DELETE FROM llm_cache")
+
+
+class ResponseCache:
+    def __init__(self, path, max_items=256, max_bytes=200 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.memory = MemoryTier(max_items, ttl)
+        self.disk = DiskTier(path, max_bytes, ttl)
+        self.counters = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "stores": 0, "bypassed": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock: self.counters[key] += 1
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("hits_memory"); return value
+        row = self.disk.get(key)
+        if row is not None:
+            self.memory.put(key, row[0], row[1])
+            self._count("hits_disk"); return row[0]
+        self._count("misses")
+        return None
+
+    def put(self, key, value):
+        if not is_cacheable(value):
+            self._count("rejected"); return
+        self.memory.put(key, value)
+        self.disk.put(key, value)
+        self._count("stores")
+
+    def note_bypass(self): self._count("bypassed")
+
+    def stats(self):
+        with self._lock: data = dict(self.counters)
+        lookups = data["hits_memory"] + data["hits_disk"] + data["misses"]
+        data["hit_ratio"] = round((data["hits_memory"] + data["hits_disk"]) / lookups, 3) if lookups else 0.0
+        data["memory_entries"] = len(self.memory)
+        data.update({f"disk_{k}": v for k, v in self.disk.stats().items()})
+        return data
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache(default_dir):
+    # None nếu tắt cache bằng LLM_CACHE_ENABLED=0
+    global _cache
+    if os.environ.get('LLM_CACHE_ENABLED', '1') == '0': return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(
+                    os.environ.get('LLM_CACHE_PATH', os.path.join(default_dir, 'llm_cache.db')),
+                    max_items=int(os.environ.get('LLM_CACHE_MAX_ITEMS', 256)),
+                    max_bytes=int(os.environ.get('LLM_CACHE_MAX_BYTES', 200 * 1024 * 1024)),
+                    ttl=float(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600)),
+                )
+    return _cache
@@ -0,0 +1,509 @@
+import os
+import json
+import ssl
+import time
+import asyncio
+import weakref
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+import resilience
+
+# --- SHARED LLM CLIENT (1 pool / process) ---
+# Giữ kết nối keep-alive tới api.yescale.io thay vì bắt tay TCP + TLS cho mỗi lần gọi.
+
+DEFAULT_BASE_URL = "https://api.yescale.io"
+CHAT_PATH = "/v1/chat/completions"
+
+# Lỗi xảy ra khi server đã đóng kết nối idle mà mình chưa biết -> thử lại 1 lần với kết nối mới
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+
+class UpstreamError(Exception):
+    def __init__(self, status, body=b"", headers=None):
+        super().__init__(f"Upstream returned {status}")
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+class TruncatedStream(UpstreamError):
+    # Stream hết mà không có "data: [DONE]" (upstream ngắt kết nối / đọc bị cắt) -> không được coi là xong, không cache
+    def __init__(self):
+        super().__init__(502, b"stream ended before [DONE]")
+
+
+class ConnectionPool:
+    def __init__(self, base_url=DEFAULT_BASE_URL, size=8, connect_timeout=10.0, read_timeout=180.0,
+                 idle_timeout=60.0, keep_alive=True, ssl_context=None):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.keep_alive = keep_alive
+        self.ssl_context = ssl_context
+        self._idle = []  # LIFO: kết nối vừa dùng xong (còn "nóng") được lấy ra trước
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.stats = {"created": 0, "reused": 0, "requests": 0, "stale_retries": 0,
+                      "discarded": 0, "errors": 0}
+
+    def _count(self, key, n=1):
+        with self._lock: self.stats[key] += n
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        self._count("created")
+        return conn
+
+    def _checkout(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.stats["reused"] += 1
+                    return conn, True
+                self.stats["discarded"] += 1
+                conn.close()
+        return self._new_connection(), False
+
+    def _checkin(self, conn):
+        if not self.keep_alive:
+            conn.close(); return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+
+    def request(self, method, path, body=None, headers=None):
+        # Trả về (status, headers, body_bytes). Giữ 1 slot trong pool suốt thời gian request.
+        self._slots.acquire()
+        try:
+            self._count("requests")
+            conn, reused = self._checkout()
+            try:
+                return self._send(conn, method, path, body, headers)
+            except STALE_ERRORS:
+                conn.close()
+                if not reused: raise
+                self._count("stale_retries")
+                return self._send(self._new_connection(), method, path, body, headers)
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            self._slots.release()
+
+    def _send(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers or {})
+            res = conn.getresponse()
+            data = res.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, res)
+        return res.status, dict(res.getheaders()), data
+
+    def _release(self, conn, res):
+        if res.will_close: conn.close()
+        else: self._checkin(conn)
+
+    def _open(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers or {})
+            return conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def stream_lines(self, method, path, body=None, headers=None):
+        # Generator: yield từng dòng của response (SSE). Kết nối chỉ quay lại pool khi đọc hết
+        # response; nếu bên gọi dừng giữa chừng (client ngắt) thì đóng kết nối đó.
+        self._slots.acquire()
+        conn = None
+        try:
+            self._count("requests")
+            conn, reused = self._checkout()
+            try:
+                res = self._open(conn, method, path, body, headers)
+            except STALE_ERRORS:
+                if not reused: raise
+                self._count("stale_retries")
+                conn = self._new_connection()
+                res = self._open(conn, method, path, body, headers)
+            if res.status != 200:
+                data = res.read()
+                self._release(conn, res); conn = None
+                raise UpstreamError(res.status, data, dict(res.getheaders()))
+            for line in res: yield line
+            self._release(conn, res); conn = None
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            if conn is not None: conn.close()
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for conn, _ in self._idle: conn.close()
+            self._idle = []
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats)
+            data["idle"] = len(self._idle)
+        data["size"] = self.size
+        data["reuse_ratio"] = round(data["reused"] / data["requests"], 3) if data["requests"] else 0.0
+        return data
+
+
+class LLMClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, model="gemini-2.5-pro-thinking", **pool_options):
+        self.base_url = base_url
+        self.model = model
+        self.pool = ConnectionPool(base_url, **pool_options)
+
+    def chat(self, api_key, prompt, model=None, temperature=0.8):
+        # Trả về (status, body_text) - việc diễn giải lỗi để cho generate_story_ai
+        status, _, text = self.complete(api_key, prompt, model, temperature)
+        return status, text
+
+    def complete(self, api_key, prompt, model=None, temperature=0.8):
+        # Như chat() nhưng kèm headers (Retry-After...) cho lớp retry
+        payload = json.dumps({
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature
+        })
+        headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
+        status, res_headers, data = self.pool.request("POST", CHAT_PATH, payload, headers)
+        return status, res_headers, data.decode("utf-8")
+
+    def stream_chat(self, api_key, prompt, model=None, temperature=0.8):
+        # Yield từng đoạn text (delta) khi model sinh ra. Lỗi HTTP -> UpstreamError
+        payload = json.dumps({
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "stream": True
+        })
+        headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json',
+                   'Accept': 'text/event-stream'}
+        finished = False
+        for raw in self.pool.stream_lines("POST", CHAT_PATH, payload, headers):
+            line = raw.decode("utf-8").strip()
+            # Sau [DONE] vẫn đọc tới hết response để kết nối còn dùng lại được
+            if finished or not line.startswith("data:"): continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                finished = True; continue
+            for choice in json.loads(data).get("choices", []):
+                delta = (choice.get("delta") or {}).get("content")
+                if delta: yield delta
+        if not finished: raise TruncatedStream()
+
+    def stats(self):
+        data = self.pool.snapshot()
+        data["base_url"] = self.base_url
+        return data
+
+
+# --- BẢN ASYNCIO (chế độ ASGI, xem asgi.py) ---
+# Cùng giao thức HTTP/1.1 keep-alive như ConnectionPool nhưng chạy trên asyncio streams:
+# 1 event loop giữ được hàng trăm request đang chờ model mà không tốn 1 thread / request.
+class AsyncConnectionPool:
+    def __init__(self, base_url=DEFAULT_BASE_URL, size=200, connect_timeout=10.0, read_timeout=180.0,
+                 idle_timeout=60.0, ssl_context=None):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme or 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.scheme == 'https' else 80)
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.ssl_context = (ssl_context or ssl.create_default_context()) if self.scheme == 'https' else None
+        self._idle = []
+        self._slots = None  # asyncio.Semaphore tạo trong event loop đang chạy
+        self.stats = {"created": 0, "reused": 0, "requests": 0, "stale_retries": 0,
+                      "discarded": 0, "errors": 0}
+
+    def _semaphore(self):
+        if self._slots is None: self._slots = asyncio.Semaphore(self.size)
+        return self._slots
+
+    async def _new_connection(self):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl_context,
+                                    server_hostname=self.host if self.ssl_context else None),
+            self.connect_timeout)
+        self.stats["created"] += 1
+        return reader, writer
+
+    async def _checkout(self):
+        now = time.monotonic()
+        while self._idle:
+            conn, last_used = self._idle.pop()
+            if now - last_used < self.idle_timeout and not conn[0].at_eof():
+                self.stats["reused"] += 1
+                return conn, True
+            self.stats["discarded"] += 1
+            conn[1].close()
+        return await self._new_connection(), False
+
+    def _checkin(self, conn, will_close):
+        if will_close: conn[1].close()
+        else: self._idle.append((conn, time.monotonic()))
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self.read_timeout)
+        except asyncio.IncompleteReadError:
+            raise ConnectionResetError("Upstream closed the connection")
+
+    async def _open(self, conn, method, path, body, headers):
+        # Gửi request, đọc status + headers. Trả về (status, headers, will_close)
+        reader, writer = conn
+        data = body.encode("utf-8") if isinstance(body, str) else (body or b"")
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(data)}"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+        status_line = await self._read(reader.readline())
+        if not status_line: raise http.client.RemoteDisconnected("Upstream closed the connection")
+        try: status = int(status_line.split()[1])
+        except (IndexError, ValueError): raise http.client.BadStatusLine(status_line)
+        res_headers = {}
+        while True:
+            line = await self._read(reader.readline())
+            if line in (b"\r\n", b"\n", b""): break
+            name, _, value = line.decode("latin-1").partition(":")
+            res_headers[name.strip().title()] = value.strip()
+        will_close = res_headers.get("Connection", "").lower() == "close"
+        return status, res_headers, will_close
+
+    async def _chunks(self, reader, headers):
+        # Body theo Content-Length hoặc chunked; không có cả 2 thì đọc tới khi server đóng
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int((await self._read(reader.readline())).split(b";")[0], 16)
+                if size == 0:
+                    await self._read(reader.readline()); return
+                yield await self._read(reader.readexactly(size))
+                await self._read(reader.readexactly(2))
+        elif "Content-Length" in headers:
+            length = int(headers["Content-Length"])
+            if length: yield await self._read(reader.readexactly(length))
+        else:
+            yield await self._read(reader.read())
+
+    async def _start(self, method, path, body, headers):
+        conn, reused = await self._checkout()
+        try:
+            return conn, await self._open(conn, method, path, body, headers)
+        except STALE_ERRORS:
+            conn[1].close()
+            if not reused: raise
+            self.stats["stale_retries"] += 1
+            conn = await self._new_connection()
+            try:
+                return conn, await self._open(conn, method, path, body, headers)
+            except Exception:
+                conn[1].close(); raise
+        except Exception:
+            conn[1].close(); raise
+
+    async def request(self, method, path, body=None, headers=None):
+        async with self._semaphore():
+            self.stats["requests"] += 1
+            try:
+                conn, (status, res_headers, will_close) = await self._start(method, path, body, headers)
+                try:
+                    data = b"".join([chunk async for chunk in self._chunks(conn[0], res_headers)])
+                except Exception:
+                    conn[1].close(); raise
+                self._checkin(conn, will_close or "Content-Length" not in res_headers and "Transfer-Encoding" not in res_headers)
+                return status, res_headers, data
+            except Exception:
+                self.stats["errors"] += 1
+                raise
+
+    async def stream_lines(self, method, path, body=None, headers=None):
+        # Async generator: yield từng dòng của response (SSE). Dừng giữa chừng -> đóng kết nối đó
+        async with self._semaphore():
+            self.stats["requests"] += 1
+            conn = None
+            try:
+                conn, (status, res_headers, will_close) = await self._start(method, path, body, headers)
+                if status != 200:
+                    data = b"".join([chunk async for chunk in self._chunks(conn[0], res_headers)])
+                    self._checkin(conn, will_close); conn = None
+                    raise UpstreamError(status, data, res_headers)
+                buffer = b""
+                async for chunk in self._chunks(conn[0], res_headers):
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines: yield line + b"\n"
+                if buffer: yield buffer
+                self._checkin(conn, will_close); conn = None
+            except BaseException as e:
+                if not isinstance(e, (GeneratorExit, asyncio.CancelledError)): self.stats["errors"] += 1
+                raise
+            finally:
+                if conn is not None: conn[1].close()
+
+    def close(self):
+        for conn, _ in self._idle: conn[1].close()
+        self._idle = []
+
+    def snapshot(self):
+        data = dict(self.stats, idle=len(self._idle), size=self.size)
+        data["reuse_ratio"] = round(data["reused"] / data["requests"], 3) if data["requests"] else 0.0
+        return data
+
+
+class AsyncLLMClient(LLMClient):
+    # Cùng payload/parse SSE với LLMClient, chỉ khác lớp vận chuyển
+    def __init__(self, base_url=DEFAULT_BASE_URL, model="gemini-2.5-pro-thinking", **pool_options):
+        self.base_url = base_url
+        self.model = model
+        self.pool = AsyncConnectionPool(base_url, **pool_options)
+
+    async def chat(self, api_key, prompt, model=None, temperature=0.8):
+        status, _, text = await self.complete(api_key, prompt, model, temperature)
+        return status, text
+
+    async def complete(self, api_key, prompt, model=None, temperature=0.8):
+        payload = json.dumps({
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature
+        })
+        headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'}
+        status, res_headers, data = await self.pool.request("POST", CHAT_PATH, payload, headers)
+        return status, res_headers, data.decode("utf-8")
+
+    async def stream_chat(self, api_key, prompt, model=None, temperature=0.8):
+        payload = json.dumps({
+            "model": model or self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "stream": True
+        })
+        headers = {'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json',
+                   'Accept': 'text/event-stream'}
+        finished = False
+        async for raw in self.pool.stream_lines("POST", CHAT_PATH, payload, headers):
+            line = raw.decode("utf-8").strip()
+            if finished or not line.startswith("data:"): continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                finished = True; continue
+            for choice in json.loads(data).get("choices", []):
+                delta = (choice.get("delta") or {}).get("content")
+                if delta: yield delta
+        if not finished: raise TruncatedStream()
+
+
+class BoldStripper:
+    # Bỏ "**" giống content.replace('**', '') nhưng cho dữ liệu stream: một chuỗi dấu *
+    # ở cuối chunk được giữ lại tới chunk sau vì có thể ghép thành "**".
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, chunk):
+        text = self._pending + chunk
+        stripped = text.rstrip("*")
+        self._pending = text[len(stripped):]
+        return stripped.replace("**", "")
+
+    def flush(self):
+        text, self._pending = self._pending, ""
+        return text.replace("**", "")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    # Tạo lazy để mỗi gunicorn worker (sau fork) có pool riêng.
+    # Bọc retry/hedging/circuit breaker (resilience.py); LLM_MAX_ATTEMPTS=1 + không hedge = gọi 1 lần như cũ
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                hedge = os.environ.get('LLM_HEDGE_PERCENTILE')
+                _client = resilience.ResilientClient(
+                    LLMClient(
+                        base_url=os.environ.get('LLM_BASE_URL', DEFAULT_BASE_URL),
+                        model=os.environ.get('LLM_MODEL', 'gemini-2.5-pro-thinking'),
+                        size=int(os.environ.get('LLM_POOL_SIZE', 8)),
+                        connect_timeout=float(os.environ.get('LLM_CONNECT_TIMEOUT', 10)),
+                        read_timeout=float(os.environ.get('LLM_READ_TIMEOUT', 180)),
+                        idle_timeout=float(os.environ.get('LLM_IDLE_TIMEOUT', 60)),
+                    ),
+                    policy=resilience.RetryPolicy(
+                        max_attempts=int(os.environ.get('LLM_MAX_ATTEMPTS', 3)),
+                        base_delay=float(os.environ.get('LLM_RETRY_BASE_DELAY', 0.5)),
+                        max_delay=float(os.environ.get('LLM_RETRY_MAX_DELAY', 8)),
+                        max_retry_after=float(os.environ.get('LLM_MAX_RETRY_AFTER', 30)),
+                        deadline=float(os.environ.get('LLM_DEADLINE', 300)),
+                    ),
+                    breaker=resilience.CircuitBreaker(
+                        failure_threshold=int(os.environ.get('LLM_BREAKER_THRESHOLD', 5)),
+                        reset_timeout=float(os.environ.get('LLM_BREAKER_RESET', 30)),
+                    ),
+                    hedge_percentile=float(hedge) if hedge else None,
+                )
+    return _client
+
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_client():
+    # 1 client / event loop (uvicorn: 1 loop / worker): kết nối asyncio không dùng được sang loop khác.
+    # Retry + circuit breaker như bản sync, không hedge
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = resilience.AsyncResilientClient(
+            AsyncLLMClient(
+                base_url=os.environ.get('LLM_BASE_URL', DEFAULT_BASE_URL),
+                model=os.environ.get('LLM_MODEL', 'gemini-2.5-pro-thinking'),
+                size=int(os.environ.get('LLM_ASYNC_POOL_SIZE', 200)),
+                connect_timeout=float(os.environ.get('LLM_CONNECT_TIMEOUT', 10)),
+                read_timeout=float(os.environ.get('LLM_READ_TIMEOUT', 180)),
+                idle_timeout=float(os.environ.get('LLM_IDLE_TIMEOUT', 60)),
+            ),
+            policy=resilience.RetryPolicy(
+                max_attempts=int(os.environ.get('LLM_MAX_ATTEMPTS', 3)),
+                base_delay=float(os.environ.get('LLM_RETRY_BASE_DELAY', 0.5)),
+                max_delay=float(os.environ.get('LLM_RETRY_MAX_DELAY', 8)),
+                max_retry_after=float(os.environ.get('LLM_MAX_RETRY_AFTER', 30)),
+                deadline=float(os.environ.get('LLM_DEADLINE', 300)),
+            ),
+            breaker=resilience.CircuitBreaker(
+                failure_threshold=int(os.environ.get('LLM_BREAKER_THRESHOLD', 5)),
+                reset_timeout=float(os.environ.get('LLM_BREAKER_RESET', 30)),
+            ),
+        )
+    return client
+
+def insecure_ssl_context():
+    # Chỉ dùng cho benchmark với stub server tự ký
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
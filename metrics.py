@@ -0,0 +1,183 @@
+import os
+import time
+import bisect
+import threading
+
+# --- METRICS KIỂU PROMETHEUS (không cần thư viện ngoài) ---
+# Counter / Histogram / Gauge giữ số liệu trong bộ nhớ của process, /metrics xuất ra text format
+# mà Prometheus scrape được. METRICS_ENABLED=0 -> mọi inc()/observe() return ngay và app không
+# gắn hook nào (xem install_flask_hooks), nên chi phí gần như bằng 0.
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 15 * 1024 ** 2, 50 * 1024 ** 2)
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key)) + (extra or [])
+    if not pairs: return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"): return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED: return
+        key = _label_key(self.labelnames, labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock: items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [số đếm mỗi bucket..., sum, count]
+
+    def observe(self, value, **labels):
+        if not ENABLED: return
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None: series = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets): series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock: items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self.header()
+        for key, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Gauge(Metric):
+    # Giá trị đọc lúc scrape: callback trả về số, hoặc {(label, ...): số}
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None, kind=None):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+        if kind: self.kind = kind  # vd: "counter" cho số đếm lấy từ stats() của module khác
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []  # nguồn số liệu lỗi không được làm hỏng cả trang /metrics
+        if value is None: return []
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, callback, labelnames=(), kind=None):
+        return self._add(Gauge(name, help, labelnames, callback, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics: lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+registry = Registry()
+
+
+# --- ĐO THỜI GIAN SQL THEO TỪNG REQUEST ---
+_local = threading.local()
+
+def begin_scope():
+    _local.queries = 0
+    _local.query_seconds = 0.0
+
+def end_scope():
+    # Trả về (số query, tổng thời gian) của request hiện tại rồi xóa bộ đếm
+    result = (getattr(_local, 'queries', 0), getattr(_local, 'query_seconds', 0.0))
+    _local.queries = None
+    return result
+
+def install_sqlalchemy_hooks(engine, query_histogram):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        query_histogram.observe(elapsed, operation=statement.lstrip()[:6].upper())
+        if getattr(_local, 'queries', None) is not None:
+            _local.queries += 1
+            _local.query_seconds += elapsed
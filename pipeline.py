@@ -0,0 +1,80 @@
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# --- FAN-OUT ENGINE CHO PIPELINE SINH NỘI DUNG ---
+# Chạy song song nhiều task (các biến thể quiz, các level của batch) trên 1 thread pool dùng chung,
+# có timeout và báo lỗi từng phần: task hỏng/quá giờ không làm hỏng kết quả của task khác.
+
+
+class TaskResult:
+    def __init__(self, name, ok, value=None, error=None, seconds=0.0):
+        self.name = name
+        self.ok = ok
+        self.value = value
+        self.error = error
+        self.seconds = seconds
+
+    def as_dict(self):
+        return {"name": self.name, "ok": self.ok, "value": self.value, "error": self.error,
+                "seconds": round(self.seconds, 2)}
+
+
+def _timed(fn):
+    start = time.monotonic()
+    try:
+        return True, fn(), None, time.monotonic() - start
+    except Exception as e:
+        return False, None, str(e) or e.__class__.__name__, time.monotonic() - start
+
+
+class FanOut:
+    # Task chưa chạy (đang chờ thread rảnh) thì chưa tính giờ: pool dùng chung nhiều job cùng lúc,
+    # task của job đến sau không bị báo "Timed out" khi chưa hề được chạy
+    POLL = 1.0  # còn task đang chờ thread -> thức dậy định kỳ để bắt đầu tính giờ cho nó
+
+    def __init__(self, max_workers, name):
+        # Pool sống suốt process; không shutdown sau mỗi lần chạy để task quá giờ
+        # (không thể kill thread) không chặn request hiện tại.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, started, key):
+        with self._lock: self._waiting += 1
+        def call():
+            with self._lock: self._waiting -= 1
+            started[key] = time.monotonic()
+            return _timed(fn)
+        # contextvars của thread gọi đi theo task (vd: app.llm_job_owner -> lời gọi LLM trong task vẫn giữ slot của job)
+        return self.executor.submit(contextvars.copy_context().run, call)
+
+    def run(self, tasks, timeout=None, on_done=None):
+        # tasks: [(name, callable)] -> [TaskResult] theo đúng thứ tự đầu vào.
+        # timeout áp dụng cho từng task, tính từ lúc task bắt đầu chạy trên thread.
+        started = {}
+        futures = {self._submit(fn, started, i): (i, name) for i, (name, fn) in enumerate(tasks)}
+        results = {}
+        pending = set(futures)
+        while pending:
+            remaining = None
+            if timeout is not None:
+                now = time.monotonic()
+                for future in [f for f in pending if futures[f][0] in started and now - started[futures[f][0]] >= timeout]:
+                    pending.discard(future)
+                    results[future] = TaskResult(futures[future][1], False, error=f"Timed out after {timeout}s",
+                                                 seconds=now - started[futures[future][0]])
+                if not pending: break
+                deadlines = [started[futures[f][0]] + timeout - now for f in pending if futures[f][0] in started]
+                if len(deadlines) < len(pending): deadlines.append(self.POLL)
+                remaining = min(deadlines)
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[future] = TaskResult(futures[future][1], *future.result())
+                if on_done: on_done(results[future])
+        return [results[f] for f in futures]
+
+    def pending(self):
+        # Số task đang chờ thread rảnh (cho /metrics)
+        return self._waiting
@@ -0,0 +1,431 @@
+import os
+import re
+import hashlib
+import threading
+from functools import lru_cache
+import storydoc
+
+# --- PROMPT TEMPLATES: BIÊN DỊCH 1 LẦN, CÓ VERSION, GIỚI HẠN TOKEN ---
+# Mỗi template có tên + version ("story/v1"). Phần tĩnh (structure, style theo level, grammar...) được
+# ghép 1 lần cho mỗi tổ hợp (level, audience, structure) rồi cache; mỗi request chỉ điền phần động.
+# Sửa nội dung prompt = thêm version mới, không sửa version cũ -> prompt (và key của LLM cache) của
+# version cũ không đổi, so sánh A/B giữa 2 version luôn ổn định.
+# PROMPT_VERSIONS="story=v1,quiz=v1" ghim version; "story=v1:80/v2:20" chia user theo tỉ lệ (cố định theo user).
+
+STORY, COMIC, TRANSLATION, QUIZ = "story", "comic", "translation", "quiz"
+
+STORY_MAX_TOKENS = int(os.environ.get('PROMPT_STORY_MAX_TOKENS', 6000))  # truyện đưa vào prompt comic/quiz
+STYLE_MAX_TOKENS = int(os.environ.get('PROMPT_STYLE_MAX_TOKENS', 125))   # ~500 ký tự văn mẫu của user
+OMITTED = "[…]"
+FIELD = re.compile(r"\$([a-z_]+)")
+
+CEFR_LEVEL_GUIDELINES = {
+    "PRE A1": "Simple Present (be/have/action). Short sentences (3-6 words). Focus on visual actions.",
+    "A1": "Present Simple/Continuous. Basic conjunctions (and, but). Dialogues are simple Q&A.",
+    "A2": "Past Simple, Future (will/going to). Adverbs of frequency. Coordinated sentences.",
+    "B1": "Narrative tenses (Past Continuous), Conditionals (1 & 2), Reasons (because/so). Expressing feelings/opinions.",
+    "B2": "Passive voice, Reported speech, Relative clauses. Nuanced vocabulary and abstract ideas.",
+    "C1": "Complex sentence structures, Inversion, Idiomatic expressions. Literary tone.",
+    "C2": "Sophisticated style, Implicit meaning, Cultural references, Irony/Humor."
+}
+
+# --- KHO GIỌNG VĂN MẪU THEO LEVEL (LITERARY STYLES) ---
+LITERARY_STYLES = {
+    "PRE A1": [
+        "Style of Eric Carle: Very simple, repetitive, focuses on nature, colors, and sensory details.",
+        "Style of Margaret Wise Brown (Goodnight Moon): Gentle, rhythmic, soothing, listing objects in the room.",
+        "Style of Mo Willems: Dialogue-heavy, simple, repetitive but expressive and funny."
+    ],
+    "A1": [
+        "Style of Arnold Lobel (Frog and Toad): Simple but warm friendship stories, cozy atmosphere.",
+        "Style of Beatrix Potter: Gentle, pastoral, focuses on small animals and rural settings.",
+        "Style of Dr. Seuss (Prose version): Whimsical, playful, simple vocabulary but creative concepts."
+    ],
+    "A2": [
+        "Style of Roald Dahl: Mischievous, energetic, vivid adjectives, funny exaggerations of characters.",
+        "Style of Enid Blyton: Clear adventure, group of friends, descriptive but accessible.",
+        "Style of Jeff Kinney (Wimpy Kid): Casual diary format, relatable school life struggles, humorous."
+    ],
+    "B1": [
+        "Style of Ernest Hemingway: Short, punchy sentences. Focus on action and concrete details. No fluffy adjectives.",
+        "Style of E.B. White (Charlotte's Web): Clear, elegant, touching, focuses on nature and loyalty.",
+        "Style of R.L. Stine (Goosebumps): Suspenseful, cliffhangers, engaging plot twists (good for mysteries)."
+    ],
+    "B2": [
+        "Style of Mark Twain: Folksy, observational, rich in local color and dialect nuances.",
+        "Style of C.S. Lewis: Descriptive, slightly magical tone, clear moral compass.",
+        "Style of Neil Gaiman (Coraline): Atmospheric, slightly dark/mysterious, rich imagery."
+    ],
+    "C1": [
+        "Style of Jane Austen: Social observation, irony, complex sentence structures, focus on manners/relationships.",
+        "Style of Sherlock Holmes (Conan Doyle): Deductive, analytical, detailed descriptions of settings.",
+        "Style of Jack London: Raw nature, survival, intense description of the environment."
+    ],
+    "C2": [
+        "Style of Oscar Wilde: Witty, aesthetic, sophisticated vocabulary, paradoxical humor.",
+        "Style of Edgar Allan Poe: Melancholic, poetic, complex grammar, psychological depth.",
+        "Style of Virginia Woolf: Stream of consciousness, focus on internal thoughts and fleeing moments."
+    ]
+}
+
+
+# --- ƯỚC LƯỢNG TOKEN + CẮT GỌN ĐẦU VÀO QUÁ DÀI ---
+def estimate_tokens(text):
+    # ~4 byte UTF-8 / token: tiếng Anh ~4 ký tự/token, tiếng Việt có dấu tốn nhiều token hơn -> nhiều byte hơn
+    return (len((text or "").encode("utf-8")) + 3) // 4
+
+def clip(text, max_tokens):
+    # Cắt theo số byte, lùi về ranh giới từ gần nhất
+    data = text.encode("utf-8")
+    if len(data) <= max_tokens * 4: return text
+    cut = data[:max_tokens * 4].decode("utf-8", "ignore")
+    return cut.rsplit(" ", 1)[0] if " " in cut else cut
+
+def _spread(n):
+    # Thứ tự chia đôi: giữa, 1/4, 3/4, 1/8... -> dừng ở đâu cũng giữ được các đoạn rải đều cả truyện
+    order, seen, parts = [], set(), 2
+    while parts <= 2 * n:
+        for k in range(1, parts, 2):
+            i = k * (n - 1) // parts
+            if i not in seen: seen.add(i); order.append(i)
+        parts *= 2
+    return order + [i for i in range(n) if i not in seen]
+
+def fit(text, max_tokens):
+    # Truyện quá dài -> tóm lược kiểu trích đoạn: giữ đoạn đầu (tiêu đề, mở truyện), đoạn cuối (kết),
+    # rồi thêm các đoạn rải đều ở giữa tới khi hết ngân sách; chỗ bị bỏ thay bằng OMITTED.
+    text = text or ""
+    if estimate_tokens(text) <= max_tokens: return text
+    paragraphs = [p for p in re.split(r"\n\s*\n", text.strip()) if p.strip()]
+    budget = max_tokens - estimate_tokens(OMITTED) * 2
+    keep, used = set(), 0
+    for i in [0, len(paragraphs) - 1] + _spread(len(paragraphs)):
+        cost = estimate_tokens(paragraphs[i]) + 1
+        if i in keep or used + cost > budget: continue
+        keep.add(i); used += cost
+    if not keep: return clip(paragraphs[0], max_tokens)
+    out, prev = [], -1
+    for i in sorted(keep):
+        if i != prev + 1: out.append(OMITTED)
+        out.append(paragraphs[i]); prev = i
+    if prev != len(paragraphs) - 1: out.append(OMITTED)
+    return "\n\n".join(out)
+
+
+# --- TEMPLATE ENGINE ---
+class Prompt(str):
+    # Chuỗi prompt bình thường, kèm tên template đã sinh ra nó (vd "story/v1")
+    template = None
+
+
+class PromptTemplate:
+    def __init__(self, name, version, body, sections=None):
+        self.name = name
+        self.version = version
+        self.key = f"{name}/{version}"
+        self.body = body
+        self.sections = sections  # (**static) -> dict các đoạn tĩnh; None = body không có phần tĩnh
+        self._compiled = lru_cache(maxsize=256)(self._compile)
+
+    def _compile(self, static):
+        # Điền phần tĩnh 1 lần, tách phần còn lại thành [chữ, field, chữ, field, ..., chữ] -> render chỉ còn join
+        values = self.sections(**dict(static)) if self.sections else {}
+        parts = FIELD.split(self.body)
+        chunks, fields = [parts[0]], []
+        for name, text in zip(parts[1::2], parts[2::2]):
+            if name in values: chunks[-1] += str(values[name]) + text
+            else: fields.append(name); chunks.append(text)
+        return chunks, fields
+
+    def render(self, static=None, **values):
+        chunks, fields = self._compiled(tuple(sorted((static or {}).items())))
+        out = [chunks[0]]
+        for name, text in zip(fields, chunks[1:]):
+            out.append(str(values[name])); out.append(text)
+        prompt = Prompt("".join(out))
+        prompt.template = self.key
+        _count(self.key, "rendered")
+        return prompt
+
+    def cache_info(self):
+        return self._compiled.cache_info()
+
+
+TEMPLATES = {}
+LATEST = {}
+_stats = {}
+_stats_lock = threading.Lock()
+
+def register(template):
+    TEMPLATES.setdefault(template.name, {})[template.version] = template
+    LATEST[template.name] = max(TEMPLATES[template.name], key=lambda v: int(v.lstrip("v") or 0))
+    return template
+
+def _count(key, event, n=1):
+    with _stats_lock: _stats[(key, event)] = _stats.get((key, event), 0) + n
+
+def stats():
+    with _stats_lock: data = dict(_stats)
+    for versions in TEMPLATES.values():
+        for t in versions.values():
+            info = t.cache_info()
+            data[(t.key, "compile_hits")] = info.hits
+            data[(t.key, "compiled")] = info.currsize
+    return data
+
+def parse_versions(spec):
+    # "story=v1:80/v2:20,quiz=v1" -> {"story": [("v1", 80), ("v2", 20)], "quiz": [("v1", 1)]}
+    plan = {}
+    for item in (spec or "").split(","):
+        name, _, variants = item.strip().partition("=")
+        if not variants: continue
+        for variant in variants.split("/"):
+            version, _, weight = variant.strip().partition(":")
+            plan.setdefault(name.strip(), []).append((version, int(weight or 1)))
+    return plan
+
+VERSION_PLAN = parse_versions(os.environ.get('PROMPT_VERSIONS'))
+
+def choose(name, subject=None):
+    # Version mới nhất, trừ khi PROMPT_VERSIONS ghim/chia A/B. Cùng subject (user) luôn rơi vào cùng version.
+    available = TEMPLATES[name]
+    plan = [(v, w) for v, w in VERSION_PLAN.get(name, []) if v in available and w > 0]
+    if not plan: return LATEST[name]
+    bucket = int(hashlib.sha256(f"{name}:{subject}".encode()).hexdigest(), 16) % sum(w for _, w in plan)
+    for version, weight in plan:
+        if bucket < weight: return version
+        bucket -= weight
+
+def assign(subject):
+    # Version của mọi template cho 1 user, lưu vào payload của job -> job chạy lại/retry vẫn dùng đúng version
+    return {name: choose(name, subject) for name in TEMPLATES}
+
+def get(name, version=None):
+    # version không còn (vd job cũ sau khi gỡ 1 version) -> dùng version đang chạy
+    return TEMPLATES[name].get(version) or TEMPLATES[name][choose(name)]
+
+def budget(key, text, max_tokens):
+    fitted = fit(text, max_tokens)
+    if fitted != text: _count(key, "trimmed")
+    return fitted
+
+
+# --- STORY ---
+def story_sections(level, structure, num_pages):
+    suggested_styles = LITERARY_STYLES.get(level, [])
+    style_selection_instr = ""
+    if suggested_styles:
+        style_list_str = "\n".join([f"- {s}" for s in suggested_styles])
+        style_selection_instr = f"""
+    **LITERARY VOICE (CRITICAL):**
+    Choose ONE of the following styles that BEST fits the story idea below:
+    {style_list_str}
+    -> **Apply the chosen style consistently.**
+    """
+
+    if structure == "picture_book":
+        structure_type = "PICTURE BOOK"
+        structure_instr = f"""
+        **STRUCTURE: PICTURE BOOK FORMAT**
+        - Divide the story into **{num_pages} PAGES**.
+        - Label each part clearly as: `--- PAGE [X] ---`
+        - **IMPORTANT:** Write a meaningful paragraph (3-5 sentences) per page.
+        - **FLOW:** Ensure smooth transitions between pages. Use connecting words (Then, Next, Suddenly) so the story reads as one continuous narrative, not disjointed scenes.
+        """
+        opening_rule = "Start with a **# Title**. Then immediately start with `--- PAGE 1 ---`."
+    elif structure == "short":
+        structure_type = "SHORT STORY (Continuous)"
+        structure_instr = """
+        **STRUCTURE: CONTINUOUS STORY**
+        - Do NOT use Chapter headings.
+        - Start directly with the story content after the Title.
+        - Organize into clear paragraphs.
+        """
+        opening_rule = "Start with a **# Title**. Then immediately start the story text."
+    else:
+        structure_type = "CHAPTER BOOK"
+        structure_instr = """
+        **STRUCTURE: CHAPTERS**
+        - Divide into **3-5 CHAPTERS**. Label: `### CHAPTER [X]: [Title]`
+        - **IMPORTANT:** The story must start immediately with **CHAPTER 1**.
+        """
+        opening_rule = "Start with a **# Title**. Immediately follow with **CHAPTER 1**. Introduce the character INSIDE Chapter 1."
+
+    return {"cefr_level": level, "structure_type": structure_type, "structure_instr": structure_instr,
+            "opening_rule": opening_rule, "style_selection_instr": style_selection_instr,
+            "grammar": CEFR_LEVEL_GUIDELINES.get(level, "Standard grammar")}
+
+register(PromptTemplate(STORY, "v1", """
+    **Role:** Best-selling Author of Graded Readers.
+    **Goal:** Write a $structure_type that is engaging, emotional, and educational.
+    
+    **CORE INPUTS:**
+    - Level: $cefr_level
+    - Length: ~$word_count words.
+    - Theme: $theme
+    - Main Character: $main_char
+    $support_instr
+    
+    **MANDATORY GUIDELINES:**
+    
+    1. **OPENING & STRUCTURE:** - $opening_rule
+       - $structure_instr
+    
+    2. **VOCABULARY INTEGRATION:**
+       - **Target Words:** [$vocab]
+       - Weave target words into the story naturally (approx 3-5 times each).
+       - Do NOT use backticks/bold for target words.
+    
+    3. $setting_instr
+    
+    4. **GRAMMAR & TONE:**
+       - **Grammar Level:** $grammar
+       - **CRITICAL:** Even at low levels (A1/A2), use **NATURAL English phrasing**. ALWAYS use proper articles (a, an, the) and pronouns. Do NOT write in "pidgin" or broken English (e.g., write "He stays in his bedroom", NOT "He stay in bedroom").
+       $style_selection_instr
+       - **Tone:** Encouraging, Relatable, Human.
+    
+    5. **ADDITIONAL CONSTRAINTS:**
+       $negative_instr
+       $user_style_instr
+       - **LANGUAGE:** Write in standard English. Use English terms for family members (Mom, Dad, Grandma) unless strictly instructed otherwise.
+
+    **OUTPUT FORMAT:**
+    # [Creative Title]
+    [Story content...]
+    ---
+    Graded Definitions ($cefr_level)
+    *Format:*
+    - word: definition.
+    """, story_sections))
+
+def story_structure(level, target_audience, word_count):
+    # -> (structure, num_pages): khóa của phần tĩnh đã biên dịch
+    if target_audience == 'Children' and level in ["PRE A1", "A1", "A2"]:
+        if word_count < 150: return "picture_book", "4-5"
+        if word_count < 300: return "picture_book", "6-8"
+        return "picture_book", "8-10"
+    return ("short" if word_count < 400 else "chapters"), ""
+
+def create_prompt_for_ai(inputs, version=None):
+    template = get(STORY, version)
+    cefr_level = inputs['level'].upper()
+    try:
+        word_count = int(inputs['count'])
+    except:
+        word_count = 250
+    structure, num_pages = story_structure(cefr_level, inputs.get('target_audience', 'General'), word_count)
+
+    setting_val = inputs['setting'].strip()
+    setting_instr = f"**SETTING:** {setting_val}" if setting_val else "**SETTING:** A realistic setting in Vietnam. Atmosphere is key."
+
+    # --- MAGIC DUST ---
+    support_instr = "- **Supporting Characters:** Automatically introduce 1-2 supporting characters. **MANDATORY:** Include natural dialogue."
+    raw_num = inputs.get('num_support')
+    if raw_num and str(raw_num).strip():
+        try:
+            num = int(raw_num)
+            if num > 0:
+                support_instr = f"- **Supporting Characters:** Include exactly {num} supporting character(s). Ensure meaningful interaction."
+            else:
+                support_instr = "- **Supporting Characters:** No supporting characters. Focus on internal thoughts."
+        except: pass
+
+    negative_instr = ""
+    if inputs.get('negative_keywords'):
+        negative_instr = f"- **NEGATIVE CONSTRAINTS:** Strictly AVOID: {inputs['negative_keywords']}."
+
+    user_style_instr = ""
+    if inputs.get('style_samples'):
+        style_sample_text = budget(template.key, inputs['style_samples'], STYLE_MAX_TOKENS).replace("\n", " ")
+        user_style_instr = f"- **USER OVERRIDE STYLE:** MIMIC this specific tone: '{style_sample_text}...'"
+
+    return template.render({"level": cefr_level, "structure": structure, "num_pages": num_pages},
+                           word_count=word_count, theme=inputs['theme'], main_char=inputs.get('main_char', 'A relatable character'),
+                           support_instr=support_instr, vocab=", ".join(inputs['vocab']), setting_instr=setting_instr,
+                           negative_instr=negative_instr, user_style_instr=user_style_instr)
+
+
+# --- COMIC / TRANSLATION / QUIZ ---
+register(PromptTemplate(COMIC, "v1", """
+    **Role:** Cinematic Art Director.
+    **Task:** Convert the story below into a list of 12 visual descriptions for image generation.
+    **INPUT STORY:** $story
+    
+    **VISUAL RULES:**
+    - **Style:** Disney/Pixar 3D style, vibrant colors, expressive lighting.
+    - **Consistency:** Use specific descriptions (e.g., "A 4-year-old Vietnamese boy named Nhan, wearing a blue t-shirt").
+    - **Content:** Create visuals that match the emotional tone of the story.
+
+    **OUTPUT FORMAT (STRICT JSON ONLY):**
+    Return a valid JSON object. Do not add any introductory text or markdown formatting outside the JSON.
+    
+    {
+      "panels": [ 
+        { 
+            "panel_number": 1, 
+            "visual_description": "Detailed description of the scene...", 
+            "caption": "Short text from the story" 
+        }
+      ]
+    }
+    """))
+
+register(PromptTemplate(TRANSLATION, "v1", """
+    **Role:** Expert Graded Translator & Poet (Folktale Specialist).
+    **Task:** Retell the Vietnamese folktale "$folktale_name" in English.
+    
+    **CRITICAL INSTRUCTIONS:**
+    1. **POETIC TRANSLATION:** Vietnamese folktales often have verses/rhymes. Identify them and translate them into **English Rhyming Couplets**.
+    2. **GRADING:** - Level: $cefr_level. Length: ~$count words.
+    3. **OUTPUT:** Start with # English Title.
+    """, lambda level: {"cefr_level": level}))
+
+register(PromptTemplate(QUIZ, "v1", """
+    **Role:** Quiz Generator Engine.
+    **MODE:** STRICT OUTPUT ONLY.
+    **Forbidden:** Do NOT include internal reasoning, notes about distractors, or conversational filler (e.g., "Here is the quiz", "Note: I chose...").
+    
+    **Task:** Create a 3-stage quiz for the story below.
+    
+    **INPUT STORY:**
+    $story
+
+    **STRUCTURE:**
+
+    PART 1: CONTROLLED PRACTICE (Recall)
+    *Format:* Based on '$quiz_preference' (mcq/tf/mix/open).
+    - Create 5 questions.
+
+    PART 2: LESS CONTROLLED PRACTICE (Vocabulary)
+    *Format:* **Gap Fill**.
+    - Create a short summary text with 5-6 blanks.
+    - **CRITICAL:** Use standard underscores for blanks like this: `_______ (1)`.
+    - **MANDATORY:** Provide the Word Bank on a SINGLE LINE exactly like this format (no tables):
+      `[[WORD BANK: word1, word2, word3, word4, word5, distractor1]]`
+
+    PART 3: FREE PRACTICE (Production)
+    1. **Discussion:** 1 Open-ended question connecting to real life.
+    2. **Creative Writing:** 1 Prompt (rewrite ending, dialogue, etc.).
+
+    **ANSWER KEY (At the bottom)**
+    - Provide ONLY the answers.
+    - Do NOT explain why an answer was chosen.
+    - Format strictly:
+      Part 1: 1. A, 2. B...
+      Part 2: 1. word...
+    """, lambda quiz_preference: {"quiz_preference": quiz_preference}))
+
+def story_body(story_content):
+    # Chỉ gửi thân truyện: worksheet cũ (nếu lọt vào) không bao giờ bị gửi lại cho model
+    return storydoc.split_worksheets(story_content)[0]
+
+def create_comic_script_prompt(story_content, version=None):
+    template = get(COMIC, version)
+    return template.render(story=budget(template.key, story_body(story_content), STORY_MAX_TOKENS))
+
+def create_translation_prompt(inputs, version=None):
+    return get(TRANSLATION, version).render({"level": inputs['level'].upper()}, folktale_name=inputs['folktale_name'], count=inputs['count'])
+
+def create_pedagogical_quiz_prompt(story_content, quiz_preference, version=None):
+    template = get(QUIZ, version)
+    return template.render({"quiz_preference": quiz_preference}, story=budget(template.key, story_body(story_content), STORY_MAX_TOKENS))
@@ -0,0 +1,314 @@
+import time
+import random
+import asyncio
+import threading
+import http.client
+from collections import deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# --- CHỐNG LỖI CHO LLM UPSTREAM: RETRY + BACKOFF, HEDGING, CIRCUIT BREAKER ---
+# Bọc quanh LLMClient (cùng giao diện chat/stream_chat/stats) nên code gọi không phải đổi.
+
+RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+NETWORK_ERRORS = (OSError, http.client.HTTPException)  # gồm cả socket.timeout, ConnectionResetError...
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_in):
+        super().__init__(f"AI service is temporarily unavailable, retry in {max(1, round(retry_in))}s")
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value, now=None):
+    # Retry-After: số giây hoặc HTTP-date. Trả về số giây (>= 0) hoặc None
+    if not value: return None
+    value = value.strip()
+    if value.isdigit(): return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - (now if now is not None else time.time()))
+
+def _header(headers, name):
+    for k, v in (headers or {}).items():
+        if k.lower() == name.lower(): return v
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, max_retry_after=30.0, deadline=300.0,
+                 statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after  # upstream bảo chờ lâu hơn mức này -> trả lỗi luôn
+        self.deadline = deadline  # tổng thời gian tối đa cho mọi lần thử của 1 lời gọi
+        self.statuses = statuses
+
+    def delay(self, attempt, retry_after=None):
+        # "Full jitter": ngẫu nhiên trong [0, min(max_delay, base * 2^attempt)] để các worker không retry cùng lúc.
+        # Có Retry-After thì không retry sớm hơn mức server yêu cầu.
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is None: return backoff
+        if retry_after > self.max_retry_after: return None
+        return retry_after + backoff * 0.1
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = None
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        # Mạch mở -> báo lỗi ngay, không tốn 1 worker chờ upstream đang sập.
+        # Hết reset_timeout -> cho đúng 1 request "thăm dò" đi qua (half-open).
+        with self._lock:
+            now = self.clock()
+            if self.state == self.CLOSED: return
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(self.reset_timeout - (now - self.opened_at))
+                self.state = self.HALF_OPEN
+                self.probe_started = now
+                return
+            # HALF_OPEN: đang có request thăm dò; nếu nó bị bỏ dở quá lâu thì cho request khác thăm dò
+            if now - self.probe_started < self.reset_timeout: raise CircuitOpenError(self.reset_timeout)
+            self.probe_started = now
+
+    def on_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN: self.opens += 1
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures, "opens": self.opens}
+
+
+class LatencyTracker:
+    # Cửa sổ trượt latency của các lần gọi thành công, dùng để tính ngưỡng hedging
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock: self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            if len(self.samples) < self.min_samples: return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def _is_upstream_failure(status):
+    # Lỗi do upstream (sập/quá tải) -> tính vào circuit breaker. 429 nghĩa là upstream vẫn sống.
+    return status >= 500 or status == 408
+
+
+class ResilientClient:
+    def __init__(self, client, policy=None, breaker=None, hedge_percentile=None, hedge_min_samples=20,
+                 hedge_budget=0.1, sleep=time.sleep):
+        self.client = client
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_percentile = hedge_percentile  # None = tắt hedging (mỗi lần hedge tốn thêm 1 lượt token)
+        self.hedge_budget = hedge_budget  # tối đa ~10% số lời gọi được hedge, tránh tự làm quá tải upstream
+        self.latency = LatencyTracker(min_samples=hedge_min_samples)
+        self.sleep = sleep
+        # Mỗi lời gọi hedge giữ tối đa 2 thread -> pool gấp đôi pool kết nối để không phải xếp hàng
+        self._hedge_pool = ThreadPoolExecutor(max_workers=2 * client.pool.size, thread_name_prefix='llm-hedge') if hedge_percentile else None
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "gave_up": 0, "short_circuited": 0, "hedges": 0, "hedge_wins": 0}
+
+    @property
+    def model(self): return self.client.model
+
+    @property
+    def pool(self): return self.client.pool
+
+    def _count(self, key, n=1):
+        with self._lock: self.counters[key] += n
+
+    def _check_breaker(self):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self._count("short_circuited")
+            raise
+
+    def _next_delay(self, attempt, deadline, retry_after=None):
+        # None = không retry nữa (hết lượt, hết thời gian, hoặc Retry-After quá lâu)
+        if attempt + 1 >= self.policy.max_attempts:
+            self._count("gave_up"); return None
+        delay = self.policy.delay(attempt, retry_after)
+        if delay is None or time.monotonic() + delay > deadline:
+            self._count("gave_up"); return None
+        self._count("retries")
+        return delay
+
+    # --- GỌI THƯỜNG ---
+    def chat(self, api_key, prompt, model=None, temperature=0.8):
+        self._count("calls")
+        deadline = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            self._check_breaker()
+            try:
+                status, headers, text = self._attempt(api_key, prompt, model, temperature)
+            except NETWORK_ERRORS:
+                self.breaker.on_failure()
+                delay = self._next_delay(attempt, deadline)
+                if delay is None: raise
+            else:
+                if _is_upstream_failure(status): self.breaker.on_failure()
+                else: self.breaker.on_success()
+                if status not in self.policy.statuses: return status, text
+                delay = self._next_delay(attempt, deadline, parse_retry_after(_header(headers, 'Retry-After')))
+                if delay is None: return status, text
+            self.sleep(delay)
+            attempt += 1
+
+    def _timed_call(self, api_key, prompt, model, temperature):
+        started = time.monotonic()
+        status, headers, text = self.client.complete(api_key, prompt, model, temperature)
+        if status == 200: self.latency.add(time.monotonic() - started)
+        return status, headers, text
+
+    def _attempt(self, api_key, prompt, model, temperature):
+        threshold = self.latency.percentile(self.hedge_percentile) if self.hedge_percentile else None
+        if threshold is None: return self._timed_call(api_key, prompt, model, temperature)
+
+        # Hedging: lần gọi đầu chậm hơn ngưỡng percentile -> bắn thêm 1 lần nữa, lấy kết quả tốt về trước.
+        # Lần thua vẫn chạy tiếp tới khi xong (http.client không hủy giữa chừng được).
+        first = self._hedge_pool.submit(self._timed_call, api_key, prompt, model, temperature)
+        done, _ = wait([first], timeout=threshold)
+        if done: return first.result()
+        with self._lock:
+            over_budget = self.counters["hedges"] >= self.hedge_budget * self.counters["calls"]
+            if not over_budget: self.counters["hedges"] += 1
+        if over_budget: return first.result()
+        second = self._hedge_pool.submit(self._timed_call, api_key, prompt, model, temperature)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result()[0] == 200:
+                    if future is second: self._count("hedge_wins")
+                    return future.result()
+        return first.result()  # cả 2 đều hỏng -> xử lý như lần gọi thường
+
+    # --- STREAMING: chỉ retry khi chưa nhận được chữ nào ---
+    def stream_chat(self, api_key, prompt, model=None, temperature=0.8):
+        self._count("calls")
+        deadline = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            self._check_breaker()
+            started = False
+            try:
+                for delta in self.client.stream_chat(api_key, prompt, model, temperature):
+                    started = True
+                    yield delta
+                self.breaker.on_success()
+                return
+            except NETWORK_ERRORS:
+                self.breaker.on_failure()
+                if started: raise
+                delay = self._next_delay(attempt, deadline)
+                if delay is None: raise
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                if status is None: raise
+                if _is_upstream_failure(status): self.breaker.on_failure()
+                else: self.breaker.on_success()
+                if started or status not in self.policy.statuses: raise
+                delay = self._next_delay(attempt, deadline, parse_retry_after(_header(getattr(e, 'headers', None), 'Retry-After')))
+                if delay is None: raise
+            self.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        data = self.client.stats()
+        with self._lock: data.update(self.counters)
+        data["breaker"] = self.breaker.snapshot()
+        if self.hedge_percentile:
+            data["hedge_threshold"] = self.latency.percentile(self.hedge_percentile)
+        return data
+
+
+class AsyncResilientClient(ResilientClient):
+    # Cùng retry/backoff + circuit breaker cho AsyncLLMClient (chế độ ASGI). Không hedge: hủy/đua coroutine
+    # thì rẻ, nhưng mỗi lần hedge vẫn tốn thêm token nên để dành cho bản sync có cấu hình riêng
+    def __init__(self, client, policy=None, breaker=None):
+        super().__init__(client, policy, breaker, sleep=asyncio.sleep)
+
+    async def chat(self, api_key, prompt, model=None, temperature=0.8):
+        self._count("calls")
+        deadline = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            self._check_breaker()
+            try:
+                status, headers, text = await self.client.complete(api_key, prompt, model, temperature)
+            except NETWORK_ERRORS:
+                self.breaker.on_failure()
+                delay = self._next_delay(attempt, deadline)
+                if delay is None: raise
+            else:
+                if _is_upstream_failure(status): self.breaker.on_failure()
+                else: self.breaker.on_success()
+                if status not in self.policy.statuses: return status, text
+                delay = self._next_delay(attempt, deadline, parse_retry_after(_header(headers, 'Retry-After')))
+                if delay is None: return status, text
+            await self.sleep(delay)
+            attempt += 1
+
+    async def stream_chat(self, api_key, prompt, model=None, temperature=0.8):
+        self._count("calls")
+        deadline = time.monotonic() + self.policy.deadline
+        attempt = 0
+        while True:
+            self._check_breaker()
+            started = False
+            try:
+                async for delta in self.client.stream_chat(api_key, prompt, model, temperature):
+                    started = True
+                    yield delta
+                self.breaker.on_success()
+                return
+            except NETWORK_ERRORS:
+                self.breaker.on_failure()
+                if started: raise
+                delay = self._next_delay(attempt, deadline)
+                if delay is None: raise
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                if status is None: raise
+                if _is_upstream_failure(status): self.breaker.on_failure()
+                else: self.breaker.on_success()
+                if started or status not in self.policy.statuses: raise
+                delay = self._next_delay(attempt, deadline, parse_retry_after(_header(getattr(e, 'headers', None), 'Retry-After')))
+                if delay is None: raise
+            await self.sleep(delay)
+            attempt += 1
@@ -0,0 +1,153 @@
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import text
+
+# --- TÌM KIẾM TOÀN VĂN: TRUYỆN (title, content, vocab/level/theme) VÀ STYLE ---
+# SQLite: bảng ảo FTS5 (bm25). PostgreSQL: bảng search_document + tsvector/GIN (ts_rank_cd).
+# Cả 2 backend cùng giao diện: upsert/delete chạy trên connection của transaction đang lưu truyện,
+# nên index luôn khớp dữ liệu (rollback thì index cũng rollback).
+
+STORY, STYLE = "story", "style"
+MARK_START, MARK_END = "\ue000", "\ue001"  # đánh dấu từ khớp trong snippet, đổi thành <mark> sau khi escape HTML
+MAX_TERMS = 12
+
+
+def query_terms(q):
+    return re.findall(r"\w+", q or "", re.UNICODE)[:MAX_TERMS]
+
+def highlight(snippet):
+    return Markup(str(escape(snippet or "")).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>"))
+
+
+class SearchIndex:
+    def upsert(self, conn, kind, ref_id, user_id, title, body, vocab="", level="", theme=""):
+        raise NotImplementedError
+
+    def index_story(self, conn, story_id, user_id, title, content, vocab=(), level=None, theme=None):
+        self.upsert(conn, STORY, story_id, user_id, title, content, ", ".join(vocab), level or "", theme or "")
+
+    def index_style(self, conn, style_id, user_id, name, content):
+        self.upsert(conn, STYLE, style_id, user_id, name, content)
+
+
+class SQLiteSearch(SearchIndex):
+    # rowid = id * 2 (+1 cho style) -> xóa/cập nhật 1 dòng theo rowid, không phải quét bảng
+    def setup(self, conn):
+        conn.execute(text("""CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            kind UNINDEXED, ref_id UNINDEXED, user_id UNINDEXED, level_key UNINDEXED,
+            title, body, vocab, level, theme,
+            tokenize = 'porter unicode61 remove_diacritics 2')"""))
+
+    def _rowid(self, kind, ref_id):
+        return ref_id * 2 + (1 if kind == STYLE else 0)
+
+    def upsert(self, conn, kind, ref_id, user_id, title, body, vocab="", level="", theme=""):
+        rowid = self._rowid(kind, ref_id)
+        conn.execute(text("DELETE FROM search_index WHERE rowid = :rowid"), {"rowid": rowid})
+        conn.execute(text("""INSERT INTO search_index (rowid, kind, ref_id, user_id, level_key, title, body, vocab, level, theme)
+                              VALUES (:rowid, :kind, :ref_id, :user_id, :level_key, :title, :body, :vocab, :level, :theme)"""),
+                     {"rowid": rowid, "kind": kind, "ref_id": ref_id, "user_id": user_id, "level_key": level.upper(),
+                      "title": title or "", "body": body or "", "vocab": vocab, "level": level, "theme": theme})
+
+    def delete(self, conn, kind, ref_id):
+        conn.execute(text("DELETE FROM search_index WHERE rowid = :rowid"), {"rowid": self._rowid(kind, ref_id)})
+
+    def delete_user(self, conn, user_id):
+        conn.execute(text("DELETE FROM search_index WHERE user_id = :user_id"), {"user_id": user_id})
+
+    def count(self, conn):
+        return conn.execute(text("SELECT COUNT(*) FROM search_index")).scalar()
+
+    def clear(self, conn):
+        conn.execute(text("DELETE FROM search_index"))
+
+    def _where(self, terms, user_id, level, kind):
+        # Mỗi từ là 1 chuỗi trong ngoặc kép (không bị hiểu là toán tử FTS), từ cuối khớp theo tiền tố
+        match = " AND ".join(f'"{t}"' for t in terms[:-1]) + (" AND " if len(terms) > 1 else "") + f'"{terms[-1]}"*'
+        clauses = ["search_index MATCH :match", "user_id = :user_id"]
+        params = {"match": match, "user_id": user_id}
+        if level: clauses.append("level_key = :level"); params["level"] = level.upper()
+        if kind: clauses.append("kind = :kind"); params["kind"] = kind
+        return " AND ".join(clauses), params
+
+    def search(self, conn, user_id, q, level=None, kind=None, limit=20, offset=0):
+        terms = query_terms(q)
+        if not terms: return [], 0
+        where, params = self._where(terms, user_id, level, kind)
+        total = conn.execute(text(f"SELECT COUNT(*) FROM search_index WHERE {where}"), params).scalar()
+        # Trọng số bm25 theo thứ tự cột: title và vocab nặng nhất, rồi level/theme, cuối cùng là thân truyện
+        rows = conn.execute(text(f"""
+            SELECT kind, ref_id, title, level, theme,
+                   snippet(search_index, 5, :start, :end, '…', 24) AS snippet,
+                   bm25(search_index, 0, 0, 0, 0, 10.0, 1.0, 6.0, 3.0, 2.0) AS score
+            FROM search_index WHERE {where}
+            ORDER BY score LIMIT :limit OFFSET :offset"""),
+            dict(params, start=MARK_START, end=MARK_END, limit=limit, offset=offset)).mappings().all()
+        return [dict(r, score=-r["score"]) for r in rows], total
+
+
+class PostgresSearch(SearchIndex):
+    def __init__(self, config="english"):
+        self.config = config  # regconfig cho stemming (vd: lanterns -> lantern)
+
+    def setup(self, conn):
+        conn.execute(text("""CREATE TABLE IF NOT EXISTS search_document (
+            kind VARCHAR(10) NOT NULL, ref_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+            title TEXT, body TEXT, vocab TEXT, level VARCHAR(20), theme TEXT, tsv TSVECTOR,
+            PRIMARY KEY (kind, ref_id))"""))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_search_document_tsv ON search_document USING GIN (tsv)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_search_document_user ON search_document (user_id, level)"))
+
+    def upsert(self, conn, kind, ref_id, user_id, title, body, vocab="", level="", theme=""):
+        conn.execute(text("""
+            INSERT INTO search_document (kind, ref_id, user_id, title, body, vocab, level, theme, tsv)
+            VALUES (:kind, :ref_id, :user_id, :title, :body, :vocab, :level, :theme,
+                    setweight(to_tsvector(CAST(:config AS regconfig), :title), 'A') ||
+                    setweight(to_tsvector(CAST(:config AS regconfig), :vocab), 'A') ||
+                    setweight(to_tsvector('simple', :level || ' ' || :theme), 'B') ||
+                    setweight(to_tsvector(CAST(:config AS regconfig), :body), 'C'))
+            ON CONFLICT (kind, ref_id) DO UPDATE SET user_id = EXCLUDED.user_id, title = EXCLUDED.title,
+                body = EXCLUDED.body, vocab = EXCLUDED.vocab, level = EXCLUDED.level, theme = EXCLUDED.theme,
+                tsv = EXCLUDED.tsv"""),
+            {"kind": kind, "ref_id": ref_id, "user_id": user_id, "title": title or "", "body": body or "",
+             "vocab": vocab, "level": level.upper(), "theme": theme, "config": self.config})
+
+    def delete(self, conn, kind, ref_id):
+        conn.execute(text("DELETE FROM search_document WHERE kind = :kind AND ref_id = :ref_id"), {"kind": kind, "ref_id": ref_id})
+
+    def delete_user(self, conn, user_id):
+        conn.execute(text("DELETE FROM search_document WHERE user_id = :user_id"), {"user_id": user_id})
+
+    def count(self, conn):
+        return conn.execute(text("SELECT COUNT(*) FROM search_document")).scalar()
+
+    def clear(self, conn):
+        conn.execute(text("DELETE FROM search_document"))
+
+    def search(self, conn, user_id, q, level=None, kind=None, limit=20, offset=0):
+        terms = query_terms(q)
+        if not terms: return [], 0
+        # Chỉ gồm ký tự \w nên ghép thẳng vào to_tsquery an toàn; từ cuối khớp theo tiền tố
+        params = {"query": " & ".join(terms[:-1] + [f"{terms[-1]}:*"]), "user_id": user_id, "config": self.config}
+        where = "tsv @@ q.query AND user_id = :user_id"
+        if level: where += " AND level = :level"; params["level"] = level.upper()
+        if kind: where += " AND kind = :kind"; params["kind"] = kind
+        query_sql = "to_tsquery(CAST(:config AS regconfig), :query)"
+        total = conn.execute(text(f"SELECT COUNT(*) FROM search_document, {query_sql} AS q(query) WHERE {where}"), params).scalar()
+        # ts_headline tốn CPU -> chỉ chạy trên các dòng của trang hiện tại
+        rows = conn.execute(text(f"""
+            SELECT page.kind, page.ref_id, page.title, page.level, page.theme, page.score,
+                   ts_headline(CAST(:config AS regconfig), page.body, page.query,
+                               'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=" … "') AS snippet
+            FROM (SELECT kind, ref_id, title, level, theme, body, q.query, ts_rank_cd(tsv, q.query) AS score
+                  FROM search_document, {query_sql} AS q(query) WHERE {where}
+                  ORDER BY score DESC, ref_id DESC LIMIT :limit OFFSET :offset) AS page
+            ORDER BY page.score DESC, page.ref_id DESC"""),
+            dict(params, limit=limit, offset=offset)).mappings().all()
+        return [dict(r) for r in rows], total
+
+
+def for_dialect(name, pg_config="english"):
+    if name == "postgresql": return PostgresSearch(pg_config)
+    if name == "sqlite": return SQLiteSearch()
+    return None
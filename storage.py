@@ -0,0 +1,169 @@
+import os
+import io
+import hashlib
+import mimetypes
+
+# --- LƯU TRỮ FILE THEO HASH NỘI DUNG (CONTENT-ADDRESSED) ---
+# Key = "<2 ký tự đầu>/<sha256>.<ext>": cùng nội dung -> cùng key -> không lưu trùng,
+# và file không bao giờ đổi nội dung nên có thể cache vĩnh viễn phía trình duyệt/CDN.
+# Đếm tham chiếu (refcount) nằm trong DB (bảng StoredFile), backend chỉ lo byte.
+
+
+def content_key(data, ext):
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{digest[:2]}/{digest}.{ext.lstrip('.').lower()}"
+
+def content_type_for(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+class Storage:
+    # Giao diện chung cho các backend
+    url_prefix = ""
+
+    def put(self, data, ext):
+        # Trả về (key, created). Nếu nội dung đã có thì không ghi lại.
+        key = content_key(data, ext)
+        if self.exists(key): return key, False
+        self.write(key, data)
+        return key, True
+
+    def url(self, key): return f"{self.url_prefix}{key}"
+
+    def key_from_url(self, url):
+        if url and url.startswith(self.url_prefix): return url[len(self.url_prefix):].split('?')[0]
+        return None
+
+    def exists(self, key): raise NotImplementedError
+    def write(self, key, data): raise NotImplementedError
+    def read(self, key): raise NotImplementedError
+    def delete(self, key): raise NotImplementedError
+    def list_keys(self): raise NotImplementedError  # -> [(key, mtime)]
+
+
+class LocalStorage(Storage):
+    def __init__(self, root, url_prefix="/media/"):
+        self.root = root
+        self.url_prefix = url_prefix
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep): raise ValueError(f"Bad storage key: {key}")
+        return path
+
+    def exists(self, key): return os.path.exists(self.path(key))
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, 'wb') as f: f.write(data)
+        os.replace(tmp, path)  # ghi nguyên tử: không ai đọc được file ghi dở
+
+    def read(self, key):
+        with open(self.path(key), 'rb') as f: return f.read()
+
+    def delete(self, key):
+        try: os.remove(self.path(key))
+        except FileNotFoundError: pass
+
+    def list_keys(self):
+        for shard in sorted(os.listdir(self.root)):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir): continue
+            for name in os.listdir(shard_dir):
+                if '.tmp' in name: continue
+                yield f"{shard}/{name}", os.path.getmtime(os.path.join(shard_dir, name))
+
+
+class S3Storage(Storage):
+    # Dùng được với AWS S3, MinIO, R2... hoặc bất kỳ client nào có các hàm put_object/get_object/
+    # head_object/delete_object/list_objects_v2 giống boto3 (vd: DirectoryS3Client bên dưới).
+    def __init__(self, bucket, public_url, client=None, prefix="media/"):
+        if client is None:
+            import boto3  # chỉ cần khi thật sự dùng S3
+            client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_prefix = public_url.rstrip('/') + '/'
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except Exception:
+            return False
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data,
+                               ContentType=content_type_for(key),
+                               CacheControl='public, max-age=31536000, immutable')
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def list_keys(self):
+        token = None
+        while True:
+            kwargs = {"Bucket": self.bucket, "Prefix": self.prefix}
+            if token: kwargs["ContinuationToken"] = token
+            page = self.client.list_objects_v2(**kwargs)
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):], obj['LastModified'].timestamp()
+            if not page.get('IsTruncated'): return
+            token = page.get('NextContinuationToken')
+
+
+class DirectoryS3Client:
+    # Bản giả lập S3 trên thư mục local (dev/test không cần MinIO). Chỉ cài phần API mà S3Storage dùng.
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path): raise KeyError(Key)
+        return {"ContentLength": os.path.getsize(path)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f: f.write(Body)
+
+    def get_object(self, Bucket, Key):
+        with open(self._path(Bucket, Key), 'rb') as f: return {"Body": io.BytesIO(f.read())}
+
+    def delete_object(self, Bucket, Key):
+        try: os.remove(self._path(Bucket, Key))
+        except FileNotFoundError: pass
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        from datetime import datetime, timezone
+        base = os.path.join(self.root, Bucket)
+        contents = []
+        for dirpath, _, files in os.walk(base):
+            for name in files:
+                key = os.path.relpath(os.path.join(dirpath, name), base).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    mtime = os.path.getmtime(os.path.join(dirpath, name))
+                    contents.append({"Key": key, "LastModified": datetime.fromtimestamp(mtime, timezone.utc)})
+        return {"Contents": contents, "IsTruncated": False}
+
+
+def from_env(default_root):
+    # STORAGE_BACKEND=local (mặc định) | s3 | s3-dir (giả lập S3 trên thư mục)
+    backend = os.environ.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(os.environ.get('STORAGE_ROOT', default_root))
+    bucket = os.environ.get('S3_BUCKET', 'story-craft')
+    public_url = os.environ.get('STORAGE_PUBLIC_URL', '/media')
+    if backend == 's3-dir':
+        return S3Storage(bucket, public_url, client=DirectoryS3Client(os.environ.get('STORAGE_ROOT', default_root)))
+    return S3Storage(bucket, public_url)
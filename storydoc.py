@@ -0,0 +1,138 @@
+import re
+from markupsafe import Markup, escape
+
+# --- MÔ HÌNH TÀI LIỆU CỦA TRUYỆN (thay cho formatStoryHTML chạy trên trình duyệt) ---
+# Story.content (markdown "bẩn" của model) -> Document: tiêu đề + các section (trang / chương / định nghĩa /
+# worksheet), mỗi section là 1 dãy block (kind, value). Quy tắc đọc từng dòng giữ đúng như formatStoryHTML cũ;
+# HTML sinh ra cùng class CSS nên template/print không phải đổi. Khác bản JS: chữ của model được escape.
+
+VERSION = 1  # tăng khi đổi parser/HTML -> HTML đã lưu theo version cũ sẽ được render lại
+WORKSHEET_MARK = "PEDAGOGICAL WORKSHEET"
+WORKSHEET_HEADER = f"\n\n\n{'='*20}\n## 🎓 {WORKSHEET_MARK}\n{'='*20}\n\n"
+# Dòng "## 🎓 PEDAGOGICAL WORKSHEET" (kèm 2 dòng ==== bao quanh nếu có) mà bản cũ chèn giữa truyện và từng worksheet
+WORKSHEET_SPLIT = re.compile(r"(?:^={3,}[ \t]*\n)?^#+[ \t]*🎓?[ \t]*" + WORKSHEET_MARK + r"[ \t]*\n?(?:={3,}[ \t]*$)?", re.MULTILINE)
+PAGE_MARKER = re.compile(r"^-{3,}\s*PAGE\s*\[?(\d+)\]?\s*-{3,}$", re.IGNORECASE)
+BOLD = re.compile(r"\*\*(.*?)\*\*")
+NUMBERED = re.compile(r"\d+\.")
+
+# kind của block -> kind của section mà nó mở ra
+SECTION_STARTS = {"page": "page", "chapter": "chapter", "section": "chapter", "worksheet": "worksheet"}
+
+
+class Section:
+    def __init__(self, kind, heading=None):
+        self.kind = kind  # intro | page | chapter | definitions | worksheet
+        self.heading = heading
+        self.blocks = []
+
+    def as_dict(self):
+        return {"kind": self.kind, "heading": self.heading, "blocks": [list(b) for b in self.blocks]}
+
+
+class Document:
+    def __init__(self, title, sections):
+        self.title = title
+        self.sections = sections
+
+    def blocks(self):
+        for section in self.sections:
+            yield from section.blocks
+
+    @property
+    def word_bank(self):
+        return [w for kind, words in self.blocks() if kind == "wordbank" for w in words]
+
+    def as_dict(self):
+        return {"title": self.title, "sections": [s.as_dict() for s in self.sections], "word_bank": self.word_bank}
+
+    def html(self):
+        return Markup('<div class="formatted-story-container">' + "".join(render_block(k, v) for k, v in self.blocks()) + "</div>")
+
+
+# --- TRUYỆN + WORKSHEET ---
+# Story.content chỉ giữ thân truyện, mỗi worksheet là 1 dòng Worksheet riêng; khi hiển thị/xuất PDF thì ghép lại như cũ
+def split_worksheets(text):
+    # "truyện + HEADER + quiz 1 + HEADER + quiz 2" -> ("truyện", ["quiz 1", "quiz 2"])
+    parts = WORKSHEET_SPLIT.split(text or "")
+    return parts[0].strip(), [p.strip() for p in parts[1:] if p.strip()]
+
+def join_worksheets(body, worksheets):
+    return (body or "").strip() + "".join(WORKSHEET_HEADER + w for w in worksheets)
+
+
+# --- PARSER: 1 lượt qua các dòng ---
+def iter_blocks(text):
+    words, in_table, first = [], False, True
+    for line in (text or "").replace("`", "").split("\n"):
+        line = line.strip()
+        if not line or line.startswith(("Of course", "Here is")): continue
+
+        # Word Bank dạng bảng markdown: gom chữ trong các ô tới khi hết bảng
+        if "| Word Bank |" in line or "|:---:|" in line:
+            in_table = True; continue
+        if in_table:
+            if line.startswith("|"):
+                words += [w.strip() for w in line.split("|") if w.strip()]; continue
+            if words: yield "wordbank", words; words = []
+            in_table = False
+        # Word Bank dạng 1 dòng [[WORD BANK: a, b, c]]
+        if line.startswith("[[WORD BANK:") and line.endswith("]]"):
+            yield "wordbank", [w.strip() for w in line[12:-2].split(",")]; continue
+
+        if first:
+            first = False
+            yield "title", re.sub(r"^[#*]+", "", line).replace("**", "").strip(); continue
+        if line.startswith("#") or line.upper().startswith("CHAPTER") or "Graded Definitions" in line or line.startswith("PART "):
+            header = re.sub(r"^#+\s*", "", line).replace("**", "")
+            if WORKSHEET_MARK in line or "QUIZ" in line: yield "worksheet", header
+            elif line.upper().startswith("PART") or line.startswith("##"): yield "section", header
+            else: yield "chapter", header
+        elif line.startswith(("---", "===")):
+            page = PAGE_MARKER.match(line)
+            yield ("page", page.group(1)) if page else ("rule", "")
+        elif line.startswith(("-", "*")) or NUMBERED.match(line):
+            yield "item", line
+        else:
+            yield "body", line
+    if words: yield "wordbank", words
+
+def parse(text):
+    title, sections = None, [Section("intro")]
+    in_worksheet = False
+    for kind, value in iter_blocks(text):
+        if kind == "title" and title is None: title = value
+        if kind in SECTION_STARTS:
+            # Sau tiêu đề worksheet, các PART/## là phần con của worksheet
+            in_worksheet = in_worksheet or kind == "worksheet"
+            heading = f"PAGE {value}" if kind == "page" else value
+            section_kind = "definitions" if "Graded Definitions" in heading else SECTION_STARTS[kind]
+            sections.append(Section("worksheet" if in_worksheet else section_kind, heading))
+        sections[-1].blocks.append((kind, value))
+    if not sections[0].blocks: sections.pop(0)
+    return Document(title, sections)
+
+
+# --- HTML (cùng markup/class với formatStoryHTML) ---
+def inline(text):
+    return BOLD.sub(r"<b>\1</b>", str(escape(text)))
+
+def word_bank_html(words):
+    chips = "".join(f'<span class="word-chip">{escape(w)}</span>' for w in words)
+    return ('<div class="word-bank-container"><div class="word-bank-title"><i class="bi bi-box-seam-fill"></i> Word Bank</div>'
+            f'<div class="word-bank-grid">{chips}</div></div>')
+
+def render_block(kind, value):
+    if kind == "title": return f'<h1 class="story-title">{escape(value)}</h1>'
+    if kind == "worksheet":
+        return f'<h2 class="story-chapter" style="color: #d35400; margin-top: 50px; border-bottom: 2px solid #d35400; padding-bottom: 10px;">{escape(value)}</h2>'
+    if kind == "section":
+        return f'<h3 style="font-family: \'Times New Roman\'; font-weight: bold; margin-top: 30px; font-size: 1.4rem; color: #2c3e50;">{escape(value)}</h3>'
+    if kind == "chapter": return f'<h2 class="story-chapter">{escape(value)}</h2>'
+    if kind == "rule": return '<hr style="margin: 30px 0; border-top: 2px dashed #ccc;">'
+    if kind == "page": return f'<hr style="margin: 30px 0; border-top: 2px dashed #ccc;" data-page="{escape(value)}">'
+    if kind == "wordbank": return word_bank_html(value)
+    if kind == "item": return f'<p class="story-body" style="text-indent: 0 !important; margin-left: 20px;">{inline(value)}</p>'
+    return f'<p class="story-body">{inline(value)}</p>'
+
+def render(text):
+    return parse(text).html() if text else Markup("")